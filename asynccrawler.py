@@ -0,0 +1,634 @@
+"""Crawling with many browsers driven from a single process. Instead of a
+CrawlerProcess per browser, a Supervisor runs an AsyncCrawler coroutine per
+browser in one event loop (see eventloop.py). Each AsyncCrawler starts its
+Firefox, talks to its extension over a non-blocking AsyncExtension
+connection and waits for page loads without tying up a process. Screenshots
+are compressed by a process pool shared by all browsers, and jobs and
+results go through in-process queues, so they are never pickled. Blocking
+work, like starting and cleaning up browsers and saving DOMs, is done in
+ThreadRunners so that it never holds up the other browsers.
+
+Author: nchachra@cs.ucsd.edu
+"""
+
+import errno
+import os
+import simplejson as json
+import socket
+import threading
+import time
+import traceback
+
+from blobstore import BlobStore
+from browser import Browser
+import config
+import crawlglobs
+from crawlerprocess import CrawlerProcess, FirefoxCrawlerProcess
+from eventloop import EventLoop, Return, Semaphore, ThreadRunner, Timeout
+from extension import Extension
+import metrics
+import mplogging
+from packfile import pack_prefix, PackWriter
+from phasetimer import PhaseSummary, VisitTimer
+from screenshotpool import ScreenshotPool
+import startup
+
+
+# Errors of non-blocking sockets that mean "try again later".
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class AsyncExtension(Extension):
+    """Client for the command socket of the Firefox extension, for use in an
+    event loop. Commands are coroutines, see eventloop.py, with the same
+    names and results as the methods of Extension. Only the commands needed
+    for a visit are implemented. DOMs are saved by disk, a ThreadRunner.
+    """
+    def __init__(self, loop, disk, logger, host='localhost', port=7055):
+        Extension.__init__(self, logger, host, port)
+        self.loop = loop
+        self.disk = disk
+        # Future of the wait for the socket in progress, which is failed if
+        #    the connection is closed meanwhile.
+        self.waiting = None
+
+    def close(self):
+        if self.sock is not None:
+            self.loop.remove_reader(self.sock.fileno())
+            self.loop.remove_writer(self.sock.fileno())
+            if self.waiting and not self.waiting.done():
+                self.waiting.set_exception(
+                        socket.error(errno.EBADF, "Connection closed"))
+        self.waiting = None
+        Extension.close(self)
+
+    def _wait(self, wait, deadline):
+        self.waiting = wait(self.sock, deadline - time.time())
+        return self.waiting
+
+    def _connect(self, deadline):
+        if self.sock is not None:
+            return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        self.sock = sock
+        self.recv_buf = ''
+        try:
+            err = sock.connect_ex((self.host, self.port))
+            if err in (errno.EINPROGRESS,) + WOULD_BLOCK:
+                yield self._wait(self.loop.wait_writable, deadline)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, os.strerror(err))
+        except:
+            self.close()
+            raise
+
+    def command(self, msg, timeout=config.EXT_SOCKET_TIMEOUT, sink=None):
+        """Sends the command msg and returns the body of the reply, like
+        send_and_recv(). Fails with socket.timeout after timeout seconds, as
+        send_and_recv() does, so that eventloop.Timeout is left to mean that
+        the whole visit ran out of time.
+        """
+        strmsg = self.encode(msg)
+        reused = self.sock is not None
+        try:
+            body = yield self._exchange(strmsg, timeout, sink)
+        except Timeout:
+            # The extension is alive but slow. Resending won't help.
+            self.close()
+            raise socket.timeout("%s timed out after %s seconds"
+                                 % (msg['command'], timeout))
+        except (socket.error, RuntimeError), e:
+            self.close()
+            if not reused or self.reply_started:
+                raise
+            self.logger.debug("Command connection broken: %s. Reconnecting."
+                              % e)
+            body = None
+        if body is None:
+            try:
+                body = yield self._exchange(strmsg, timeout, sink)
+            except Timeout:
+                self.close()
+                raise socket.timeout("%s timed out after %s seconds"
+                                     % (msg['command'], timeout))
+            except (socket.error, RuntimeError):
+                self.close()
+                raise
+        raise Return(body)
+
+    def _exchange(self, strmsg, timeout, sink):
+        deadline = time.time() + timeout
+        yield self._connect(deadline)
+        self.reply_started = False
+        data = "%d\n%s" % (len(strmsg), strmsg)
+        while data:
+            try:
+                data = data[self.sock.send(data):]
+            except socket.error, e:
+                if e.args[0] not in WOULD_BLOCK:
+                    raise
+                yield self._wait(self.loop.wait_writable, deadline)
+        body = yield self._recv_frame(deadline, sink)
+        raise Return(body)
+
+    def _recv_chunk(self, deadline):
+        while True:
+            try:
+                chunk = self.sock.recv(config.EXT_RECV_SIZE)
+            except socket.error, e:
+                if e.args[0] not in WOULD_BLOCK:
+                    raise
+                yield self._wait(self.loop.wait_readable, deadline)
+                continue
+            if chunk == '':
+                raise RuntimeError, 'SOCKET BROKEN'
+            raise Return(chunk)
+
+    def _recv_frame(self, deadline, sink):
+        """Same as recv_frame(). Returns '' if sink is given.
+        """
+        while '\n' not in self.recv_buf:
+            if len(self.recv_buf) > 20:
+                raise RuntimeError('Malformed frame header: %r'
+                                   % self.recv_buf[:20])
+            self.recv_buf += yield self._recv_chunk(deadline)
+        (header, self.recv_buf) = self.recv_buf.split('\n', 1)
+        if not header.isdigit():
+            raise RuntimeError('Malformed frame header: %r' % header)
+        self.reply_started = True
+        remaining = int(header)
+        chunks = []
+        while remaining:
+            if not self.recv_buf:
+                self.recv_buf = yield self._recv_chunk(deadline)
+            chunk = self.recv_buf[:remaining]
+            self.recv_buf = self.recv_buf[len(chunk):]
+            remaining -= len(chunk)
+            if sink:
+                sink(chunk)
+            else:
+                chunks.append(chunk)
+        raise Return(''.join(chunks))
+
+    def _call(self, command, args=''):
+        body = yield self.command({'command': command, 'args': args})
+        raise Return(json.loads(body))
+
+    def wait_ready(self, process, timeout=config.PAGE_TIMEOUT):
+        """Same as Extension.wait_ready().
+        """
+        start = time.time()
+        for interval in startup.probe_intervals(timeout):
+            if process.poll() is not None:
+                self.logger.error("Browser at port %s exited on startup"
+                                  % self.port)
+                break
+            body = None
+            try:
+                body = yield self.command({'command': 'RESET', 'args': ''},
+                                          max(start + timeout - time.time(),
+                                              1))
+            except (socket.error, RuntimeError), e:
+                # Refused until the extension listens.
+                pass
+            if body:
+                raise Return(time.time() - start)
+            yield self.loop.sleep(interval)
+        raise Return(None)
+
+    def reset(self):
+        body = yield self.command({'command': 'RESET', 'args': ''})
+        raise Return(body)
+
+    def set_url(self, url):
+        return self._call('SET_URL', url)
+
+    def set_header(self, name, value):
+        return self._call('SET_HEADER', [name, value])
+
+    def set_pref(self, name, value, pref_type):
+        return self._call('SET_PREF', [name, value, pref_type])
+
+    def set_proxy(self, ip, port, proxy_type):
+        return self._call('SET_PROXY', [proxy_type, ip, port])
+
+    def set_load_policy(self, idle_time, idle_cap):
+        return self._call('SET_LOAD_POLICY',
+                          [int(idle_time * 1000), int(idle_cap * 1000)])
+
+    def html(self):
+        return self.command({'command': 'GET_HTML', 'args': ''})
+
+    def wait_for_load(self, timeout=config.PAGE_TIMEOUT, policy='onload'):
+        events = ('load', 'error')
+        if policy == 'idle':
+            events = ('settled', 'error')
+        msg = {'command': 'WAIT_FOR_EVENT',
+               'args': {'events': list(events),
+                        'timeout': int(timeout * 1000)}}
+        body = yield self.command(msg, timeout + config.EXT_EVENT_GRACE)
+        raise Return(self.event_result(json.loads(body)))
+
+    def html_file(self, dest_dir, fname, keep_html=False, store=None,
+                  pack=None):
+        """Same as Extension.html_file(), except that the HTML is kept in
+        memory while it arrives, and written and stored by the disk thread.
+        """
+        (target, existing) = yield self.disk.call(self.html_target, dest_dir,
+                                                  fname, store, pack)
+        if existing:
+            html = None
+            if keep_html:
+                html = yield self.html()
+            raise Return((existing, html))
+        chunks = []
+        msg = {'command': 'GET_HTML', 'args':''}
+        yield self.command(msg, sink=chunks.append)
+        result = yield self.disk.call(self._save_html, chunks, target,
+                                      keep_html, store, pack)
+        raise Return(result)
+
+    def _save_html(self, chunks, target, keep_html, store, pack):
+        """Writes the chunks of the HTML through an HTMLSink, and stores
+        it. Runs in the disk thread.
+        """
+        sink = self.html_sink(target[0], keep_html)
+        try:
+            try:
+                for chunk in chunks:
+                    sink(chunk)
+            finally:
+                sink.close()
+            return self.store_html(sink, target, store, pack)
+        except:
+            sink.discard()
+            raise
+
+    def screenshot_raw(self):
+        temp_path = self.screenshot_temp_path()
+        msg = {'command': 'SAVE_SCREENSHOT_FILE', 'args': temp_path}
+        response = yield self.command(msg)
+        raise Return(self.screenshot_saved(msg, response))
+
+    def collect_visit(self, evals=None):
+        msg = {'command': 'COLLECT_VISIT', 'args': evals or []}
+        body = yield self.command(msg)
+        response = self.safe_decode(body)
+        if response.get('result') == "ERROR":
+            self.logger.error("Collecting visit failed: %s"
+                              % response.get('message'))
+            raise Return(None)
+        raise Return(response)
+
+
+class AsyncCrawler(FirefoxCrawlerProcess):
+    """Crawler for a single Firefox whose visits are coroutines. It shares
+    the job handling, restart policies, resource monitoring and result
+    building of FirefoxCrawlerProcess, but is run by a Supervisor, see
+    crawl(). Standby browsers, tabs and the 'reset' restart policy are not
+    supported.
+    """
+    def __init__(self, loop, restart, ext_port, proxy_file, proxy_scheme,
+                 log_q):
+        CrawlerProcess.__init__(self, restart, 'Firefox', ext_port,
+                                proxy_file, proxy_scheme, log_q,
+                                screenshot_workers=0)
+        self.__class__ = AsyncCrawler
+        self.loop = loop
+        self.visit_lock = threading.Lock()
+        # ThreadRunners for getting jobs and for putting them back, set by
+        #    the Supervisor.
+        self.getter = None
+        self.putter = None
+        # eventloop.Semaphore limiting the browsers starting up at once, 
+        #    set by the Supervisor.
+        self.startup_slots = None
+        # ThreadRunners for starting and cleaning up browsers, and for 
+        #    creating directories and saving DOMs, set by the Supervisor. 
+        #    Browsers are started and cleaned up in order, so a browser is
+        #    gone before the next one starts at its port.
+        self.launcher = None
+        self.disk = None
+
+    def clear_browser_state(self):
+        # Needs a blocking connection. The 'reset' policy isn't supported.
+        return False
+
+    def crawl(self):
+        """Coroutine visiting jobs off the request queue, until "CLEANUP"
+        comes up. Same as CrawlerProcess._run_browser().
+        """
+        req_q = self.req_q
+        while True:
+            self.timer = VisitTimer()
+            task = yield self.getter.call(req_q.get)
+            self.timer.mark('queue_wait')
+            if task == 'CLEANUP':
+                self.logger.info("Crawler at port %s preparing to exit. "
+                                 % self.ext_port + "Found cleanup")
+                yield self.putter.call(req_q.put, task)
+                yield self.putter.call(req_q.task_done)
+                yield self._cleanup_browsers()
+                break
+            visit = self._parse_task(task)
+            if self.browser_inst and self._restart_due():
+                self._retire_browser()
+            if self.browser_inst is None:
+                started = yield self.start_browser_async()
+                if not started:
+                    yield self.putter.call(req_q.task_done)
+                    yield self.putter.call(req_q.put, task)
+                    yield self._cleanup_browsers()
+                    break
+            self.timer.mark('browser_start')
+            yield self.visit(*visit)
+
+    def start_browser_async(self):
+        """Starts Firefox and waits for its extension, like Firefox.start().
+        Returns whether the browser is up.
+        """
+        browser_inst = Browser(self.browser_name, self.logger)
+        extension_inst = AsyncExtension(self.loop, self.disk, self.logger,
+                                        port=self.ext_port)
+        browser_inst.extension = extension_inst
+        slot_start = time.time()
+        if self.startup_slots:
+            yield self.startup_slots.acquire()
+        browser_inst.slot_wait = time.time() - slot_start
+        try:
+            yield self.launcher.call(browser_inst.launch, self.ext_port)
+            browser_inst.ready_time = yield extension_inst.wait_ready(
+                                                        browser_inst.process)
+        except Exception, e:
+            self.logger.error("Error starting Firefox at port %s: %s"
+                              % (self.ext_port, traceback.format_exc()))
+            browser_inst.stop()
+            metrics.count_browser_start(None, browser_inst.slot_wait)
+            raise Return(False)
+        finally:
+            if self.startup_slots:
+                self.startup_slots.release()
+        if browser_inst.ready_time is None:
+            self.logger.error(("Extension could not be restarted for " +
+                               "Firefox instance at port %s. \n Cleaning up " +
+                               "that instance.") % self.ext_port)
+            yield self._stop_browser(browser_inst)
+            metrics.count_browser_start(None, browser_inst.slot_wait)
+            raise Return(False)
+        self.logger.info(("Firefox at port %s ready in %.2f s, after " +
+                          "waiting %.2f s to start")
+                         % (self.ext_port, browser_inst.ready_time,
+                            browser_inst.slot_wait))
+        metrics.count_browser_start(browser_inst.ready_time,
+                                    browser_inst.slot_wait)
+        (self.browser_inst, self.extension_inst) = (browser_inst,
+                                                    extension_inst)
+        raise Return(True)
+
+    def _stop_browser(self, browser_inst):
+        """Closes the connection to the extension of browser_inst, which
+        belongs to the loop, and has the launcher clean up the browser. 
+        Returns the Future of the cleanup.
+        """
+        if browser_inst.extension:
+            browser_inst.extension.close()
+            browser_inst.extension = None
+        def cleanup():
+            # Nobody waits for the cleanup of a retired browser.
+            try:
+                browser_inst.cleanup()
+            except Exception, e:
+                self.logger.error("Error cleaning up Firefox at port %s: %s"
+                                  % (self.ext_port, traceback.format_exc()))
+        return self.launcher.call(cleanup)
+
+    def _retire_browser(self):
+        """Same as CrawlerProcess._retire_browser(), without standby. The
+        cleanup goes on in the launcher while the loop moves on.
+        """
+        retired = self.browser_inst
+        self.browser_inst = None
+        self.num_visits = 0
+        metrics.count_browser_restart()
+        self._stop_browser(retired)
+
+    def _cleanup_browsers(self):
+        """Same as CrawlerProcess._cleanup_browsers(), but returns the 
+        Future of the cleanup.
+        """
+        browser_inst = self.browser_inst
+        self.browser_inst = None
+        if browser_inst is None:
+            # Still waits for the cleanups asked for earlier.
+            return self.launcher.call(lambda: None)
+        return self._stop_browser(browser_inst)
+
+    def visit(self, job_id, url, setup, features, actions):
+        """Coroutine visiting url and reporting the results. Same as
+        CrawlerProcess._visit(), except that a visit that takes longer than
+        config.ALARM_TIME is cancelled and its browser stopped, instead of
+        the alarm killing the process. Sampling the browser's resource usage
+        reads /proc, so the disk runner does it.
+        """
+        self.logger.info("Visiting %s for features %s " % (url, features))
+        result_list = None
+        self.pending_screenshot = None
+        self.attempt = {'status': None, 'proxy': None,
+                        'time': time.time()}
+        try:
+            result_list = yield self.loop.with_timeout(
+                                self.grab(job_id, url, setup, features,
+                                          actions),
+                                config.ALARM_TIME)
+        except Timeout:
+            self.timer.mark('error')
+            self.logger.critical(("Visit of %s took longer than %s seconds."+
+                                  " Stopping the browser at port %s.")
+                                 % (url, config.ALARM_TIME, self.ext_port))
+            self.attempt['status'] = config.VISIT_EXCEPTION_ST
+            self.pending_screenshot = None
+            self._retire_browser()
+        except Exception, e:
+            self.logger.error(("Error in grabbing URL %s. " +
+                               "Exception: %s")
+                              % (url, traceback.format_exc()))
+            self.attempt['status'] = config.VISIT_EXCEPTION_ST
+            self.timer.mark('error')
+        yield self.disk.call(self._after_visit)
+        self.timer.mark('monitor')
+        yield self._report(job_id, result_list)
+
+    def _report(self, job_id, result_list):
+        """Coroutine doing CrawlerProcess._report(). The putter puts the 
+        results on the result queue, which blocks if the queue is full, or 
+        is a call to the coordinator with --worker.
+        """
+        self.attempt['timings'] = dict(self.timer.timings)
+        if self.pending_screenshot:
+            self._store_screenshot_async(job_id, result_list)
+        else:
+            yield self.putter.call(self._put_results, job_id, result_list,
+                                   self.attempt)
+        self.timer.mark('enqueue')
+        self._add_timings(self.timer.timings)
+        metrics.count_visit(self.attempt, self.timer.timings)
+
+    def _visit_setup(self, setup):
+        extension_inst = self.extension_inst
+        if setup and setup.has_key('ff_prefs'):
+            for pref in setup['ff_prefs']:
+                yield extension_inst.set_pref(pref[0], pref[1], pref[2])
+        if setup and setup.has_key('headers'):
+            for (header, value) in setup['headers'].iteritems():
+                yield extension_inst.set_header(header, value)
+        proxy = self._pick_proxy(setup)
+        if proxy:
+            yield extension_inst.set_proxy(proxy[0], proxy[1], proxy[2])
+
+    def grab(self, req_id, url, setup, features, actions):
+        """Coroutine doing the work of FirefoxCrawlerProcess.grab().
+        Screenshots always go to the screenshot pool.
+        """
+        extension_inst = self.extension_inst
+        timer = self.timer
+        yield extension_inst.reset()
+        timer.mark('reset')
+        yield self._visit_setup(setup)
+        load_policy = self._load_policy(setup)
+        if load_policy['policy'] == 'idle':
+            yield extension_inst.set_load_policy(load_policy['idle_time'],
+                                                 load_policy['idle_cap'])
+        timer.mark('setup')
+        yield extension_inst.set_url(url)
+        timer.mark('navigate')
+        yield extension_inst.wait_for_load(config.PAGE_TIMEOUT,
+                                           load_policy['policy'])
+        timer.mark('load')
+        all_flag = features == "all"
+        dom = None
+        dom_fname = ''
+        img_fname = ''
+        html = None
+        if all_flag or features.has_key('dom'):
+            (dom_path, dom_fname) = yield self.disk.call(
+                                            self._feature_destination,
+                                            'html', features, 'dom',
+                                            crawlglobs.dom_dir)
+            if dom_path:
+                (dom, html) = yield extension_inst.html_file(
+                                            dom_path, dom_fname,
+                                            keep_html=bool(crawlglobs.tags_l),
+                                            store=self.blob_store,
+                                            pack=self.pack_writer)
+                # Stats the DOM file.
+                yield self.disk.call(self._count_stored, 'dom', dom, dom_path)
+                timer.mark('dom')
+        if all_flag or features.has_key('screenshot'):
+            (img_path, img_fname) = yield self.disk.call(
+                                            self._feature_destination,
+                                            'png', features, 'screenshot',
+                                            crawlglobs.img_dir)
+            if img_path:
+                raw_path = yield extension_inst.screenshot_raw()
+                if raw_path:
+                    self.pending_screenshot = [raw_path, img_path, img_fname,
+                                               None]
+            timer.mark('screenshot')
+        collected = yield extension_inst.collect_visit(actions.get('eval'))
+        timer.mark('eval')
+        tags = {}
+        if crawlglobs.tags_l and collected is not None:
+            if html is None:
+                html = yield extension_inst.html()
+            tags = yield self.disk.call(self._match_tags, html)
+            timer.mark('tags')
+        raise Return(self._grab_results(req_id, url, features, collected,
+                                        html, dom, None, dom_fname,
+                                        img_fname, tags))
+
+
+class Supervisor:
+    """Runs a number of AsyncCrawlers in an event loop in the calling
+    process. The blob store, pack writer and screenshot pool are shared by
+    all of them.
+    """
+    def __init__(self, log_q, screenshot_workers=config.SCREENSHOT_WORKERS,
+                 startup_concurrency=config.STARTUP_CONCURRENCY):
+        self.log_q = log_q
+        self.logger = mplogging.setupSubProcessLogger("Supervisor", log_q)
+        self.loop = EventLoop(self.logger)
+        self.screenshot_workers = screenshot_workers
+        self.startup_slots = None
+        if startup_concurrency:
+            self.startup_slots = Semaphore(self.loop, startup_concurrency)
+        # Phase timings of the visits of all browsers.
+        self.phase_summary = PhaseSummary()
+        self.crawlers = []
+
+    def add_crawler(self, restart, ext_port, proxy_file, proxy_scheme):
+        crawler = AsyncCrawler(self.loop, restart, ext_port, proxy_file,
+                               proxy_scheme, self.log_q)
+        self.crawlers.append(crawler)
+        return crawler
+
+    def run(self, req_q, res_q):
+        """Visits jobs off req_q with all crawlers, and returns once they
+        have all exited.
+        """
+        # Each browser needs about as much compression as in a crawler
+        #    process of its own, and it has to happen outside the loop.
+        pool = ScreenshotPool(max(1, self.screenshot_workers *
+                                     len(self.crawlers)),
+                              self.logger)
+        blob_store = None
+        if crawlglobs.blob_store_dir:
+            blob_store = BlobStore(crawlglobs.blob_store_dir, self.logger)
+        pack_writer = None
+        if crawlglobs.pack_dir:
+            pack_writer = PackWriter(crawlglobs.pack_dir,
+                                     pack_prefix('crawl'),
+                                     logger=self.logger)
+        getter = ThreadRunner(self.loop, "JobGetter")
+        putter = ThreadRunner(self.loop, "JobPutter")
+        launcher = ThreadRunner(self.loop, "BrowserLauncher")
+        disk = ThreadRunner(self.loop, "DiskWriter")
+        for crawler in self.crawlers:
+            crawler.req_q = req_q
+            crawler.res_q = res_q
+            crawler.screenshot_pool = pool
+            crawler.blob_store = blob_store
+            crawler.pack_writer = pack_writer
+            crawler.getter = getter
+            crawler.putter = putter
+            crawler.launcher = launcher
+            crawler.disk = disk
+            crawler.startup_slots = self.startup_slots
+            crawler.phase_summary = self.phase_summary
+        self.logger.info("Running %s browsers in process %s"
+                         % (len(self.crawlers), os.getpid()))
+        try:
+            self.loop.run_until_complete(self._crawl_all())
+        finally:
+            getter.close()
+            putter.close()
+            launcher.close()
+            disk.close()
+            pool.close()
+            if pack_writer:
+                pack_writer.close()
+            self.loop.close()
+        self.logger.info("All browsers: %s" % self.phase_summary.report())
+
+    def _crawl_all(self):
+        tasks = [(crawler, self.loop.spawn(crawler.crawl()))
+                 for crawler in self.crawlers]
+        for (crawler, task) in tasks:
+            try:
+                yield task
+            except Exception, e:
+                self.logger.critical("Crawler at port %s died: %s"
+                                     % (crawler.ext_port,
+                                        traceback.format_exc()))
+                yield crawler._cleanup_browsers()
@@ -0,0 +1,132 @@
+"""Content addressed storage for DOMs and screenshots that are named with
+their md5. Files live in directories sharded by the leading hex digits of
+the md5, so no directory grows beyond a few thousand entries:
+
+    <root>/ab/cd/abcd1234....html
+
+An SQLite index in <root>/index.sqlite maps every md5 to its size and the
+time it was first seen. Dedup lookups go to the index.
+
+Author: nchachra@cs.ucsd.edu
+"""
+
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+import config
+
+
+class BlobStore:
+    """A blob store rooted at root. Safe to use from several processes and
+    threads at once, each of which opens its own connection to the index.
+    """
+    def __init__(self, root, logger=None):
+        self.root = os.path.abspath(root)
+        self.logger = logger
+        self.index_path = os.path.join(self.root, 'index.sqlite')
+        # The connection can't be shared with processes forked later, or 
+        #    with other threads.
+        self._local = threading.local()
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError:
+                # Another crawler created it first.
+                pass
+
+    def db(self):
+        """Returns this thread's connection to the index, creating the
+        index if it doesn't exist.
+        """
+        local = self._local
+        if getattr(local, 'db', None) is None or local.pid != os.getpid():
+            local.db = sqlite3.connect(self.index_path,
+                                       timeout=config.SQLITE_TIMEOUT)
+            local.pid = os.getpid()
+            local.db.execute("CREATE TABLE IF NOT EXISTS blobs (" +
+                             "md5 TEXT NOT NULL, " +
+                             "ext TEXT NOT NULL, " +
+                             "size INTEGER, " +
+                             "first_seen REAL, " +
+                             "PRIMARY KEY (md5, ext))")
+            local.db.commit()
+        return local.db
+
+    def path(self, md5, ext):
+        """Returns the path for the blob with md5 and file extension ext.
+        """
+        shards = [md5[2 * i:2 * i + 2]
+                  for i in range(config.BLOB_STORE_SHARD_DEPTH)]
+        return os.path.join(self.root, *(shards + [md5 + '.' + ext]))
+
+    def tmp_dir(self):
+        """Returns a directory on the store's file system for files that are
+        still being written, so that put() can rename them into place.
+        """
+        path = os.path.join(self.root, 'tmp')
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                pass
+        return path
+
+    def contains(self, md5, ext):
+        """Returns whether the store has the blob.
+        """
+        row = self.db().execute("SELECT 1 FROM blobs WHERE md5=? AND ext=?",
+                                (md5, ext)).fetchone()
+        return row is not None
+
+    def info(self, md5, ext):
+        """Returns (size, first_seen) for the blob, or None if the store
+        doesn't have it.
+        """
+        return self.db().execute(("SELECT size, first_seen FROM blobs " +
+                                  "WHERE md5=? AND ext=?"),
+                                 (md5, ext)).fetchone()
+
+    def put(self, src_path, md5, ext):
+        """Moves the file at src_path into the store as the blob with md5 and
+        extension ext. If the store already has it, src_path is removed
+        instead. Returns whether the blob already existed.
+        """
+        if self.contains(md5, ext):
+            os.remove(src_path)
+            return True
+        dest_path = self.path(md5, ext)
+        dest_dir = os.path.dirname(dest_path)
+        if not os.path.isdir(dest_dir):
+            try:
+                os.makedirs(dest_dir)
+            except OSError:
+                pass
+        size = os.path.getsize(src_path)
+        try:
+            os.rename(src_path, dest_path)
+        except OSError:
+            # Different file system.
+            shutil.move(src_path, dest_path)
+        db = self.db()
+        db.execute(("INSERT OR IGNORE INTO blobs (md5, ext, size, " +
+                    "first_seen) VALUES (?, ?, ?, ?)"),
+                   (md5, ext, size, time.time()))
+        db.commit()
+        if self.logger:
+            self.logger.debug("Stored %s.%s in blob store" % (md5, ext))
+        return False
+
+
+# BlobStores opened through get_store(), by root.
+_stores = {}
+
+def get_store(root):
+    """Returns a BlobStore for root, reusing the one already opened by this
+    process if any. Useful in pool workers that only get the root passed.
+    """
+    if root not in _stores:
+        _stores[root] = BlobStore(root)
+    return _stores[root]
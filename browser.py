@@ -9,6 +9,78 @@ import subprocess
 
 import crawlglobs
 import extension
+import metrics
+import utils
+
+
+TEMPLATE_NAME = "template"
+
+
+def stage_profile_template(logger):
+    '''Copies firefox_template into the profile directory, which is on tmpfs
+    if possible, so that profiles are cloned from memory. Sets 
+    crawlglobs.profile_dir. Called once per run, before any crawlers are 
+    started.
+    '''
+    root = utils.default_tmp_location()
+    if (os.path.isdir(config.PROFILE_TMPFS) and 
+        os.access(config.PROFILE_TMPFS, os.W_OK)):
+            root = os.path.join(config.PROFILE_TMPFS, os.path.basename(root))
+    crawlglobs.profile_dir = os.path.join(root, config.PROFILE_DIR)
+    if os.path.exists(crawlglobs.profile_dir):
+        logger.error("Firefox profile directory already exists. Something's"+
+                     "wrong. Please file a bug.")
+    logger.info("Staging Firefox profile template in %s" 
+                % crawlglobs.profile_dir)
+    # Exclude .svn files. They are write protected, and aren't deleted by 
+    #    the removedir call.
+    shutil.copytree(os.path.join(os.getcwd(), 'firefox_template'), 
+                    os.path.join(crawlglobs.profile_dir, TEMPLATE_NAME),
+                    ignore=shutil.ignore_patterns('*.svn'))
+
+
+def profile_root():
+    '''Returns the directory that holds the Firefox profiles.
+    '''
+    if crawlglobs.profile_dir:
+        return crawlglobs.profile_dir
+    return os.path.join(crawlglobs.tmp_dir, config.PROFILE_DIR)
+
+
+def profile_template():
+    '''Returns the staged profile template, or firefox_template itself if 
+    none was staged.
+    '''
+    if crawlglobs.profile_dir:
+        return os.path.join(crawlglobs.profile_dir, TEMPLATE_NAME)
+    return os.path.join(os.getcwd(), 'firefox_template')
+
+
+def clone_profile(template, dest):
+    '''Creates the profile dest out of template. Files under the entries of
+    config.PROFILE_LINKED are hard linked, everything else is copied, since
+    Firefox writes to it in place.
+    '''
+    for (dirpath, dirnames, filenames) in os.walk(template):
+        if '.svn' in dirnames:
+            dirnames.remove('.svn')
+        rel_dir = os.path.relpath(dirpath, template)
+        dest_dir = os.path.normpath(os.path.join(dest, rel_dir))
+        if not os.path.isdir(dest_dir):
+            os.makedirs(dest_dir)
+        for fname in filenames:
+            src = os.path.join(dirpath, fname)
+            dst = os.path.join(dest_dir, fname)
+            top = os.path.normpath(os.path.join(rel_dir, fname))
+            top = top.split(os.sep)[0]
+            if top in config.PROFILE_LINKED:
+                try:
+                    os.link(src, dst)
+                    continue
+                except OSError:
+                    # Not on the same file system.
+                    pass
+            shutil.copy2(src, dst)
 
 
 class Browser:
@@ -16,6 +88,15 @@ class Browser:
     def __init__(self, name, logger):
         self.process = None
         self.logger = logger
+        self.extension = None
+        # Extension instances of the browser's tabs, if it visits with 
+        #    several tabs, and the proxy they all use.
+        self.tabs = None
+        self.proxy = None
+        # Seconds the browser waited for a startup slot, and took from 
+        #    launch until it was ready.
+        self.slot_wait = 0
+        self.ready_time = None
         if name == 'Firefox':
             self.__class__ = Firefox
 
@@ -35,65 +116,62 @@ class Firefox(Browser):
         and returns False, otherwise returns the associated extension 
         instance.
         '''
-        profile_path = os.path.join(crawlglobs.tmp_dir, config.PROFILE_DIR, 
-                                    "ff_" + str(extension_port))
-        self.profile(profile_path, extension_port)
-        if not os.path.isdir(self.profile_dir):
-            raise Exception('No profile')
-        self.process = subprocess.Popen(['firefox', '-no-remote', '-profile',
-                                        self.profile_dir])
-        self.logger.debug("Starting extention.")
-        ext = extension.Extension(self.logger, port=extension_port)
-        if not ext.reset():
+        # Only so many browsers start at once, see startup.py.
+        slots = crawlglobs.startup_slots
+        if slots:
+            self.slot_wait = slots.acquire()
+        try:
+            self.launch(extension_port)
+            self.logger.debug("Starting extention.")
+            ext = extension.Extension(self.logger, port=extension_port)
+            self.extension = ext
+            self.ready_time = ext.wait_ready(self.process)
+        finally:
+            if slots:
+                slots.release()
+        metrics.count_browser_start(self.ready_time, self.slot_wait)
+        if self.ready_time is None:
             self.logger.error(("Extension could not be restarted for " +
                                "Firefox instance at port %s. \n Cleaning up " +
                                "that instance.") % extension_port)
             self.cleanup()
             return False
+        self.logger.info(("Firefox at port %s ready in %.2f s, after " +
+                          "waiting %.2f s to start") 
+                         % (extension_port, self.ready_time, self.slot_wait))
         return ext
 
-    def profile(self, dir_name, extension_port):
-        '''Create a firefox profile with dir_name if there isn't one already.
-        It uses the extension port to change the server port in extension.
+    def launch(self, extension_port):
+        '''Starts the Firefox process for extension_port without waiting
+        for the extension to come up.
+        '''
+        profile_path = os.path.join(profile_root(), 
+                                    "ff_" + str(extension_port))
+        self.profile(profile_path)
+        if not os.path.isdir(self.profile_dir):
+            raise Exception('No profile')
+        # The extension reads its port from the environment.
+        env = dict(os.environ)
+        env[config.EXT_PORT_ENV] = str(extension_port)
+        self.process = subprocess.Popen(['firefox', '-no-remote', '-profile',
+                                        self.profile_dir], env=env)
+
+    def profile(self, dir_name):
+        '''Creates a firefox profile with dir_name out of the profile 
+        template, if there isn't one already.
         '''
-        self.logger.debug("Creating FF profile if there isn't one already.")
-        if not hasattr(Firefox, 'profile_dir'):
-            self.profile_dir = None
-        if self.profile_dir is None: 
-            if not os.path.isdir(dir_name):
-                # Since there are read-only .svn files, use -f
-                self.logger.info("Creating Firefox profile.")
-                # Exclude .svn files when creating profile. The .svn files
-                #     are write protected, and aren't deleted by the removedir
-                #     call.
-                shutil.copytree(os.getcwd() + '/firefox_template',
-                                dir_name, 
-                                ignore=shutil.ignore_patterns('*.svn'))
-                self.profile_dir = dir_name
-                self.logger.debug("Created profile at %s" % dir_name)
-                # TODO: Replace the server port with extension_port.Ideally, this
-                # should be a custom pref or some such.
-                fp = open((self.profile_dir + 
-                           '/extensions/trajlogger@cs.ucsd.edu/chrome/' +
-                           'content/commandsocket.js'), 'r')
-                orig_contents = fp.read()
-                fp.close()
-                new_contents = orig_contents.replace("7055", 
-                                                     str(extension_port))
-                fp = open((self.profile_dir + 
-                           '/extensions/trajlogger@cs.ucsd.edu/chrome/' +
-                           'content/commandsocket.js'), 'w')
-                fp.write(new_contents)
-                fp.close()
-                # File's not very big. Read all contents into memory.
-            else:
-                self.profile_dir = dir_name
-        else:
+        self.profile_dir = dir_name
+        if os.path.isdir(dir_name):
             self.logger.debug("Profile already exists.")
+            return
+        self.logger.debug("Creating Firefox profile at %s" % dir_name)
+        clone_profile(profile_template(), dir_name)
         
     def cleanup(self):
         '''Kills Firefox, and removes its template directory.'''
         self.logger.info("Stopping browser")
+        if self.extension:
+            self.extension.close()
         self.stop()
         self.logger.info("Removing Firefox profile")
         if self.profile_dir and os.path.isdir(self.profile_dir):
@@ -4,21 +4,131 @@ RESULT_Q_SIZE = REQUEST_Q_SIZE * 3
 
 # Files and directories
 LOG_FILENAME = 'stallone.log'
+# Job ledger for resuming crawls, kept in the log directory by default.
+LEDGER_FILENAME = 'ledger.sqlite'
 LOG_FORMAT = "%(levelname)s|%(asctime)s|%(name)s|%(process)s %(msg)s"
 MAIN_LOGGER_NAME = "Stallone"
 LOG_DIR = "logs"
 # Directory for firefox profiles
 PROFILE_DIR = "firefox_profiles"
+# The profile template is staged once per run in PROFILE_DIR under this 
+#    directory if it is writable, which is usually a tmpfs, and under the 
+#    tmp directory otherwise. Profiles are cloned from the staged template.
+PROFILE_TMPFS = "/dev/shm"
+# Entries of the profile template that Firefox never writes to. Profiles 
+#    hard link their files instead of copying them.
+PROFILE_LINKED = ["extensions"]
+# Environment variable that tells the extension the port to listen on.
+EXT_PORT_ENV = "STALLONE_EXT_PORT"
 
 # Constants
 PAGE_TIMEOUT=180
+# Page load completion policy. 'onload' waits for the load event. 'idle'
+#    waits for the load event followed by IDLE_TIME seconds without any
+#    request in flight, but at most IDLE_CAP seconds after DOMContentLoaded.
+LOAD_POLICY='onload'
+IDLE_TIME=0.5
+IDLE_CAP=15
+# Processes per crawler that compress and store screenshots in the 
+#    background. 0 does it in the crawler process itself.
+SCREENSHOT_WORKERS=1
 # Alarm is fired if a visit doesn't complete in ALARM_TIME
 ALARM_TIME=15*60
 # Restart firefox every so many visits
 MAX_BROWSER_VISITS_PER_RESTART=50
+# When to restart the browser. 'visits' restarts it every 
+#    MAX_BROWSER_VISITS_PER_RESTART visits, 'always' for every visit. 'reset'
+#    wipes the browser's state between visits instead, and only restarts it
+#    if it crashed, the state couldn't be wiped, or after 
+#    RESET_MAX_VISITS_PER_RESTART visits, to keep its memory in check. 
+#    'memory' only restarts it if it crashed. All but 'always' also restart 
+#    a browser that exceeds the memory limits below.
+RESTART_POLICY='visits'
+RESET_MAX_VISITS_PER_RESTART=500
+# A browser is recycled once the RSS of its process tree exceeds 
+#    BROWSER_MAX_RSS bytes, or it grew by more than BROWSER_MAX_GROWTH bytes
+#    per visit on average over the last BROWSER_GROWTH_VISITS visits. 0 
+#    turns a limit off. See procmonitor.py.
+BROWSER_MAX_RSS=1024 * 1024 * 1024
+BROWSER_MAX_GROWTH=25 * 1024 * 1024
+BROWSER_GROWTH_VISITS=10
+# Browsers that may be starting up at once, across all crawlers. 0 for no
+#    limit. See startup.py.
+STARTUP_CONCURRENCY=4
+# A starting browser's extension is probed for readiness after 
+#    READY_PROBE_INTERVAL seconds, and then at intervals growing by 
+#    READY_PROBE_BACKOFF up to READY_PROBE_MAX_INTERVAL seconds.
+READY_PROBE_INTERVAL=0.1
+READY_PROBE_BACKOFF=1.5
+READY_PROBE_MAX_INTERVAL=2
+# Crawlers log the mean and maximum time of each phase of their visits 
+#    every so many visits, and when they exit. See phasetimer.py.
+TIMING_SUMMARY_VISITS=100
+# The metrics endpoint (see metrics.py) listens on this address only. Its
+#    latency histograms have these buckets, in seconds, and the visit rate
+#    is averaged over the last METRICS_RATE_WINDOW seconds.
+METRICS_HOST='127.0.0.1'
+METRICS_BUCKETS=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 180)
+METRICS_RATE_WINDOW=60
+# Timeout for a single command over the extension's command socket
+EXT_SOCKET_TIMEOUT=180
+# Bytes read from the extension's command socket per recv()
+EXT_RECV_SIZE=65536
+# Extra seconds the socket waits for a pushed event after the extension's
+#    own timeout for it has run out.
+EXT_EVENT_GRACE=10
+
+# Directory levels of two hex digits each that blob store files are 
+#    sharded into.
+BLOB_STORE_SHARD_DEPTH=2
+# Pack files are rolled over once they grow beyond this many bytes.
+PACK_MAX_SIZE=1024 * 1024 * 1024
+# Seconds to wait for a lock on an SQLite database held by another process
+SQLITE_TIMEOUT=60
+# JSONL result shards are rotated once they hold this many bytes of JSON, or
+#    are this many seconds old.
+RESULT_SHARD_SIZE=256 * 1024 * 1024
+RESULT_SHARD_AGE=60 * 60
+# JSONL results are written in batches of this many visits, or once the
+#    oldest unwritten visit is this many seconds old.
+RESULT_BATCH_SIZE=50
+RESULT_FLUSH_INTERVAL=30
+# Bytes read from an input file at a time while parsing it.
+INPUT_CHUNK_SIZE=65536
+# Jobs parsed ahead from the input files and held in memory.
+INPUT_PREFETCH=1000
+# Jobs inserted per transaction when importing input files into a queue
+#    database.
+JOB_IMPORT_BATCH=10000
+
+# Politeness scheduling, see scheduler.py. Jobs of one host that may be
+#    visited at once, seconds between starting visits to a host, jobs
+#    looked ahead at to find other hosts, and of those, jobs of one host.
+HOST_MAX_JOBS=1
+HOST_MIN_DELAY=2
+HOST_WINDOW=5000
+HOST_WINDOW_PER_HOST=50
+# Failed visits are retried after RETRY_BACKOFF seconds, doubling with 
+#    every further attempt up to RETRY_MAX_BACKOFF seconds.
+RETRY_BACKOFF=60
+RETRY_MAX_BACKOFF=60 * 60
+# Seconds a job handed to a distributed worker stays leased to it without
+#    the worker renewing its leases.
+DIST_LEASE_TIME=120
+# Seconds a worker's request for a job waits at the coordinator.
+DIST_POLL_TIME=5
+# Environment variable with the authentication key between coordinator and
+#    workers, if --authkey and --authkey-file aren't given. There is no 
+#    default key.
+DIST_AUTHKEY_ENV='STALLONE_AUTHKEY'
 
 #Status codes
 PAGE_TIMEOUT_ST = 'tim'
+# The page failed with a Firefox network error whose code starts with
+#    PROXY_ERROR_PREFIX, like proxyConnectFailure or proxyResolveFailure.
 PROXY_ERR_ST = 'prx'
+PROXY_ERROR_PREFIX = 'proxy'
 FIREFOX_ERR_ST='err'
+# grab() raised an exception.
+VISIT_EXCEPTION_ST='exc'
 
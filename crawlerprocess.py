@@ -1,7 +1,10 @@
+import copy
 import multiprocessing as mp
 import os
 import Queue
 import signal
+import threading
+import time
 import traceback
 
 try:
@@ -9,11 +12,17 @@ try:
 except ImportError:
     import re
 
+from blobstore import BlobStore
 from browser import Browser
 import config
 import crawlglobs
+import metrics
 import mplogging
+from packfile import pack_prefix, PackWriter
+from phasetimer import PhaseSummary, VisitTimer
+from procmonitor import ResourceMonitor
 from proxy import Proxy
+from screenshotpool import pack_screenshot, ScreenshotPool
 """Processes that do the actual instrumentation and visits through browser.
 Any new browser addition, or new method of crawling will need to subclass
 CrawlerProcess and implement the empty functions.
@@ -27,7 +36,16 @@ class CrawlerProcess:
     other functions need to be overridden. 
     '''
     def __init__(self, restart, browser, ext_port, proxy_file, proxy_scheme, 
-                 log_q):
+                 log_q, screenshot_workers=config.SCREENSHOT_WORKERS,
+                 standby_port=None, tabs=1):
+        """restart is the restart policy, see config.RESTART_POLICY. True
+        stands for 'always' and False for 'visits'. With tabs > 1, that many
+        visits are made at once in tabs of the browser, see _run_tabs().
+        """
+        if restart is True:
+            restart = 'always'
+        elif not restart:
+            restart = 'visits'
         self.restart = restart
         self.browser_name = browser
         self.browser_inst = None
@@ -38,14 +56,72 @@ class CrawlerProcess:
         self.logger = mplogging.setupSubProcessLogger("Crawler", log_q)
         self.proxy = Proxy(proxy_file, proxy_scheme, self.logger)
         # To make sure the process doesn't take more than 15 min to complete
-        #     a single visit. Kill the process if it does.
+        #     a single visit. Kill the process if it does. Tabs watch the
+        #     time of their visits instead, see _check_tab_deadlines().
         signal.signal(signal.SIGALRM, self.alarm_handler)
         # We would like to restart browser every so many visits.
         self.num_visits = 0
+        # Screenshots are compressed by a pool of this many processes, 
+        #    started in run(). 0 compresses them in this process.
+        self.screenshot_workers = screenshot_workers
+        self.screenshot_pool = None
+        # [raw_path, dest_dir, fname, page] for a screenshot of the current
+        #    visit that still needs to be stored. page is the visit chain 
+        #    entry that gets the final file name.
+        self.pending_screenshot = None
+        # BlobStore for md5 named DOMs and screenshots, if one is used.
+        self.blob_store = None
+        # PackWriter for DOMs and screenshots in pack mode.
+        self.pack_writer = None
+        # {'status': status, 'proxy': proxy, 'time': start time} for the 
+        #    current visit, reported with its results. See retryqueue.
+        self.attempt = None
+        # Earlier attempts at the current job, and the proxy it should 
+        #    avoid, if it's a retry.
+        self.attempts = []
+        self.avoid_proxy = None
+        # If set, a spare browser is kept warming up at this port, and is
+        #    swapped in when the browser is due for a restart. The ports of
+        #    the two browsers trade places on every swap.
+        self.standby_port = standby_port
+        # (thread, [browser, extension]) for the spare browser. The list 
+        #    is filled in by the thread once the browser is up.
+        self.standby = None
+        # ResourceMonitor of the browser in use.
+        self.monitor = None
+        self.tabs = tabs
+        # The crawler that owns the browser. Tabs visit with copies of it.
+        self.owner = self
+        # Guards the browser's visit count and monitor, which all tabs 
+        #    update.
+        self.visit_lock = None
+        # Set to make tabs stop taking jobs, see _run_tab().
+        self.stop_tabs = None
+        # {tab: start time} of the visits going on in the tabs.
+        self.tab_visits = {}
+        self.cleanup_seen = False
+        # VisitTimer of the current visit, and the PhaseSummary of all 
+        #    visits of the crawler, which its tabs share.
+        self.timer = None
+        self.phase_summary = PhaseSummary()
 
 
     def start_browser(self):
         pass
+
+    def clear_browser_state(self):
+        """Wipes the state earlier visits left in the browser. Returns 
+        True if the browser can be used for the next visit without a 
+        restart.
+        """
+        return False
+
+    def launch_browser(self, port):
+        """Starts a browser at port and returns (browser, extension), where
+        extension is False if the browser failed to start. Used for the 
+        standby browser, so it must not touch the crawler's state.
+        """
+        pass
     
     def grab(self, url, setup, features):
         pass
@@ -54,11 +130,143 @@ class CrawlerProcess:
         """Called when the alarm goes off. There's only 1 alarm per process.
         """
         self.logger.critical(("Alarm went off for process: %s \n. The process"+
-                             " took longer than 15 min for a single visit." +
-                             "This subprocess is exiting.") % 
-                             mp.current_process.name())
+                             " took longer than %s seconds for a single " +
+                             "visit. This subprocess is exiting.") % 
+                             (mp.current_process().name, config.ALARM_TIME))
         self.req_q.task_done()
-        mp.current_process.terminate()
+        if self.browser_inst:
+            self.browser_inst.stop()
+        # A process can't terminate() itself.
+        os._exit(1)
+
+    def _restart_due(self):
+        """Returns whether the browser has to be restarted before the next
+        visit, according to the restart policy. With the 'reset' policy, 
+        this wipes the browser's state if it doesn't.
+        """
+        if self.browser_inst.process.poll() is not None:
+            return True
+        if self.restart == 'always':
+            return True
+        if self.monitor and self.monitor.pid == self.browser_inst.process.pid:
+            reason = self.monitor.over_limit()
+            if reason:
+                self.logger.warning("Recycling browser at port %s: %s"
+                                    % (self.ext_port, reason))
+                return True
+        if self.restart == 'memory':
+            return False
+        if self.restart == 'reset':
+            if self.num_visits > config.RESET_MAX_VISITS_PER_RESTART:
+                return True
+            if self.num_visits and not self.clear_browser_state():
+                self.logger.warning("Restarting browser, since its state " +
+                                    "couldn't be cleared.")
+                return True
+            return False
+        return self.num_visits > config.MAX_BROWSER_VISITS_PER_RESTART
+
+    def _after_visit(self):
+        """Counts a visit made with the browser, and samples its resource
+        usage. Called by every tab.
+        """
+        self.visit_lock.acquire()
+        try:
+            self._sample_browser()
+            self.num_visits += 1
+        finally:
+            self.visit_lock.release()
+
+    def _sample_browser(self):
+        """Samples the resource usage of the browser after a visit. The 
+        sample is logged and set as the browser's gauges in the crawl's 
+        metrics.
+        """
+        if not self.browser_inst or not self.browser_inst.process:
+            return
+        pid = self.browser_inst.process.pid
+        if self.monitor is None or self.monitor.pid != pid:
+            limits = crawlglobs.browser_limits or {}
+            self.monitor = ResourceMonitor(
+                        pid, limits.get('max_rss', config.BROWSER_MAX_RSS),
+                        limits.get('max_growth', config.BROWSER_MAX_GROWTH))
+        sample = self.monitor.sample()
+        if sample is None:
+            return
+        self.logger.info(("Browser at port %s: RSS %d MB, CPU %s%%, %d " +
+                          "processes, %d visits") 
+                         % (self.ext_port, sample['rss'] / 2**20, 
+                            sample['cpu_pct'], sample['procs'], 
+                            self.num_visits + 1))
+        metrics.count_browser_sample(self.ext_port, sample)
+
+    def _warm_standby(self, retired=None):
+        """Starts the standby browser in a background thread. retired is
+        the browser last used at the standby port, which the thread cleans 
+        up first.
+        """
+        port = self.standby_port
+        standby = []
+        def warm():
+            if retired:
+                retired.cleanup()
+            try:
+                standby.extend(self.launch_browser(port))
+            except Exception, e:
+                self.logger.error("Error starting standby browser: %s" 
+                                  % traceback.format_exc())
+        thread = threading.Thread(target=warm, name="StandbyBrowser")
+        thread.daemon = True
+        thread.start()
+        self.standby = (thread, standby)
+
+    def _retire_browser(self):
+        """Replaces the browser with the standby browser, if there is one.
+        Otherwise just stops it, and browser_inst is left None.
+        """
+        retired = self.browser_inst
+        self.browser_inst = None
+        self.num_visits = 0
+        metrics.count_browser_restart()
+        if self.standby:
+            self._take_standby(retired)
+        else:
+            retired.cleanup()
+
+    def _take_standby(self, retired):
+        """Swaps the standby browser in for retired, which is cleaned up 
+        in the background while the next standby warms up. Waits for the 
+        standby if it is still starting. If it failed, retired is cleaned up
+        and browser_inst is left None.
+        """
+        (thread, standby) = self.standby
+        self.standby = None
+        thread.join()
+        if (standby and standby[1] and 
+            standby[0].process.poll() is None):
+                (self.browser_inst, self.extension_inst) = standby
+                (self.ext_port, self.standby_port) = (self.standby_port, 
+                                                      self.ext_port)
+                self._warm_standby(retired)
+                return
+        self.logger.error("Standby browser at port %s isn't running."
+                          % self.standby_port)
+        if standby:
+            standby[0].cleanup()
+        retired.cleanup()
+
+    def _cleanup_browsers(self):
+        """Stops the browser and the standby browser.
+        """
+        if self.browser_inst:
+            self.browser_inst.cleanup()
+            self.browser_inst = None
+        if self.standby:
+            (thread, standby) = self.standby
+            self.standby = None
+            thread.join()
+            if standby:
+                standby[0].cleanup()
 
     def run(self, req_q, res_q):
         """If the request_q has jobs, extract one, and process it. Process
@@ -67,7 +275,32 @@ class CrawlerProcess:
         """
         self.req_q = req_q
         self.res_q = res_q
-        signal.alarm(config.ALARM_TIME)
+        if self.screenshot_workers:
+            self.screenshot_pool = ScreenshotPool(self.screenshot_workers, 
+                                                  self.logger)
+        if crawlglobs.blob_store_dir:
+            self.blob_store = BlobStore(crawlglobs.blob_store_dir, 
+                                        self.logger)
+        if crawlglobs.pack_dir:
+            self.pack_writer = PackWriter(crawlglobs.pack_dir, 
+                                          pack_prefix('crawl'),
+                                          logger=self.logger)
+        self.visit_lock = threading.Lock()
+        if self.tabs > 1:
+            self._run_tabs()
+        else:
+            self._run_browser()
+        if self.screenshot_pool:
+            self.screenshot_pool.close()
+        if self.pack_writer:
+            self.pack_writer.close()
+        self.logger.info("Crawler at port %s: %s" 
+                         % (self.ext_port, self.phase_summary.report()))
+
+    def _run_browser(self):
+        """Visits one job after another with the browser.
+        """
+        req_q = self.req_q
         while True:
             # One visit takes place per loop. None of the visits should ever
             #     take more than 15 minutes. Something has to have gone wrong
@@ -75,64 +308,255 @@ class CrawlerProcess:
             #     some error on res_q and raise exception (which kills this
             #     process)
             try:
+                self.timer = VisitTimer()
                 task = req_q.get()
+                self.timer.mark('queue_wait')
                 print "task: ", task
                 if task == 'CLEANUP':
                     self.logger.info("Crawler preparing to exit.Found cleanup")
                     req_q.put(task)
                     req_q.task_done()
-                    if self.browser_inst:
-                        self.browser_inst.cleanup()
+                    self._cleanup_browsers()
                     break
-                (job_id, job) = task
-                url = job['url']
-                if job.has_key('setup'):
-                    setup = job['setup']
-                else:
-                    setup = None
-                if job.has_key('features'):
-                    features = job['features']
-                else:
-                    self.logger.error(("No feature requested for id: %s") 
-                                      % job_id)
-                if job.has_key('actions'):
-                    actions = job['actions']
-                else:
-                    actions = {}
+                visit = self._parse_task(task)
             except Queue.Empty:
                 self.logger.debug("Request q is empty. Joining.")
-                if self.browser_inst:
-                    self.browser_inst.cleanup()
+                self._cleanup_browsers()
                 break
-            self.logger.info("Visiting %s for features %s " % (url, features))
-            print "Got item: ", url, " ", features
-            if (self.browser_inst and 
-                    (self.browser_inst.process.poll() is not None or 
-                     self.restart or
-                     self.num_visits > config.MAX_BROWSER_VISITS_PER_RESTART)
-                ):
-                    self.browser_inst.cleanup()
-                    self.browser_inst = None
-                    self.num_visits = 0
+            print "Got item: ", visit[1], " ", visit[3]
+            signal.alarm(config.ALARM_TIME)
+            if self.browser_inst and self._restart_due():
+                self._retire_browser()
             if self.browser_inst is None and hasattr(self, "start_browser"):
+                if self.standby_port and self.standby is None:
+                    # Warms up alongside the browser started below.
+                    self._warm_standby()
                 if not self.start_browser():
+                    signal.alarm(0)
                     req_q.task_done()
                     req_q.put(task)
+                    self._cleanup_browsers()
                     break
-            result_list = None
-            try:
-                result_list = self.grab(job_id, url, setup, features, actions)
-            except Exception, e:
-                self.logger.error(("Error in grabbing URL %s. " +
-                                   "Exception: %s") 
-                                  % (url, traceback.print_exc()))
-            if result_list: 
-                res_q.put(result_list)
-            req_q.task_done()
-            self.num_visits += 1
+            self.timer.mark('browser_start')
+            self._visit(*visit)
             # Clear alarm
             signal.alarm(0)
 
+    def _parse_task(self, task):
+        """Returns the (job id, url, setup, features, actions) of a task 
+        off the request queue. Remembers the job's earlier attempts.
+        """
+        (job_id, job) = task
+        url = job['url']
+        if job.has_key('setup'):
+            setup = job['setup']
+        else:
+            setup = None
+        if job.has_key('features'):
+            features = job['features']
+        else:
+            features = None
+            self.logger.error(("No feature requested for id: %s") 
+                              % job_id)
+        if job.has_key('actions'):
+            actions = job['actions']
+        else:
+            actions = {}
+        self.attempts = job.get('attempts', [])
+        self.avoid_proxy = job.get('avoid_proxy')
+        return (job_id, url, setup, features, actions)
+
+    def _visit(self, job_id, url, setup, features, actions):
+        """Visits url with the browser, or the tab, and puts the results on
+        the result queue.
+        """
+        self.logger.info("Visiting %s for features %s " % (url, features))
+        result_list = None
+        self.pending_screenshot = None
+        self.attempt = {'status': None, 'proxy': None, 
+                        'time': time.time()}
+        try:
+            result_list = self.grab(job_id, url, setup, features, actions)
+        except Exception, e:
+            self.logger.error(("Error in grabbing URL %s. " +
+                               "Exception: %s") 
+                              % (url, traceback.print_exc()))
+            self.attempt['status'] = config.VISIT_EXCEPTION_ST
+            self.timer.mark('error')
+        self.owner._after_visit()
+        self.timer.mark('monitor')
+        self._report(job_id, result_list)
+
+    def _report(self, job_id, result_list):
+        """Puts the results of the visit on the result queue, once its 
+        screenshot is stored if there is one pending. The phase timings of
+        the visit are reported with its attempt, added to the crawler's
+        summary and counted in the crawl's metrics.
+        """
+        self.attempt['timings'] = dict(self.timer.timings)
+        if self.pending_screenshot:
+            self._store_screenshot_async(job_id, result_list)
+        else:
+            self._put_results(job_id, result_list, self.attempt)
+        self.timer.mark('enqueue')
+        self._add_timings(self.timer.timings)
+        metrics.count_visit(self.attempt, self.timer.timings)
+
+    def _put_results(self, job_id, result_list, attempt):
+        """Puts the results of a visit on the result queue and marks its 
+        request done.
+        """
+        # Put even without results, so the job is known finished.
+        self.res_q.put((job_id, result_list, attempt))
+        self.req_q.task_done()
+
+    def _count_stored(self, kind, result, dest_dir):
+        """Counts the bytes of a DOM or screenshot saved in dest_dir, or the
+        blob store, in the crawl's metrics.
+        """
+        store_root = None
+        if self.blob_store:
+            store_root = self.blob_store.root
+        metrics.count_stored(kind, result, dest_dir, store_root)
+
+    def _add_timings(self, timings, visit=True):
+        """Adds timings to the crawler's PhaseSummary, which is logged every
+        config.TIMING_SUMMARY_VISITS visits.
+        """
+        visits = self.owner.phase_summary.add(timings, visit)
+        if visit and visits % config.TIMING_SUMMARY_VISITS == 0:
+            self.logger.info("Crawler at port %s: %s" 
+                             % (self.ext_port, 
+                                self.owner.phase_summary.report()))
+
+    def _run_tabs(self):
+        """Visits self.tabs jobs at once in the tabs of one browser, with a
+        thread per tab. The browser is restarted once the restart policy 
+        says so and every tab finished its visit. The alarm can't tell the
+        tabs apart, so this thread watches the time of their visits instead.
+        """
+        while True:
+            if self.browser_inst is None:
+                if self.standby_port and self.standby is None:
+                    self._warm_standby()
+                if not self.start_browser():
+                    self._cleanup_browsers()
+                    break
+            self.stop_tabs = threading.Event()
+            threads = []
+            for extension_inst in self.browser_inst.tabs:
+                thread = threading.Thread(target=self._run_tab, 
+                                          args=(extension_inst,),
+                                          name="Tab%s" % extension_inst.tab)
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(1)
+                    self._check_tab_deadlines()
+            if self.cleanup_seen:
+                self._cleanup_browsers()
+                break
+            self._retire_browser()
+
+    def _run_tab(self, extension_inst):
+        """Visits jobs off the request queue in the tab of extension_inst,
+        until the browser is due for a restart or "CLEANUP" comes up.
+        """
+        tab = copy.copy(self)
+        tab.extension_inst = extension_inst
+        while not self.stop_tabs.is_set():
+            tab.timer = VisitTimer()
+            task = self.req_q.get()
+            tab.timer.mark('queue_wait')
+            if task == 'CLEANUP':
+                self.logger.info("Tab %s preparing to exit. Found cleanup" 
+                                 % extension_inst.tab)
+                self.req_q.put(task)
+                self.req_q.task_done()
+                self.cleanup_seen = True
+                self.stop_tabs.set()
+                break
+            self.visit_lock.acquire()
+            self.tab_visits[extension_inst.tab] = time.time()
+            self.visit_lock.release()
+            tab._visit(*tab._parse_task(task))
+            self.visit_lock.acquire()
+            try:
+                self.tab_visits.pop(extension_inst.tab, None)
+                if not self.stop_tabs.is_set() and self._restart_due():
+                    self.stop_tabs.set()
+            finally:
+                self.visit_lock.release()
+
+    def _check_tab_deadlines(self):
+        """Stops the browser if the visit of a tab has taken longer than
+        config.ALARM_TIME. The visits going on in its tabs fail, and the 
+        tabs stop taking jobs so that the browser is restarted.
+        """
+        now = time.time()
+        self.visit_lock.acquire()
+        try:
+            overdue = [tab for (tab, start) in self.tab_visits.iteritems()
+                       if now - start > config.ALARM_TIME]
+            for tab in overdue:
+                # Only stop the browser once for the visit.
+                del self.tab_visits[tab]
+        finally:
+            self.visit_lock.release()
+        if not overdue:
+            return
+        self.logger.critical(("Visit in tab %s of the browser at port %s " +
+                              "took longer than %s seconds. Stopping the " +
+                              "browser.")
+                             % (', '.join([str(tab) for tab in overdue]),
+                                self.ext_port, config.ALARM_TIME))
+        self.stop_tabs.set()
+        self.browser_inst.stop()
+
+    def _store_screenshot_async(self, job_id, result_list):
+        """Hands the pending screenshot of the visit to the screenshot pool.
+        The visit's results are put on the result queue, and the request is
+        marked done, only once the screenshot is stored, so that the visit
+        chain has the final file name.
+        """
+        (raw_path, dest_dir, fname, page) = self.pending_screenshot
+        self.pending_screenshot = None
+        store_root = None
+        if self.blob_store:
+            store_root = self.blob_store.root
+        req_q = self.req_q
+        res_q = self.res_q
+        pack = self.pack_writer
+        logger = self.logger
+        attempt = self.attempt
+        submitted = time.time()
+        def stored(screenshot):
+            if pack:
+                try:
+                    screenshot = pack_screenshot(pack, screenshot, dest_dir,
+                                                 fname)
+                except Exception, e:
+                    logger.error("Error packing screenshot: %s" 
+                                 % traceback.format_exc())
+                    screenshot = None
+            if page is not None:
+                page['screenshot'] = screenshot
+            metrics.count_stored('screenshot', screenshot, dest_dir, 
+                                 store_root)
+            timings = {'screenshot_store': round(time.time() - submitted, 3)}
+            attempt['timings'].update(timings)
+            if page is not None and page.has_key('timings'):
+                page['timings'].update(timings)
+            res_q.put((job_id, result_list, attempt))
+            req_q.task_done()
+            self._add_timings(timings, visit=False)
+            metrics.count_phases(timings)
+        self.screenshot_pool.submit(raw_path, dest_dir, fname, stored, 
+                                    store_root, 
+                                    compress_only=bool(pack))
+
 
 class FirefoxCrawlerProcess(CrawlerProcess):
     """Class controlling Firefox based processes. Firefox needs extension
@@ -142,9 +566,27 @@ class FirefoxCrawlerProcess(CrawlerProcess):
         Presumably every browser needs hooks before starting. Firefox needs
         a profile and extension, set-up by this function.
         """
-        self.browser_inst = Browser(self.browser_name, self.logger)
-        self.extension_inst = self.browser_inst.start(self.ext_port)
+        (self.browser_inst, self.extension_inst) = self.launch_browser(
+                                                                self.ext_port)
         return self.extension_inst
+
+    def clear_browser_state(self):
+        return self.extension_inst.clear_state()
+
+    def launch_browser(self, port):
+        browser_inst = Browser(self.browser_name, self.logger)
+        extension_inst = browser_inst.start(port)
+        if extension_inst and self.tabs > 1:
+            browser_inst.tabs = extension_inst.open_tabs(self.tabs)
+            if not browser_inst.tabs:
+                browser_inst.cleanup()
+                return (browser_inst, False)
+            browser_inst.proxy = self.proxy.next_proxy()
+            if browser_inst.proxy:
+                extension_inst.set_proxy(browser_inst.proxy[0], 
+                                         browser_inst.proxy[1],
+                                         browser_inst.proxy[2])
+        return (browser_inst, extension_inst)
     
     def _visit_setup(self, setup):
         """Based on the properties in setup, readies the browser and 
@@ -156,14 +598,44 @@ class FirefoxCrawlerProcess(CrawlerProcess):
         if setup and setup.has_key('headers'):
             for (header, value) in setup['headers'].iteritems():
                 self.extension_inst.set_header(header, value)
+        proxy = self._pick_proxy(setup)
+        if proxy:
+            self.extension_inst.set_proxy(proxy[0], proxy[1], proxy[2])
+
+    def _pick_proxy(self, setup):
+        """Returns the proxy the browser has to be set to for the visit, or
+        None if it needs none. Records the proxy used in the attempt.
+        """
         if setup and setup.has_key('proxy'):
-            self.extension_inst.set_proxy(setup['proxy'][0], 
-                                          setup['proxy'][1],
-                                          setup['proxy'][2])
-        else:
-            proxy = self.proxy.next_proxy()
-            if proxy:
-                self.extension_inst.set_proxy(proxy[0], proxy[1], proxy[2])
+            self.attempt['proxy'] = setup['proxy']
+            return setup['proxy']
+        if self.tabs > 1:
+            # Proxies apply to all tabs, so the browser got one when it 
+            #    started.
+            self.attempt['proxy'] = self.browser_inst.proxy
+            return None
+        proxy = self.proxy.next_proxy()
+        if (proxy and self.avoid_proxy and 
+            list(proxy) == list(self.avoid_proxy)):
+                # A retry of a visit that failed with this proxy.
+                proxy = self.proxy.next_proxy()
+        if proxy:
+            self.attempt['proxy'] = proxy
+        return proxy
+            
+    def _load_policy(self, setup):
+        """Returns the load policy for a visit as a dictionary with keys
+        'policy', 'idle_time' and 'idle_cap'. Values in the visit's setup
+        override the crawler defaults.
+        """
+        policy = {'policy': config.LOAD_POLICY, 
+                  'idle_time': config.IDLE_TIME,
+                  'idle_cap': config.IDLE_CAP}
+        if crawlglobs.load_policy:
+            policy.update(crawlglobs.load_policy)
+        if setup and setup.has_key('load_policy'):
+            policy.update(setup['load_policy'])
+        return policy
             
     def _feature_destination(self, file_ext, features, feature, glob_dir):
         """Returns a tuple of (directory, fname) where a feature will be 
@@ -200,7 +672,8 @@ class FirefoxCrawlerProcess(CrawlerProcess):
             fname = os.path.basename(path)
             path = os.path.dirname(path) + '/'
         try:
-            if path and not os.path.exists(path):
+            # In pack mode the path only names the record. 
+            if path and not crawlglobs.pack_dir and not os.path.exists(path):
                     os.makedirs(path)
         except OSError, e:
             self.logger.error(("Excepting while creating directory for \n" +
@@ -211,6 +684,39 @@ class FirefoxCrawlerProcess(CrawlerProcess):
                           % (path, fname, feature))
         return (path, fname)  
 
+    def _visit_chain(self, url, collected):
+        """Builds the list of pages in the visit out of the result of 
+        Extension.collect_visit(). Each page is a dictionary with its url
+        and, where known, status code, headers and server address.
+        """
+        visit = []
+        headers = collected['headers']
+        redirects = collected['redirects']
+        response_codes = collected['response_codes']
+        if not response_codes:
+            response_codes = {url: 'UNK'} 
+        for page in redirects:
+            if page == 'about:blank': 
+                continue
+            webpage = {'url': page}
+            if page in response_codes:
+                webpage['status_code'] = response_codes[page]
+            elif page + '/' in response_codes:
+                webpage['status_code'] = response_codes[page + '/']
+            if headers is not None and headers.get(page) is not None:
+                webpage['headers'] = headers[page]
+            if headers is not None and headers.get(page + '/') is not None:
+                webpage['headers'] = headers[page + '/']
+            # Our tinyproxy is configured to return the server addr
+            #    in a special header. This shouldn't hurt anyone not
+            #    using the modified tinyproxy
+            if (webpage.has_key('headers') and 
+                webpage['headers'].has_key('X-Server-Address')):
+                    webpage['server_addr'] = (
+                        webpage['headers']['X-Server-Address'])
+            visit.append(webpage)
+        return visit
+
     def grab(self, req_id, url, setup, features, actions):
         """Does the actual work of visiting a page and extracting information
         from it. Setup is done before loading a page, and features are 
@@ -218,30 +724,30 @@ class FirefoxCrawlerProcess(CrawlerProcess):
         [(fname.json, dict)] tuples. The dictionary will be written in file 
         called fname.json.
         """
-        # Result_list contains tuples of (fname, dict) where dict will be 
-        #    written in json format to fname.
-        result_list = []
-        visit = []
+        timer = self.timer
         # Set up pre-visit features
         self.extension_inst.reset()
+        timer.mark('reset')
         self._visit_setup(setup)
+        load_policy = self._load_policy(setup)
+        if load_policy['policy'] == 'idle':
+            self.extension_inst.set_load_policy(load_policy['idle_time'],
+                                                load_policy['idle_cap'])
+        timer.mark('setup')
         # Visit URL
         self.extension_inst.set_url(url)
-        self.extension_inst.wait_for_load(5, config.PAGE_TIMEOUT)
-        if not self.extension_inst.page_loaded():
-            visit.append({'url': url, 'status_code': config.PAGE_TIMEOUT_ST})
-        if self.extension_inst.page_error():
-            visit.append({'url': url, 'status_code': config.FIREFOX_ERR_ST})
-        print self.extension_inst.headers()
-        html = self.extension_inst.html()
+        timer.mark('navigate')
+        self.extension_inst.wait_for_load(config.PAGE_TIMEOUT,
+                                          load_policy['policy'])
+        timer.mark('load')
         
         all_flag = False
         dom = None
         screenshot = None
         dom_fname = ''
         img_fname = ''
-        eval_result_l = []
-        tags = {}
+        # The HTML is only needed in memory for tagging.
+        html = None
         
         if features == "all":
             all_flag = True
@@ -251,37 +757,72 @@ class FirefoxCrawlerProcess(CrawlerProcess):
                                                           'dom',
                                                           crawlglobs.dom_dir)
             if dom_path:
-                dom = self.extension_inst.html_file(dom_path, dom_fname)
+                (dom, html) = self.extension_inst.html_file(
+                                            dom_path, dom_fname, 
+                                            keep_html=bool(crawlglobs.tags_l),
+                                            store=self.blob_store,
+                                            pack=self.pack_writer)
+                self._count_stored('dom', dom, dom_path)
+                timer.mark('dom')
             
         if all_flag or features.has_key('screenshot'):
             (img_path, img_fname) = self._feature_destination('png', features, 
                                                           'screenshot',
                                                           crawlglobs.img_dir)
-            if img_path:
-                screenshot = self.extension_inst.screenshot_file(img_path, 
-                                                                 img_fname)
-
-        if actions.has_key('eval'):
-            # Eval is a list of javascript snippets. Run each one.
-            for exp in actions['eval']:
-                eval_result_l.append(self.extension_inst.eval_js(exp))
+            if img_path and self.screenshot_pool:
+                raw_path = self.extension_inst.screenshot_raw()
+                if raw_path:
+                    self.pending_screenshot = [raw_path, img_path, img_fname, 
+                                               None]
+            elif img_path:
+                screenshot = self.extension_inst.screenshot_file(
+                                                        img_path, img_fname,
+                                                        self.blob_store,
+                                                        self.pack_writer)
+                self._count_stored('screenshot', screenshot, img_path)
+            timer.mark('screenshot')
+
+        # Eval is a list of javascript snippets. They are run as part of
+        #    collecting the visit, after the DOM and screenshot are saved.
+        collected = self.extension_inst.collect_visit(actions.get('eval'))
+        timer.mark('eval')
+        if crawlglobs.tags_l and html is None and collected is not None:
+            html = self.extension_inst.html()
+        return self._grab_results(req_id, url, features, collected, html, 
+                                  dom, screenshot, dom_fname, img_fname)
+
+    def _grab_results(self, req_id, url, features, collected, html, dom,
+                      screenshot, dom_fname, img_fname, tags=None):
+        """Second half of grab(), once the page is visited and its DOM and
+        screenshot are saved: tags html and builds the result list out of 
+        what collect_visit() returned. tags are those of _match_tags(), if
+        html was tagged already.
+        """
+        all_flag = features == "all"
+        # Result_list contains tuples of (fname, dict) where dict will be 
+        #    written in json format to fname.
+        result_list = []
+        visit = []
+        if collected is None:
+            self.attempt['status'] = config.FIREFOX_ERR_ST
+            return None
+        if not collected['loaded']:
+            visit.append({'url': url, 'status_code': config.PAGE_TIMEOUT_ST})
+            self.attempt['status'] = config.PAGE_TIMEOUT_ST
+        if collected['error']:
+            status = config.FIREFOX_ERR_ST
+            if collected.get('error_code', '').startswith(
+                                                config.PROXY_ERROR_PREFIX):
+                status = config.PROXY_ERR_ST
+            visit.append({'url': url, 'status_code': status})
+            self.attempt['status'] = status
+        eval_result_l = collected['eval_results']
                 
         # Tagging
-        if crawlglobs.tags_l:
-            # We have to tag.
-            for (tag_name, attrs) in crawlglobs.tags_l:
-                threshold = attrs["threshold"]
-                # Keep track of how many matched
-                match_count = 0
-                match_groups = []
-                for regex in attrs["regexes"]:
-                    se = regex.search(html)
-                    if se: 
-                        match_count += 1
-                    match_groups.append(se.groups())
-                    print match_groups
-                if match_count >= threshold:
-                    tags[tag_name] = match_groups
+        if tags is None:
+            tags = self._match_tags(html)
+            if crawlglobs.tags_l and html:
+                self.timer.mark('tags')
                         
         if all_flag or features.has_key("visitchain"):
             (vc_path, vc_fname) = self._feature_destination(
@@ -293,40 +834,21 @@ class FirefoxCrawlerProcess(CrawlerProcess):
                 vc_fname = req_id + ".json"
             if vc_path:
                 vc_fname = os.path.join(vc_path, vc_fname)
-                
-            headers = self.extension_inst.headers()
-            redirects = self.extension_inst.redirects()
-            response_codes =  self.extension_inst.response_codes()
-            if not response_codes:
-                response_codes= {url: 'UNK'} 
-            if response_codes != None and len(redirects) != 0:
-                for page in redirects:
-                    if page == 'about:blank': 
-                        continue
-                    webpage = {'url': page}
-                    if page in response_codes.keys():
-                        webpage['status_code'] = response_codes[page]
-                    elif page + '/' in response_codes.keys():
-                        webpage['status_code'] = response_codes[page + '/']
-                    if headers is not None and headers.has_key(page):
-                        webpage['headers'] = headers[page]
-                    if headers is not None and headers.has_key(page+ '/'):
-                        webpage['headers'] = headers[page + '/']
-                        # Our tinyproxy is configured to return the server addr
-                        #    in a special header. This shouldn't hurt anyone not
-                        #    using the modified tinyproxy
-                    if (webpage.has_key('headers') and 
-                        webpage['headers'].has_key('X-Server-Address')):
-                            webpage['server_addr'] = (
-                                webpage['headers']['X-Server-Address'])
-                    visit.append(webpage)
+            visit.extend(self._visit_chain(url, collected))
             if visit:
                 visit[-1]['dom'] = dom
                 visit[-1]['screenshot'] = screenshot
+                if self.pending_screenshot:
+                    # Filled in once the screenshot pool has stored it.
+                    self.pending_screenshot[3] = visit[-1]
                 if eval_result_l:
                     visit[-1]['eval_results'] = eval_result_l
                 if tags:
                     visit[-1]['tags'] = tags
+                if self.attempts:
+                    # Earlier attempts, if this visit is a retry.
+                    visit[-1]['attempts'] = self.attempts
+                visit[-1]['timings'] = dict(self.timer.timings)
                 result_list.append((vc_fname, visit))
             return result_list
         else:
@@ -339,3 +861,26 @@ class FirefoxCrawlerProcess(CrawlerProcess):
                                    "missing, the mapping to dom and/or " +
                                    "screenshot will be lost forever!"))
             return None
+
+    def _match_tags(self, html):
+        """Returns {tag name: groups matched by each of its regexes, or 
+        None} of the tags in crawlglobs.tags_l that html matches.
+        """
+        tags = {}
+        if not crawlglobs.tags_l or not html:
+            return tags
+        for (tag_name, attrs) in crawlglobs.tags_l:
+            threshold = attrs["threshold"]
+            # Keep track of how many matched
+            match_count = 0
+            match_groups = []
+            for regex in attrs["regexes"]:
+                se = regex.search(html)
+                if se: 
+                    match_count += 1
+                    match_groups.append(se.groups())
+                else:
+                    match_groups.append(None)
+            if match_count >= threshold:
+                tags[tag_name] = match_groups
+        return tags
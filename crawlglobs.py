@@ -10,13 +10,33 @@ display = None
 img_dir = None
 dom_dir = None
 visit_chain_dir = None
+# Root of the content addressed store for md5 named DOMs and screenshots.
+blob_store_dir = None
+# Directory for pack files. If set, DOMs, screenshots and visit chains are
+#    appended to packs instead of being written as individual files.
+pack_dir = None
 proxy_file = None
 proxy_scheme = None
+# Default page load completion policy. Dictionary with keys 'policy',
+#    'idle_time' and 'idle_cap'. See config.LOAD_POLICY.
+load_policy = None
+# Memory limits for recycling browsers. Dictionary with keys 'max_rss' and
+#    'max_growth'. See config.BROWSER_MAX_RSS.
+browser_limits = None
+# startup.StartupSlots limiting the browsers starting up at once, shared by
+#    all crawler processes.
+startup_slots = None
 # List of tag dictionaries.
 tags_l = None
 # Directory for all temporary data
 tmp_dir = None
+# Directory with the staged profile template and the Firefox profiles. See
+#    browser.stage_profile_template().
+profile_dir = None
 # Logging queue for multiprocess logging
 log_q = None
+# Queue the crawlers put metrics events on, or None if metrics are off. See
+#    metrics.py.
+metrics_q = None
 logger = None
 log_level = None
\ No newline at end of file
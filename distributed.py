@@ -0,0 +1,310 @@
+"""Crawling with browsers on several machines. A coordinator runs the queue
+controller as usual and serves its request and result queues over TCP
+through a JobBroker. Workers on other machines run CrawlerProcesses against
+RemoteRequestQueue and RemoteResultQueue, which stand in for the
+multiprocessing queues.
+
+Every job handed to a worker is leased to it. Workers renew their leases
+while they are alive, and the jobs of leases that run out are handed out
+again. A job is done once the first result for it comes back.
+
+The broker is served by a multiprocessing manager, which unpickles what
+clients send. Anyone with the authkey can run code on the coordinator, so
+there is no default key, and the port must not be reachable from untrusted
+networks.
+
+Author: nchachra@cs.ucsd.edu
+"""
+
+import collections
+import os
+import Queue
+import socket
+import threading
+import time
+from multiprocessing.managers import BaseManager
+
+import config
+import mplogging
+
+
+def parse_address(address):
+    """Returns (host, port) for a 'host:port' string.
+    """
+    (host, port) = address.rsplit(':', 1)
+    return (host, int(port))
+
+
+class JobBroker:
+    """Hands out the jobs on the coordinator's request queue to workers and
+    puts their results on the result queue. Runs in the coordinator's main
+    process; its methods are called by workers through BrokerClient.
+    """
+    def __init__(self, req_q, res_q, logger,
+                 lease_time=config.DIST_LEASE_TIME):
+        self.req_q = req_q
+        self.res_q = res_q
+        self.logger = logger
+        self.lease_time = lease_time
+        self.lock = threading.Lock()
+        # {job id: [task, worker id, lease deadline]}
+        self.leases = {}
+        # Tasks whose lease ran out or was released, handed out first.
+        self.reissue = collections.deque()
+        # {worker id: time last heard from}
+        self.workers = {}
+        # Set once "CLEANUP" came off the request queue.
+        self.cleanup = False
+        self.stopped = threading.Event()
+
+    def start(self):
+        reaper = threading.Thread(target=self._reap, name="LeaseReaper")
+        reaper.daemon = True
+        reaper.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _reap(self):
+        while not self.stopped.is_set():
+            self.stopped.wait(self.lease_time / 4.0)
+            now = time.time()
+            self.lock.acquire()
+            try:
+                for (job_id, lease) in self.leases.items():
+                    if lease[2] < now:
+                        self.logger.warning(("Lease of job %s by %s ran " +
+                                             "out. Reissuing.")
+                                            % (job_id, lease[1]))
+                        del self.leases[job_id]
+                        self.reissue.append(lease[0])
+                for (worker_id, seen) in self.workers.items():
+                    if seen + self.lease_time < now:
+                        self.logger.warning("Lost worker %s" % worker_id)
+                        del self.workers[worker_id]
+            finally:
+                self.lock.release()
+
+    def _lease(self, task, worker_id):
+        """Call with the lock held.
+        """
+        self.leases[task[0]] = [task, worker_id,
+                                time.time() + self.lease_time]
+
+    def get_job(self, worker_id, timeout=config.DIST_POLL_TIME):
+        """Returns the next task for worker_id, "CLEANUP" once all jobs are
+        done, or None if there was no job within timeout seconds.
+        """
+        deadline = time.time() + timeout
+        while True:
+            self.lock.acquire()
+            try:
+                self.workers[worker_id] = time.time()
+                if self.reissue:
+                    task = self.reissue.popleft()
+                    self._lease(task, worker_id)
+                    return task
+                if self.cleanup:
+                    if not self.leases:
+                        # The worker's crawler is about to exit.
+                        del self.workers[worker_id]
+                        return "CLEANUP"
+                    # Wait for leased jobs, which may need reissuing.
+            finally:
+                self.lock.release()
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            if self.cleanup:
+                time.sleep(min(remaining, config.DIST_POLL_TIME))
+                continue
+            try:
+                task = self.req_q.get(True, remaining)
+            except Queue.Empty:
+                return None
+            self.lock.acquire()
+            try:
+                if task == "CLEANUP":
+                    self.logger.info("No more jobs for workers.")
+                    self.cleanup = True
+                    # Local crawlers need it too.
+                    self.req_q.put(task)
+                    self.req_q.task_done()
+                    continue
+                self._lease(task, worker_id)
+                return task
+            finally:
+                self.lock.release()
+
+    def renew(self, worker_id):
+        """Extends all leases held by worker_id.
+        """
+        self.lock.acquire()
+        try:
+            now = time.time()
+            self.workers[worker_id] = now
+            for lease in self.leases.itervalues():
+                if lease[1] == worker_id:
+                    lease[2] = now + self.lease_time
+        finally:
+            self.lock.release()
+
+    def release(self, worker_id, job_id):
+        """Gives back the job leased by worker_id without results, so it is
+        handed out again.
+        """
+        self.lock.acquire()
+        try:
+            lease = self.leases.get(job_id)
+            if lease and lease[1] == worker_id:
+                del self.leases[job_id]
+                self.reissue.append(lease[0])
+        finally:
+            self.lock.release()
+
+    def put_result(self, worker_id, job_id, result_list, attempt):
+        """Accepts the results of job_id. Results for jobs that aren't
+        leased, because another worker finished them first, are dropped.
+        """
+        self.lock.acquire()
+        try:
+            self.workers[worker_id] = time.time()
+            if not self.leases.has_key(job_id):
+                self.logger.info("Dropping duplicate result for %s from %s"
+                                 % (job_id, worker_id))
+                return
+            del self.leases[job_id]
+        finally:
+            self.lock.release()
+        self.res_q.put((job_id, result_list, attempt))
+        self.req_q.task_done()
+
+    def check_cleanup(self):
+        """Called by the coordinator while it waits for the workers, in case
+        no worker has taken "CLEANUP" off the request queue yet. A job found
+        instead is kept for the next worker.
+        """
+        if self.cleanup or self.reissue:
+            return
+        try:
+            task = self.req_q.get_nowait()
+        except Queue.Empty:
+            return
+        self.lock.acquire()
+        try:
+            if task == "CLEANUP":
+                self.cleanup = True
+                self.req_q.put(task)
+                self.req_q.task_done()
+            else:
+                self.reissue.append(task)
+        finally:
+            self.lock.release()
+
+    def finished(self):
+        """Returns whether all jobs are done and every worker that was still
+        around has been told to exit.
+        """
+        self.lock.acquire()
+        try:
+            return (self.cleanup and not self.leases and not self.reissue
+                    and not self.workers)
+        finally:
+            self.lock.release()
+
+
+class BrokerServer(BaseManager):
+    pass
+
+
+class BrokerClient(BaseManager):
+    pass
+
+BrokerClient.register('get_broker')
+
+
+def serve_broker(broker, address, authkey):
+    """Serves broker at address in a background thread of this process.
+    """
+    BrokerServer.register('get_broker', callable=lambda: broker)
+    server = BrokerServer(address=address, authkey=authkey).get_server()
+    thread = threading.Thread(target=server.serve_forever,
+                              name="BrokerServer")
+    thread.daemon = True
+    thread.start()
+    broker.start()
+    return server
+
+
+class RemoteRequestQueue:
+    """Request queue of a worker's crawler process. Implements the parts of
+    JoinableQueue that CrawlerProcess uses. Connects to the coordinator on
+    first use, which has to happen in the crawler's own process.
+    """
+    def __init__(self, address, authkey, log_q):
+        self.address = address
+        self.authkey = authkey
+        self.logger = mplogging.setupSubProcessLogger("RemoteQueue", log_q)
+        self.broker = None
+        self.worker_id = None
+
+    def _connect(self):
+        if self.broker is None:
+            self.worker_id = '%s:%s' % (socket.gethostname(), os.getpid())
+            client = BrokerClient(address=self.address, authkey=self.authkey)
+            client.connect()
+            self.broker = client.get_broker()
+            renewer = threading.Thread(target=self._renew,
+                                       name="LeaseRenewer")
+            renewer.daemon = True
+            renewer.start()
+        return self.broker
+
+    def _renew(self):
+        # The proxy opens a connection of its own for every thread.
+        while True:
+            time.sleep(config.DIST_LEASE_TIME / 4.0)
+            try:
+                self.broker.renew(self.worker_id)
+            except Exception, e:
+                self.logger.error("Error renewing leases: %s" % e)
+
+    def get(self):
+        """Blocks until the coordinator hands out a task. Returns "CLEANUP"
+        if the coordinator is gone.
+        """
+        while True:
+            try:
+                task = self._connect().get_job(self.worker_id)
+            except (EOFError, socket.error), e:
+                self.logger.critical("Lost coordinator: %s" % e)
+                return "CLEANUP"
+            if task is not None:
+                return task
+
+    def put(self, task):
+        """Crawlers put back "CLEANUP" for their siblings, which get it from
+        the coordinator anyway, and jobs they couldn't visit.
+        """
+        if task != "CLEANUP":
+            self._connect().release(self.worker_id, task[0])
+
+    def task_done(self):
+        # The coordinator marks the job done when its results arrive.
+        pass
+
+
+class RemoteResultQueue:
+    """Result queue of a worker's crawler process. Sends results to the
+    coordinator.
+    """
+    def __init__(self, req_q):
+        """req_q is the crawler's RemoteRequestQueue, whose connection is
+        used.
+        """
+        self.req_q = req_q
+
+    def put(self, item):
+        (job_id, result_list, attempt) = item
+        self.req_q._connect().put_result(self.req_q.worker_id, job_id,
+                                         result_list, attempt)
@@ -0,0 +1,429 @@
+"""A single threaded event loop, for driving many browsers from one process.
+See asynccrawler.py.
+
+Coroutines are generators. A coroutine waits for a Future, or for another
+coroutine, by yielding it, and the yield evaluates to the result or raises
+its exception. A coroutine returns a value by raising Return(value):
+
+    def fetch(loop, sock):
+        yield loop.wait_readable(sock, 10)
+        raise Return(sock.recv(4096))
+
+    data = loop.run_until_complete(loop.spawn(fetch(loop, sock)))
+
+Blocking calls, like getting a job off a Queue, are made in a ThreadRunner
+so that the loop keeps going.
+
+Author: nchachra@cs.ucsd.edu
+"""
+
+import collections
+import errno
+import fcntl
+import heapq
+import os
+import Queue
+import select
+import sys
+import threading
+import time
+import types
+
+
+class Return(Exception):
+    """Raised by a coroutine to return value.
+    """
+    def __init__(self, value=None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class Timeout(Exception):
+    """Raised into a coroutine whose wait ran out of time.
+    """
+    pass
+
+
+class Cancelled(Exception):
+    """The exception of a Task that was cancelled.
+    """
+    pass
+
+
+class Future:
+    """The result of an operation that finishes later. Callbacks added with
+    add_done_callback() are run by the loop once the result is set.
+    """
+    def __init__(self, loop):
+        self.loop = loop
+        self.finished = False
+        self.result = None
+        # sys.exc_info() of the exception, if the operation failed.
+        self.exc_info = None
+        self.callbacks = []
+
+    def done(self):
+        return self.finished
+
+    def set_result(self, result):
+        """Sets the result. Later results are ignored.
+        """
+        if self.finished:
+            return
+        self.result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        """Fails the operation with exc_info, a sys.exc_info() tuple or an
+        exception instance.
+        """
+        if self.finished:
+            return
+        if not isinstance(exc_info, tuple):
+            exc_info = (exc_info.__class__, exc_info, None)
+        self.exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        self.finished = True
+        for callback in self.callbacks:
+            self.loop.call_soon(callback, self)
+        self.callbacks = None
+
+    def add_done_callback(self, callback):
+        """callback is called with the future once it's done.
+        """
+        if self.finished:
+            self.loop.call_soon(callback, self)
+        else:
+            self.callbacks.append(callback)
+
+    def get_result(self):
+        """Returns the result, or raises the exception of a failed
+        operation.
+        """
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+
+class Task(Future):
+    """Runs a coroutine in the loop. The task is done when the coroutine
+    returns, with the coroutine's result.
+    """
+    def __init__(self, loop, coroutine):
+        Future.__init__(self, loop)
+        self.coroutine = coroutine
+        # The future the coroutine waits for.
+        self.waiting = None
+        loop.call_soon(self._step, None, None)
+
+    def cancel(self):
+        """Stops the coroutine at the yield it waits in, which runs its
+        finally clauses, and cancels the task it waits for, if any. The task
+        fails with Cancelled.
+        """
+        if self.finished:
+            return
+        waiting = self.waiting
+        self.waiting = None
+        self.coroutine.close()
+        self.set_exception(Cancelled())
+        if isinstance(waiting, Task):
+            waiting.cancel()
+
+    def _step(self, value, exc_info):
+        self.waiting = None
+        if self.finished:
+            # Cancelled while the result was on its way.
+            return
+        try:
+            if exc_info:
+                waited = self.coroutine.throw(*exc_info)
+            else:
+                waited = self.coroutine.send(value)
+        except StopIteration:
+            self.set_result(None)
+            return
+        except Return, e:
+            self.set_result(e.value)
+            return
+        except Exception:
+            self.set_exception(sys.exc_info())
+            return
+        if isinstance(waited, types.GeneratorType):
+            waited = Task(self.loop, waited)
+        if waited is None:
+            # A bare yield lets other coroutines run.
+            self.loop.call_soon(self._step, None, None)
+        elif isinstance(waited, Future):
+            self.waiting = waited
+            waited.add_done_callback(self._wakeup)
+        else:
+            self.loop.call_soon(self._step, None,
+                                (TypeError, TypeError("Can't wait for %r"
+                                                      % (waited,)), None))
+
+    def _wakeup(self, future):
+        self._step(future.result, future.exc_info)
+
+
+class EventLoop:
+    """Runs callbacks, timers and coroutines in the thread that calls one of
+    the run methods, and waits for sockets with select(). Only
+    call_soon_threadsafe() may be called from other threads.
+    """
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.ready = collections.deque()
+        # Heap of [time due, sequence number, callback, args]. Cancelled
+        #    timers have their callback set to None.
+        self.timers = []
+        self.sequence = 0
+        # {fd: (callback, args)}
+        self.readers = {}
+        self.writers = {}
+        self.stopped = False
+        # Other threads append to this, and wake the loop up through the
+        #    pipe.
+        self.threadsafe = collections.deque()
+        (self.wake_r, self.wake_w) = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def call_soon(self, callback, *args):
+        self.ready.append((callback, args))
+
+    def call_later(self, delay, callback, *args):
+        """Calls callback after delay seconds. Returns a handle for
+        cancel_timer().
+        """
+        self.sequence += 1
+        timer = [time.time() + delay, self.sequence, callback, args]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def cancel_timer(self, timer):
+        timer[2] = None
+
+    def call_soon_threadsafe(self, callback, *args):
+        self.threadsafe.append((callback, args))
+        try:
+            os.write(self.wake_w, 'x')
+        except OSError, e:
+            # The pipe is full, so the loop is waking up anyway.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def add_reader(self, fd, callback, *args):
+        self.readers[fd] = (callback, args)
+
+    def remove_reader(self, fd):
+        self.readers.pop(fd, None)
+
+    def add_writer(self, fd, callback, *args):
+        self.writers[fd] = (callback, args)
+
+    def remove_writer(self, fd):
+        self.writers.pop(fd, None)
+
+    def spawn(self, coroutine):
+        """Starts running coroutine and returns its Task.
+        """
+        return Task(self, coroutine)
+
+    def sleep(self, delay):
+        """Returns a Future that is done after delay seconds.
+        """
+        future = Future(self)
+        self.call_later(delay, future.set_result, None)
+        return future
+
+    def _wait_fd(self, fd, timeout, add, remove):
+        if hasattr(fd, 'fileno'):
+            fd = fd.fileno()
+        future = Future(self)
+        timer = None
+        def ready():
+            remove(fd)
+            if timer:
+                self.cancel_timer(timer)
+            future.set_result(True)
+        def expired():
+            if future.done():
+                # Failed by someone else, and fd may be in use again.
+                return
+            remove(fd)
+            future.set_exception(Timeout("Timed out after %s seconds"
+                                         % timeout))
+        add(fd, ready)
+        if timeout is not None:
+            timer = self.call_later(max(timeout, 0), expired)
+        return future
+
+    def wait_readable(self, fd, timeout=None):
+        """Returns a Future that is done once fd, a file descriptor or an
+        object with a fileno(), can be read from. It fails with Timeout
+        after timeout seconds.
+        """
+        return self._wait_fd(fd, timeout, self.add_reader, self.remove_reader)
+
+    def wait_writable(self, fd, timeout=None):
+        """Same as wait_readable(), for writing.
+        """
+        return self._wait_fd(fd, timeout, self.add_writer, self.remove_writer)
+
+    def with_timeout(self, waited, timeout):
+        """Returns a Future with the result of waited, a Future or a
+        coroutine, that fails with Timeout if waited isn't done after
+        timeout seconds. A coroutine is cancelled in that case.
+        """
+        if isinstance(waited, types.GeneratorType):
+            waited = self.spawn(waited)
+        future = Future(self)
+        def expired():
+            future.set_exception(Timeout("Timed out after %s seconds"
+                                         % timeout))
+            if isinstance(waited, Task):
+                waited.cancel()
+        timer = self.call_later(timeout, expired)
+        def done(waited):
+            self.cancel_timer(timer)
+            if waited.exc_info:
+                future.set_exception(waited.exc_info)
+            else:
+                future.set_result(waited.result)
+        waited.add_done_callback(done)
+        return future
+
+    def stop(self):
+        self.stopped = True
+
+    def run_until_complete(self, future):
+        """Runs the loop until future, a Future or a coroutine, is done, and
+        returns its result.
+        """
+        if isinstance(future, types.GeneratorType):
+            future = self.spawn(future)
+        future.add_done_callback(lambda future: self.stop())
+        self.stopped = False
+        while not self.stopped:
+            self._run_once()
+        return future.get_result()
+
+    def _run_once(self):
+        timeout = None
+        if self.ready or self.threadsafe:
+            timeout = 0
+        elif self.timers:
+            timeout = max(0, self.timers[0][0] - time.time())
+        readers = self.readers.keys() + [self.wake_r]
+        try:
+            (readable, writable, _) = select.select(readers,
+                                                    self.writers.keys(), [],
+                                                    timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            (readable, writable) = ([], [])
+        for fd in readable:
+            if fd == self.wake_r:
+                try:
+                    while os.read(self.wake_r, 4096):
+                        pass
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+            elif fd in self.readers:
+                self.ready.append(self.readers[fd])
+        for fd in writable:
+            if fd in self.writers:
+                self.ready.append(self.writers[fd])
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            timer = heapq.heappop(self.timers)
+            if timer[2] is not None:
+                self.ready.append((timer[2], timer[3]))
+        while self.threadsafe:
+            self.ready.append(self.threadsafe.popleft())
+        # Callbacks added by these run on the next round.
+        for i in range(len(self.ready)):
+            (callback, args) = self.ready.popleft()
+            try:
+                callback(*args)
+            except Exception:
+                if self.logger:
+                    self.logger.exception("Error in event loop callback")
+                else:
+                    raise
+
+    def close(self):
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+
+class Semaphore:
+    """Lets at most value coroutines hold it at once.
+    """
+    def __init__(self, loop, value):
+        self.loop = loop
+        self.value = value
+        # Futures of the coroutines waiting for it, in order.
+        self.waiters = collections.deque()
+
+    def acquire(self):
+        """Returns a Future that is done once the caller holds the 
+        semaphore.
+        """
+        future = Future(self.loop)
+        if self.value > 0:
+            self.value -= 1
+            future.set_result(None)
+        else:
+            self.waiters.append(future)
+        return future
+
+    def release(self):
+        if self.waiters:
+            self.waiters.popleft().set_result(None)
+        else:
+            self.value += 1
+
+
+class ThreadRunner:
+    """Makes blocking calls for coroutines in a thread of its own, one at a
+    time and in the order they were asked for.
+    """
+    def __init__(self, loop, name="ThreadRunner"):
+        self.loop = loop
+        self.calls = Queue.Queue()
+        self.thread = threading.Thread(target=self._run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def call(self, func, *args):
+        """Returns a Future with the result of func(*args).
+        """
+        future = Future(self.loop)
+        self.calls.put((future, func, args))
+        return future
+
+    def _run(self):
+        while True:
+            item = self.calls.get()
+            if item is None:
+                break
+            (future, func, args) = item
+            try:
+                result = func(*args)
+            except Exception:
+                self.loop.call_soon_threadsafe(future.set_exception,
+                                               sys.exc_info())
+            else:
+                self.loop.call_soon_threadsafe(future.set_result, result)
+
+    def close(self):
+        """Stops the thread once the calls asked for are made.
+        """
+        self.calls.put(None)
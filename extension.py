@@ -1,37 +1,103 @@
 import hashlib
+import itertools
 import os.path
 import simplejson as json
-import shutil
 import socket
-import subprocess
 import time
 import traceback
 
 import config
 import crawlglobs
+import screenshotpool
+import startup
+import utils
+
+
+# Numbers the raw screenshots of this process, so that their temp files
+#    never clash, even across browser restarts.
+_screenshot_numbers = itertools.count(1)
+
+
+class ExtensionError(Exception):
+    """The extension replied with an error to a command whose caller can't
+    tell it apart from a regular result otherwise.
+    """
+    pass
 
 class Extension:
-    def __init__(self, logger, host='localhost',port=7055):
+    """Client for the command socket of the Firefox extension. A single
+    connection is kept open and reused for all commands. Every message in
+    either direction is framed as "<body length>\n<body>".
+    """
+    # GET_HTML replies with this instead of the HTML if the page has none.
+    HTML_ERROR_PREFIX = '{"result":"ERROR"'
+
+    def __init__(self, logger, host='localhost',port=7055, tab=None):
         """
         By default Firefox extension starts up listening on port 7055. If
         another port is desired, start the extension with defaults and use
-        restart_at_port().
+        restart_at_port(). If tab is given, commands are run for the tab 
+        with that id, see open_tabs().
         """
         self.host = host
         self.port = port
+        self.tab = tab
         self.logger = logger
+        self.sock = None
+        # Bytes read from the socket that belong to the next frame.
+        self.recv_buf = ''
+        # Set once the header of the reply to the current command is read.
+        self.reply_started = False
+
+    def encode(self, msg):
+        """
+        Returns the JSON encoded command msg, for this instance's tab.
+        """
+        if self.tab is not None:
+            msg = dict(msg, tab=self.tab)
+        return json.dumps(msg)
+
+    def tag(self):
+        """
+        Returns a string unique to this browser and tab, for temporary file
+        names.
+        """
+        if self.tab is None:
+            return str(self.port)
+        return '%s_%s' % (self.port, self.tab)
+
+    def open_tabs(self, num):
+        """
+        Has the extension open num tabs for visiting pages at once. Returns
+        [Extension] with an instance for each tab, each with its own 
+        connection, or None on error.
+        """
+        msg = {'command': 'OPEN_TABS', 'args': num}
+        try:
+            response = json.loads(self.send_and_recv(self.encode(msg)))
+        except Exception, e:
+            self.logger.error("Error opening tabs: %s" % e)
+            return None
+        if response.get('result') != "DONE":
+            self.logger.error("Opening tabs failed: %s" 
+                              % response.get('message'))
+            return None
+        return [Extension(self.logger, self.host, self.port, tab) 
+                for tab in range(num)]
 
     def restart_at_port(self, port):
         """
         Restart the extension at a new port.
         """
         msg = {'command':'SET_PORT', 'args':port}
-        result = self.wait_for_action(json.dumps(msg))
+        result = self.wait_for_action(self.encode(msg))
+        # The old connection stays with the old port. Reconnect on next use.
+        self.close()
         self.port = port
-        self.logger("msg: %s, result: %s" % (msg, result))
+        self.logger.debug("msg: %s, result: %s" % (msg, result))
         return result
     
-    def wait_for_action(self, msg, poll_interval=10, 
+    def wait_for_action(self, msg, poll_interval=1, 
                         timeout=config.PAGE_TIMEOUT):
         """
         Retries a command at poll_interval,until timeout. Returns None if
@@ -44,40 +110,144 @@ class Extension:
                 result = self.send_and_recv(msg)
                 if result: break
             except Exception, e:
-                self.logger.warning("Exception in %s. Retrying until timeout.")
+                self.logger.warning(("Exception in %s: %s. Retrying until " +
+                                     "timeout.") % (msg, e))
             time.sleep(poll_interval)
             wait_time += poll_interval
         return result
+
+    def wait_ready(self, process, timeout=config.PAGE_TIMEOUT):
+        """
+        Probes the extension of the browser running as process until it
+        answers a RESET, see startup.probe_intervals(). Returns the seconds
+        it took, or None if the extension didn't answer within timeout 
+        seconds or the browser exited.
+        """
+        start = time.time()
+        msg = self.encode({'command': 'RESET', 'args': ''})
+        for interval in startup.probe_intervals(timeout):
+            if process.poll() is not None:
+                self.logger.error("Browser at port %s exited on startup" 
+                                  % self.port)
+                return None
+            try:
+                if self.send_and_recv(msg):
+                    return time.time() - start
+            except (socket.error, RuntimeError), e:
+                # Refused until the extension listens.
+                pass
+            time.sleep(interval)
+        return None
+
+    def connect(self):
+        """
+        Opens the command connection to the extension, unless it is open
+        already.
+        """
+        if self.sock is None:
+            self.sock = socket.create_connection((self.host, self.port),
+                                                 config.EXT_SOCKET_TIMEOUT)
+            self.recv_buf = ''
+
+    def close(self):
+        """
+        Closes the command connection. The next command reconnects.
+        """
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+            self.recv_buf = ''
     
-    def send_and_recv(self, strmsg, msglen=4096):
-        """
-        Sends strmsg to the socket, and returns the received data.
-        """
-        resultstring = ""
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(180)
-        sock.connect((self.host, self.port))
-        sock.send(strmsg)
-        if msglen != 4096:
-            while len(resultstring) < msglen:
-                chunk = sock.recv(4096)
-                if chunk == '':
-                    raise RuntimeError, 'SOCKET BROKEN'
-                resultstring = resultstring + chunk
-            return resultstring
-        else:
-            data = sock.recv(4096)
-            return data
+    def send_and_recv(self, strmsg, timeout=None, sink=None):
+        """
+        Sends strmsg as a single frame and returns the body of the reply
+        frame. timeout overrides the socket timeout for this command only. 
+        If sink is given, the body is passed to it chunk by chunk instead of
+        being returned. A connection that was reused and turns out to be 
+        broken before any reply arrives is reopened once before giving up.
+        """
+        reused = self.sock is not None
+        try:
+            return self._command(strmsg, timeout, sink)
+        except socket.timeout:
+            # The extension is alive but slow. Resending won't help.
+            self.close()
+            raise
+        except (socket.error, RuntimeError), e:
+            self.close()
+            if not reused or self.reply_started:
+                raise
+            self.logger.debug("Command connection broken: %s. Reconnecting."
+                              % e)
+            try:
+                return self._command(strmsg, timeout, sink)
+            except (socket.error, RuntimeError):
+                self.close()
+                raise
+
+    def _command(self, strmsg, timeout, sink):
+        """
+        Helper for send_and_recv(). Does a single frame exchange.
+        """
+        self.connect()
+        self.reply_started = False
+        if timeout is not None:
+            self.sock.settimeout(timeout)
+        try:
+            self.sock.sendall("%d\n%s" % (len(strmsg), strmsg))
+            return self.recv_frame(sink)
+        finally:
+            if timeout is not None and self.sock is not None:
+                self.sock.settimeout(config.EXT_SOCKET_TIMEOUT)
+
+    def recv_chunk(self):
+        """
+        Returns the next chunk of bytes from the socket.
+        """
+        chunk = self.sock.recv(config.EXT_RECV_SIZE)
+        if chunk == '':
+            raise RuntimeError, 'SOCKET BROKEN'
+        return chunk
+
+    def recv_frame(self, sink=None):
+        """
+        Reads a single frame off the connection and returns its body. If 
+        sink is given, it is called with each chunk of the body as it 
+        arrives and nothing is returned.
+        """
+        while '\n' not in self.recv_buf:
+            if len(self.recv_buf) > 20:
+                raise RuntimeError('Malformed frame header: %r' 
+                                   % self.recv_buf[:20])
+            self.recv_buf += self.recv_chunk()
+        (header, self.recv_buf) = self.recv_buf.split('\n', 1)
+        if not header.isdigit():
+            raise RuntimeError('Malformed frame header: %r' % header)
+        self.reply_started = True
+        remaining = int(header)
+        chunks = []
+        while remaining:
+            if not self.recv_buf:
+                self.recv_buf = self.recv_chunk()
+            chunk = self.recv_buf[:remaining]
+            self.recv_buf = self.recv_buf[len(chunk):]
+            remaining -= len(chunk)
+            if sink:
+                sink(chunk)
+            else:
+                chunks.append(chunk)
+        if not sink:
+            return ''.join(chunks)
 
     def redirects(self):
         """
         Returns a list of the URLs seen in the address bar during navigation
         """
-        redirects_len = self.msg_len('GET_REDIRECTS_LEN')
         msg = {'command': 'GET_REDIRECTS', 'args': ''}
-        redirects = self.send_and_recv(json.dumps(msg), redirects_len)
-        if redirects_len != len(redirects):
-            raise RuntimeError('Incomplete redirects received.')
+        redirects = self.send_and_recv(self.encode(msg))
         return self.safe_decode(redirects)
 
     def reset(self):
@@ -87,16 +257,35 @@ class Extension:
         URL.
         """
         msg = {'command': 'RESET', 'args': ''}
-        result = self.wait_for_action(json.dumps(msg))
+        result = self.wait_for_action(self.encode(msg))
         return result
 
+    def clear_state(self):
+        """
+        Resets the extension like reset(), and wipes cookies, cache, local
+        and session storage, history, permissions and all windows and tabs
+        but one, so the next visit starts out like in a fresh browser.
+        Returns True if the extension verified that the state is gone.
+        """
+        msg = {'command': 'CLEAR_STATE', 'args': ''}
+        try:
+            response = json.loads(self.send_and_recv(self.encode(msg)))
+        except Exception, e:
+            self.logger.error("Error clearing browser state: %s" % e)
+            return False
+        if response.get('result') != "DONE":
+            self.logger.error("Clearing browser state failed: %s" 
+                              % response.get('message'))
+            return False
+        return True
+
     def current_url(self):
         """
         Returns the current URL in the address bar, as a dictionary of url
         parts: href, host, hostname, port
         """
         msg = {'command': 'GET_URL', 'args': ''}
-        data = self.send_and_recv(json.dumps(msg))
+        data = self.send_and_recv(self.encode(msg))
         return json.loads(data)
 
     def set_url(self, url):
@@ -105,7 +294,7 @@ class Extension:
         but can also be used to execute JS or scroll to an anchor
         """
         msg = {'command': 'SET_URL', 'args': url}
-        data = self.send_and_recv(json.dumps(msg))    
+        data = self.send_and_recv(self.encode(msg))    
         return json.loads(data)
 
     def set_header(self, name, value):
@@ -114,7 +303,7 @@ class Extension:
         pairs. This can be used to overwrite existing headers.
         """
         msg = {'command': 'SET_HEADER', 'args': [name, value]}
-        data = self.send_and_recv(json.dumps(msg))
+        data = self.send_and_recv(self.encode(msg))
         return json.loads(data)
 
     def headers(self):
@@ -124,13 +313,10 @@ class Extension:
         fetched with HTTP).
         headerval = headers[url][headername]
         """
-        headers_len = self.msg_len('GET_HEADERS_LEN')
-        if headers_len == 0:
-            return None
         msg = {'command': 'GET_HEADERS', 'args':''}
-        headers = self.send_and_recv(json.dumps(msg), headers_len)
-        if len(headers) != headers_len:
-            raise RuntimeError('Incomplete headers returned.')
+        headers = self.send_and_recv(self.encode(msg))
+        if not headers:
+            return None
         return self.safe_decode(headers)
 
     def set_pref(self, name, value, pref_type):
@@ -140,43 +326,27 @@ class Extension:
         'true', 'false', integers.
         """
         msg = {'command': 'SET_PREF', 'args':[name, value, pref_type]}
-        return json.loads(self.send_and_recv(json.dumps(msg)))
+        return json.loads(self.send_and_recv(self.encode(msg)))
 
     def set_proxy(self, ip, port, proxy_type):
         """ Sets the proxy for FF to use. Type can be 'http' or 'socks'.
         IP address (string), and port is a string too.
         """
         msg = {'command': 'SET_PROXY', 'args': [proxy_type, ip, port]}
-        return json.loads(self.send_and_recv(json.dumps(msg)))
+        return json.loads(self.send_and_recv(self.encode(msg)))
 
     def disable_proxy(self):
         """ Turns off proxying """
         msg = {'command': 'DISABLE_PROXY', 'args':''}
-        return json.loads(self.send_and_recv(json.dumps(msg)))
+        return json.loads(self.send_and_recv(self.encode(msg)))
 
     def html(self):
         """
         Returns the raw HTML for the page. Note: the HTML is NOT JSON encoded.
         It's raw as it comes out of innerHTML for the body and head elements.
         """
-        html_len = self.msg_len('GET_HTML_LEN')
         msg = {'command': 'GET_HTML', 'args':''}
-        html = self.send_and_recv(json.dumps(msg), html_len)
-        if html_len != len(html):
-            raise RuntimeError('Incomplete message received.')
-        return html
-        
-    def msg_len(self, command='GET_HTML_LEN'):
-        """
-        Helper method. Returns length of message that will be returned by
-        the extension. 
-        """
-        msg = {'command': command, 'args':''}
-        len_str = self.send_and_recv(json.dumps(msg))
-        if len_str == "": 
-            raise ValueError('Get Length returned empty string')
-        msg_len = int(len_str)
-        return msg_len
+        return self.send_and_recv(self.encode(msg))
 
     def wait_for_file_creation(self, file_path, poll_interval=1, timeout=10):
         """
@@ -209,30 +379,56 @@ class Extension:
         Returns md5 for file at file_path. Ensure that file exists before 
         calling this functin.
         """
-        md5 = hashlib.md5()
-        fh = open(file_path)
-        while True:
-            data = fh.read()
-            if not data:
-                break
-            md5.update(data)
-        return md5.hexdigest()
+        return utils.file_md5(file_path)
         
     def response_codes(self):
         """
         Returns a dictionary of {url: response_code} 
         """
-        responsecodes_len = self.msg_len('GET_RESPONSE_CODES_LEN')
-        if responsecodes_len == 0:
-            return None
         msg = {'command': 'GET_RESPONSE_CODES', 'args':''}
-        responsecodes = self.send_and_recv(json.dumps(msg), 
-                                            responsecodes_len)
-        if responsecodes_len != len(responsecodes):
-            raise RuntimeError('Incomplete response codes received.')
+        responsecodes = self.send_and_recv(self.encode(msg))
+        if not responsecodes:
+            return None
         return self.safe_decode(responsecodes)
 
-    def screenshot_file(self, dest_dir, fname):
+    def screenshot_raw(self):
+        """
+        Has the extension save an uncompressed screenshot into a new file in
+        the tmp directory. Returns the path of the file, or None on error. 
+        The caller is responsible for removing the file.
+        """
+        temp_path = self.screenshot_temp_path()
+        msg = {'command': 'SAVE_SCREENSHOT_FILE', 'args': temp_path}
+        response = self.send_and_recv(self.encode(msg))
+        return self.screenshot_saved(msg, response)
+
+    def screenshot_temp_path(self):
+        """
+        Returns a new path in the tmp directory for a raw screenshot. The 
+        path is unique to the capture, so it can't clash with a screenshot
+        still waiting in the screenshot pool.
+        """
+        temp_fname = '%s_%s_%s_%s.png' % (os.uname()[1], os.getpid(), 
+                                          self.tag(), 
+                                          _screenshot_numbers.next())
+        temp_path = os.path.join(crawlglobs.tmp_dir, temp_fname)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return temp_path
+
+    def screenshot_saved(self, msg, response):
+        """
+        Returns the path of the raw screenshot that msg asked for, given the
+        extension's response, or None if it wasn't saved.
+        """
+        self.logger.debug("Result for %s: %s" % (msg, response))
+        if json.loads(response)['result'] == "ERROR":
+            return None
+        if not os.path.exists(msg['args']):
+            return None
+        return msg['args']
+
+    def screenshot_file(self, dest_dir, fname, store=None, pack=None):
         """ 
         If fname is valid, it creates a file with fname in dest_dir. If fname 
         is invalid or not passed, it creates a file with file's md5. All 
@@ -241,113 +437,195 @@ class Extension:
         Return value is a dictionary {'md5': md5, 'exists': True/False} or
         {'file': fname, 'exists': True/False}. 'exists' indicates if a file 
         with the name already existed. New file is not created in this 
-        scenario. 
+        scenario. If store is given and fname isn't, the file goes into that
+        BlobStore instead of dest_dir. If pack is given, the file is appended
+        to that PackWriter instead, see screenshotpool.pack_screenshot().
+        
+        The compression happens in this process. See screenshotpool for 
+        doing it in the background.
         """
-        temp_fname = os.uname()[1] + '_' + str(self.port) + '.png'
-        temp_path = os.path.join(crawlglobs.tmp_dir, temp_fname)
-        nq8_temp_path = temp_path.split('.png')[0] + '-nq8.png'
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-        if os.path.exists(nq8_temp_path):
-            os.remove(nq8_temp_path)
-        self.logger.debug("Removed temp files for screenshot")
-        msg = {'command': 'SAVE_SCREENSHOT_FILE', 'args': temp_path}
-        response = self.send_and_recv(json.dumps(msg))
-        self.logger.debug("Result for %s: %s" % (msg, response))
-        if json.loads(response)['result'] == "ERROR":
+        temp_path = self.screenshot_raw()
+        if temp_path is None:
             return None
-        self.wait_for_file_creation(temp_path)
-        if os.path.exists(temp_path):
-            compress_process_returncode = subprocess.call(['pngnq', 
-                                                           temp_path])
-        self.wait_for_file_creation(nq8_temp_path)
-        self.logger.debug("Created compressed pngnq screenshot")
-        if os.path.exists(nq8_temp_path):
-            if not fname:
-                md5 = self.file_md5(nq8_temp_path)
-                md5_name = md5 + '.png'
-                dest_path = os.path.join(dest_dir, md5_name)
-            elif fname[-4:] != '.png':
-                fname += '.png'
-                dest_path= os.path.join(dest_dir, fname)
-            else:
-                dest_path = os.path.join(dest_dir, fname)
-        if os.path.exists(dest_path):
-            if fname:
-                return {'file': fname, 'exists': True}
-            else:
-                return {'md5': md5, 'exists': True}
-        else:
-            store_tmp_path = os.path.join(dest_dir, temp_fname)
-            shutil.move(nq8_temp_path, store_tmp_path)
-            shutil.move(store_tmp_path, dest_path)
-            if fname:
-                return {'file': fname, 'exists': False}
-            else:
-                return {'md5':md5, 'exists':False}
+        if pack:
+            compressed = screenshotpool.store_screenshot(temp_path, dest_dir,
+                                                         fname, 
+                                                         compress_only=True)
+            return screenshotpool.pack_screenshot(pack, compressed, dest_dir,
+                                                  fname)
+        store_root = None
+        if store:
+            store_root = store.root
+        return screenshotpool.store_screenshot(temp_path, dest_dir, fname,
+                                               store_root)
+
+    def html_file(self, dest_dir, fname, keep_html=False, store=None, 
+                  pack=None):
+        """
+        Same as screenshot_file, except for .html files. The HTML is 
+        streamed off the socket into a temporary file in dest_dir and hashed
+        on the way, then renamed into place. Returns a tuple (result, html)
+        where result is the dictionary described in screenshot_file(), or 
+        None on error. html is the page's HTML if keep_html is set, 
+        otherwise None.
+
+        If pack is given, the file is appended to that PackWriter as a 'dom'
+        record instead. The key is the path the file would have had, or 
+        <md5>.html, and result also gets the 'pack', 'offset' and 'length' 
+        of the record.
+        """
+        (target, existing) = self.html_target(dest_dir, fname, store, pack)
+        if existing:
+            # Nothing to save. Only fetch the HTML if the caller wants it.
+            html = None
+            if keep_html:
+                html = self.html()
+            return (existing, html)
+        sink = self.html_sink(target[0], keep_html)
+        msg = {'command': 'GET_HTML', 'args':''}
+        try:
+            try:
+                self.send_and_recv(self.encode(msg), sink=sink)
+            finally:
+                sink.close()
+            return self.store_html(sink, target, store, pack)
+        except:
+            # Don't leave the partial file behind in the output directory.
+            sink.discard()
+            raise
+
+    def html_target(self, dest_dir, fname, store=None, pack=None):
+        """
+        Returns ((directory, fname, pack_dest_dir), existing) for saving the
+        HTML as html_file() does. existing is the result for a file that 
+        already exists, in which case there is nothing to save.
+        """
+        pack_dest_dir = dest_dir
+        if pack:
+            dest_dir = crawlglobs.tmp_dir
+        elif store and not fname:
+            dest_dir = store.tmp_dir()
+        if fname and fname[-5:] != ".html":
+            fname += '.html'
+        existing = None
+        if (fname and not pack and 
+            os.path.exists(os.path.join(dest_dir, fname))):
+            existing = {'file': fname, 'exists': True}
+        return ((dest_dir, fname, pack_dest_dir), existing)
 
-    def html_file(self, dest_dir, fname):
+    def html_sink(self, dest_dir, keep_html):
         """
-        Same as screenshot_file, except for .html files.
+        Returns an HTMLSink for streaming the HTML into a temporary file in
+        dest_dir.
         """
-        temp_fname = os.uname()[1] + '_' + str(self.port) + '.html'
-        temp_path = os.path.join(crawlglobs.tmp_dir, temp_fname)
-        if os.path.exists(temp_path):
+        temp_fname = '.%s_%s.html.part' % (os.uname()[1], self.tag())
+        return HTMLSink(os.path.join(dest_dir, temp_fname), keep_html)
+
+    def store_html(self, sink, target, store=None, pack=None):
+        """
+        Moves the HTML streamed into sink, see html_sink(), to its place. 
+        Returns (result, html) as html_file() does.
+        """
+        (dest_dir, fname, pack_dest_dir) = target
+        temp_path = sink.temp_path
+        md5 = sink.md5
+        if not sink.has_html():
+            self.logger.debug("No HTML to save for the page")
             os.remove(temp_path)
-        msg = {'command': 'SAVE_HTML_FILE', 'args':temp_path}
-        response = self.send_and_recv(json.dumps(msg))
-        self.wait_for_file_creation(temp_path)
-        self.logger.debug("Result for %s: %s" % (msg, response))
-        if json.loads(response)['result'] == "ERROR":
-            return None
-        md5 = None
-        if not fname:
-            md5 = self.file_md5(temp_path)
-            md5_name = md5 + '.html'
-            dest_path = os.path.join(dest_dir, md5_name)
-        else:
-            if fname[-5:] != ".html": 
-                fname += '.html'
+            return (None, None)
+        html = sink.html()
+        if fname:
             dest_path = os.path.join(dest_dir, fname)
-        if os.path.exists(dest_path):
-            if md5:
-                return {'md5':md5, 'exists':True}
-            else:
-                return {'file': fname, 'exists': True}
+            result = {'file': fname}
         else:
-            store_tmp_path = os.path.join(dest_dir, temp_fname)
-            shutil.move(temp_path, store_tmp_path)
-            shutil.move(store_tmp_path, dest_path)
-            if md5:
-                return {'md5': md5, 'exists': False}
+            dest_path = os.path.join(dest_dir, md5.hexdigest() + '.html')
+            result = {'md5': md5.hexdigest()}
+        if pack:
+            if fname:
+                key = os.path.join(pack_dest_dir, fname)
+            else:
+                key = md5.hexdigest() + '.html'
+            if pack.has_key('dom', key):
+                os.remove(temp_path)
+                result['exists'] = True
             else:
-                return {'file': fname, 'exists': False}
+                result.update(pack.append_file('dom', key, temp_path))
+                result['exists'] = False
+        elif store and not fname:
+            result['exists'] = store.put(temp_path, md5.hexdigest(), 'html')
+        elif os.path.exists(dest_path):
+            os.remove(temp_path)
+            result['exists'] = True
+        else:
+            # Same directory, so this is a single atomic rename.
+            os.rename(temp_path, dest_path)
+            result['exists'] = False
+        return (result, html)
 
     def page_loaded(self):
         """
         Returns whether page dom has been loaded.
         """
         msg = {'command': 'HAS_PAGE_LOADED', 'args':''}
-        response = json.loads(self.send_and_recv(json.dumps(msg)))
+        response = json.loads(self.send_and_recv(self.encode(msg)))
         return response['result']
 
-    def wait_for_load(self, poll_interval=1, timeout=10, method=time.sleep):
+    def wait_for_event(self, events, timeout):
+        """
+        Blocks until the extension pushes one of events ('load', 'error',
+        'idle'), or for at most timeout seconds. Returns the name of the
+        event, or None on timeout. Events that already happened during this
+        visit return immediately. Raises ExtensionError if the extension
+        fails the command, so that it isn't taken for a page timeout.
+        """
+        msg = {'command': 'WAIT_FOR_EVENT', 
+               'args': {'events': list(events), 
+                        'timeout': int(timeout * 1000)}}
+        response = json.loads(self.send_and_recv(
+                                    self.encode(msg), 
+                                    timeout + config.EXT_EVENT_GRACE))
+        return self.event_result(response)
+
+    def event_result(self, response):
+        """
+        Returns the result of wait_for_event() for the extension's response.
+        """
+        if response['result'] == "ERROR":
+            raise ExtensionError("Waiting for page events failed: %s"
+                                 % response.get('message'))
+        if response['result'] == "timeout":
+            return None
+        return response['result']
+
+    def set_load_policy(self, idle_time, idle_cap):
         """
-        Waits until timeout for the page to load. Gives up if the page still
-        doesn't load.
+        Sets the completion policy used for the 'settled' event: the page
+        has loaded and no request was in flight for idle_time seconds, or 
+        idle_cap seconds have passed since DOMContentLoaded. An idle_cap of
+        0 disables the cap.
         """
-        test = lambda : True if self.page_loaded() == "True" else False
-        waittime = 0
-        while waittime <= timeout and not test():
-            method(poll_interval)
-            waittime += poll_interval
+        msg = {'command': 'SET_LOAD_POLICY', 
+               'args': [int(idle_time * 1000), int(idle_cap * 1000)]}
+        return json.loads(self.send_and_recv(self.encode(msg)))
+
+    def wait_for_load(self, timeout=config.PAGE_TIMEOUT, policy='onload'):
+        """
+        Waits until timeout for the page to load or fail. Returns as soon 
+        as the extension reports either. With the 'idle' policy, the page 
+        counts as loaded once it has settled, see set_load_policy(). Returns
+        the event name ('load', 'settled' or 'error'), or None if the page 
+        still didn't load. Raises ExtensionError as wait_for_event() does.
+        """
+        if policy == 'idle':
+            return self.wait_for_event(('settled', 'error'), timeout)
+        return self.wait_for_event(('load', 'error'), timeout)
 
     def page_error(self):
         """
         Returns if the page is a FF error page.
         """
         msg = {'command':'IS_PAGE_ERROR', 'args':''}
-        response = json.loads(self.send_and_recv(json.dumps(msg)))
+        response = json.loads(self.send_and_recv(self.encode(msg)))
         if response['result'] == "True":
             return True
         else:
@@ -359,5 +637,69 @@ class Extension:
         the eval.
         """
         msg = {'command': 'EVAL_JS', 'args': js}
-        response = json.loads(self.send_and_recv(json.dumps(msg)))
-        return response['result']
\ No newline at end of file
+        response = json.loads(self.send_and_recv(self.encode(msg)))
+        return response['result']
+
+    def collect_visit(self, evals=None):
+        """
+        Returns everything recorded about the current visit in a single
+        round trip, as a dictionary with keys 'loaded', 'error' (booleans),
+        'error_code' (the code of Firefox's network error page, like
+        'proxyConnectFailure', or ''), 'redirects' (list of URLs), 
+        'headers' ({url: {header: value}}), 'response_codes' 
+        ({url: response_code}) and 'eval_results' (results of the JS 
+        snippets in evals, in order). Returns None if the extension reports
+        an error.
+        """
+        msg = {'command': 'COLLECT_VISIT', 'args': evals or []}
+        response = self.safe_decode(self.send_and_recv(self.encode(msg)))
+        if response.get('result') == "ERROR":
+            self.logger.error("Collecting visit failed: %s" 
+                              % response.get('message'))
+            return None
+        return response
+
+
+class HTMLSink:
+    """Writes the chunks of a GET_HTML reply into temp_path, hashing them on
+    the way. Keeps the HTML in memory as well if keep_html is set.
+    """
+    def __init__(self, temp_path, keep_html=False):
+        self.temp_path = temp_path
+        self.keep_html = keep_html
+        self.md5 = hashlib.md5()
+        self.kept = []
+        # The extension replies with a JSON error instead of the HTML if the
+        #    page has none. Keep the start of the reply to recognize it, 
+        #    which may take more than one chunk.
+        self.head = ''
+        self.fh = open(temp_path, 'wb')
+
+    def __call__(self, chunk):
+        missing = len(Extension.HTML_ERROR_PREFIX) - len(self.head)
+        if missing > 0:
+            self.head += chunk[:missing]
+        self.fh.write(chunk)
+        self.md5.update(chunk)
+        if self.keep_html:
+            self.kept.append(chunk)
+
+    def close(self):
+        self.fh.close()
+
+    def discard(self):
+        """Closes and removes the temporary file, after a failure.
+        """
+        self.fh.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+    def has_html(self):
+        return bool(self.head) and self.head != Extension.HTML_ERROR_PREFIX
+
+    def html(self):
+        """Returns the HTML if keep_html is set, otherwise None.
+        """
+        if not self.keep_html:
+            return None
+        return ''.join(self.kept)
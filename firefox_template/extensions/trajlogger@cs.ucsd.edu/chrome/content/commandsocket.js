@@ -1,6 +1,24 @@
 /*
  * Server that listens for TCP connections.
  *
+ * Connections are persistent. Every message in either direction is a frame
+ * of the form:
+ *
+ *     <decimal byte length of body>\n<UTF-8 encoded body>
+ *
+ * The body of a request frame is a JSON encoded command of the form
+ * {"command": ..., "args": ...}, and the body of the reply frame is the
+ * string returned by TrajLogging.LIB.handleCommand(). A client may send any
+ * number of commands over the same connection. Once tabs were opened with
+ * OPEN_TABS, a command with a "tab" id is run for that tab only.
+ *
+ * Clients that send a bare JSON command (no length header) get the old
+ * behaviour: a single unframed reply, after which the connection is closed.
+ *
+ * WAIT_FOR_EVENT is the only command that is not answered right away. Its
+ * reply is pushed to the client when one of the requested events ("load",
+ * "error", "idle", "settled") fires, or when the timeout runs out. See waitForEvent().
+ *
  *
  * Author: grier@imchris.org
  *         nchachra@cs.ucsd.edu
@@ -11,60 +29,44 @@ TrajLogging.ns(function() {
         _serverSocket : 0,
         _serverPort : 7055,
 
+        /*
+         * Connections that are currently open. See Connection below.
+         */
+        _connections : [],
+
+        /*
+         * Clients blocked in WAIT_FOR_EVENT. Each entry is an object with
+         * the connection, the list of events it waits for and its timer.
+         */
+        _waiters : [],
+
+        /*
+         * A single client connection. Reads frames as they arrive, hands the
+         * commands to LIB and writes back a reply frame for each.
+         */
+        Connection : function(transport) {
+            this.transport = transport;
+            this.outputStream = transport.openOutputStream(0, 0, 0);
+            this.inputStream = transport.openInputStream(0, 0, 0);
+            // Raw bytes received, but not yet handled.
+            this.buffer = "";
+            this.closed = false;
+        },
+
         serverStart : function() {
-            var lib = TrajLogging.LIB;
+            var command = this;
             // Listener for performing actions when a connection is
             // established.
             var listener = {
                 onSocketAccepted : function(socket, transport) {
                     try {
-                        var outputStream = transport.openOutputStream(0, 0, 0);
-
-                        var inputStream = transport.openInputStream(0, 0, 0);
-                        var instream = Components
-                              .classes["@mozilla.org/scriptableinputstream;1"]
-                              .createInstance(Components.interfaces
-                              .nsIScriptableInputStream);
-                        instream.init(inputStream);
-
-                        var inputString = "";
-                        while(inputString == "") {
-                            inputString += instream.read(instream.available());
-                        }
-                        // the input command should be JSON
-                        lib.log("INFO", "Received: " + inputString);
-                        var command = JSON.parse(inputString);
-
-                        // handle the command
-                        lib.log("INFO", "Handing " + command);
-                        var outputString =lib.handleCommand(command['command'],
-                                                              command['args']);
-                        // report the results
-                        lib.log("INFO", "Sending: " + outputString);
-                        tot = 0;
-                        len = outputString.length;
-                        while(tot < len) {
-                            try {
-                                n = outputStream.write(outputString
-                                                .substring(tot), (len - tot));
-                                tot += n;
-                            } catch(e) {
-                                if(e.name == "NS_BASE_STREAM_WOULD_BLOCK") {
-                                    lib.log("ERROR", 
-                                                   "Blocking exc, continuing");
-                                } else {
-                                    lib.log("ERROR", 
-                                            "Unknown exc: " + e.name + 
-                                            " Message: " + e.toString());
-                                    //throw e;
-                                }
-                            }
-                        }
-                        outputStream.close();
-                    } catch(ex2) {
-                        TrajLogging.LIB.log("ERROR", "Exception: " + 
-                                            ex2.name + " Message: " + 
-                                            e.toString());
+                        var conn = new command.Connection(transport);
+                        command._connections.push(conn);
+                        conn.start();
+                    } catch(ex) {
+                        TrajLogging.LIB.log("ERROR", "Exception: " +
+                                            ex.name + " Message: " +
+                                            ex.toString());
                     }
                 },
                 onStopListening : function(socket, status) {
@@ -91,19 +93,261 @@ TrajLogging.ns(function() {
                 this._serverSocket.close();
         },
         /*
-         * Starts server on portnum.
+         * Starts server on portnum. Connections that are already open are
+         * left alone so the reply to SET_PORT can still be sent.
          */
         serverUsePort : function(portnum) {
             this.serverStop();
             this._serverPort = parseInt(portnum);
             this.serverStart();
         },
+        /*
+         * Forgets about a connection that has been closed.
+         */
+        removeConnection : function(conn) {
+            var i = this._connections.indexOf(conn);
+            if(i != -1) {
+                this._connections.splice(i, 1);
+            }
+            for(i = this._waiters.length - 1; i >= 0; i--) {
+                if(this._waiters[i].conn === conn) {
+                    this._waiters[i].timer.cancel();
+                    this._waiters.splice(i, 1);
+                }
+            }
+        },
+        /*
+         * Replies to conn with the first of events that fires for the visit
+         * tracked by lib, or with "timeout" after timeout milliseconds. 
+         * Events that already fired during this visit are answered 
+         * immediately.
+         */
+        waitForEvent : function(conn, events, timeout, lib) {
+            for(var i = 0; i < events.length; i++) {
+                if(lib.hasEventFired(events[i])) {
+                    conn.sendFrame('{"result":"' + events[i] + '"}');
+                    return;
+                }
+            }
+            var command = this;
+            var waiter = {
+                conn : conn,
+                lib : lib,
+                events : events,
+                timer : Components.classes["@mozilla.org/timer;1"]
+                                  .createInstance(Components.interfaces
+                                  .nsITimer)
+            };
+            this._waiters.push(waiter);
+            waiter.timer.initWithCallback({
+                notify : function(timer) {
+                    command.resolveWaiter(waiter, "timeout");
+                }
+            }, timeout, Components.interfaces.nsITimer.TYPE_ONE_SHOT);
+        },
+        /*
+         * Pushes eventName of the visit tracked by lib, by default LIB, to
+         * every client waiting for it.
+         */
+        notify : function(eventName, lib) {
+            if(!lib) {
+                lib = TrajLogging.LIB;
+            }
+            var waiters = this._waiters.slice();
+            for(var i = 0; i < waiters.length; i++) {
+                if(waiters[i].lib === lib &&
+                   waiters[i].events.indexOf(eventName) != -1) {
+                    this.resolveWaiter(waiters[i], eventName);
+                }
+            }
+        },
+        /*
+         * Sends the reply for a waiter and forgets about it.
+         */
+        resolveWaiter : function(waiter, result) {
+            var i = this._waiters.indexOf(waiter);
+            if(i == -1)
+                return;
+            this._waiters.splice(i, 1);
+            waiter.timer.cancel();
+            waiter.conn.sendFrame('{"result":"' + result + '"}');
+        },
         init : function() {
+            // The crawler passes the port to listen on in the environment.
+            //     See browser.py.
+            var env = Components.classes["@mozilla.org/process/environment;1"]
+                        .getService(Components.interfaces.nsIEnvironment);
+            if(env.exists("STALLONE_EXT_PORT")) {
+                this._serverPort = parseInt(env.get("STALLONE_EXT_PORT"));
+            }
             this.serverStart();
         },
         uninit : function() {
             TrajLogging.LIB.log("INFO", "Server stopped.");
             this.serverStop();
+            while(this._connections.length) {
+                this._connections[0].close();
+            }
+        }
+    };
+
+    TrajLogging.Command.Connection.prototype = {
+        /*
+         * Starts reading asynchronously from the connection.
+         */
+        start : function() {
+            var pump = Components
+                        .classes["@mozilla.org/network/input-stream-pump;1"]
+                        .createInstance(Components.interfaces
+                        .nsIInputStreamPump);
+            pump.init(this.inputStream, -1, -1, 0, 0, false);
+            pump.asyncRead(this, null);
+        },
+
+        onStartRequest : function(request, context) {
+        },
+
+        onStopRequest : function(request, context, status) {
+            this.close();
+        },
+
+        onDataAvailable : function(request, context, inputStream, offset,
+                                   count) {
+            var binStream = Components
+                            .classes["@mozilla.org/binaryinputstream;1"]
+                            .createInstance(Components.interfaces
+                            .nsIBinaryInputStream);
+            binStream.setInputStream(inputStream);
+            this.buffer += binStream.readBytes(count);
+            try {
+                this.processBuffer();
+            } catch(e) {
+                TrajLogging.LIB.log("ERROR", "Exception: " + e.name +
+                                    " Message: " + e.toString());
+                this.close();
+            }
+        },
+
+        /*
+         * Handles every complete frame in the buffer. Old style clients are
+         * recognized by a bare JSON command in place of the length header.
+         */
+        processBuffer : function() {
+            var lib = TrajLogging.LIB;
+            if(this.buffer.charAt(0) == "{") {
+                var command;
+                try {
+                    command = JSON.parse(this.buffer);
+                } catch(e) {
+                    // Wait for the rest of the command.
+                    return;
+                }
+                this.buffer = "";
+                this.write(this.handle(command));
+                this.close();
+                return;
+            }
+            while(!this.closed) {
+                var newline = this.buffer.indexOf("\n");
+                if(newline == -1)
+                    return;
+                var len = parseInt(this.buffer.substring(0, newline));
+                if(isNaN(len)) {
+                    lib.log("ERROR", "Malformed frame header: " +
+                            this.buffer.substring(0, newline));
+                    this.close();
+                    return;
+                }
+                if(this.buffer.length < newline + 1 + len)
+                    return;
+                var body = this.buffer.substr(newline + 1, len);
+                this.buffer = this.buffer.substring(newline + 1 + len);
+                var command = JSON.parse(lib.fromUTF8(body));
+                if(command['command'] == "WAIT_FOR_EVENT") {
+                    // Args are {"events": [...], "timeout": milliseconds}
+                    var state = lib.stateForTab(command['tab']);
+                    if(!state) {
+                        this.sendFrame(lib.getErrorJSONString("No tab " +
+                                                              command['tab']));
+                        continue;
+                    }
+                    TrajLogging.Command.waitForEvent(this,
+                                                     command['args']['events'],
+                                                     command['args']['timeout'],
+                                                     state);
+                    continue;
+                }
+                this.sendFrame(this.handle(command));
+            }
+        },
+
+        /*
+         * Runs the command and returns the reply string.
+         */
+        handle : function(command) {
+            var lib = TrajLogging.LIB;
+            lib.log("INFO", "Received: " + command['command']);
+            // Commands with a tab id are run for that tab. See LIB.tabs.
+            var state = lib.stateForTab(command['tab']);
+            if(!state) {
+                return lib.getErrorJSONString("No tab " + command['tab']);
+            }
+            var outputString = state.handleCommand(command['command'],
+                                                   command['args']);
+            if(outputString === undefined || outputString === null) {
+                outputString = lib.getErrorJSONString("Unknown command: " +
+                                                      command['command']);
+            }
+            return outputString;
+        },
+
+        /*
+         * Writes outputString as a single UTF-8 encoded frame.
+         */
+        sendFrame : function(outputString) {
+            if(this.closed)
+                return;
+            var body = TrajLogging.LIB.toUTF8(outputString);
+            this.write(body.length + "\n" + body);
+        },
+
+        /*
+         * Writes the string to the socket, retrying when the non-blocking
+         * stream would block.
+         */
+        write : function(outputString) {
+            var lib = TrajLogging.LIB;
+            var tot = 0;
+            var len = outputString.length;
+            while(tot < len) {
+                try {
+                    var n = this.outputStream.write(outputString
+                                                    .substring(tot),
+                                                    (len - tot));
+                    tot += n;
+                } catch(e) {
+                    if(e.name == "NS_BASE_STREAM_WOULD_BLOCK") {
+                        lib.log("ERROR", "Blocking exc, continuing");
+                    } else {
+                        lib.log("ERROR", "Unknown exc: " + e.name +
+                                " Message: " + e.toString());
+                        this.close();
+                        return;
+                    }
+                }
+            }
+        },
+
+        close : function() {
+            if(this.closed)
+                return;
+            this.closed = true;
+            try {
+                this.inputStream.close();
+                this.outputStream.close();
+            } catch(e) {
+            }
+            TrajLogging.Command.removeConnection(this);
         }
-    }
+    };
 });
@@ -36,6 +36,11 @@ TrajLogging.ns(function() {
                         lib.log("ERROR", 'Non-http request ' + subject.name);
                         return;
                     }
+                    // The state of the tab that made the request.
+                    lib = lib.stateForChannel(subject);
+                    if(!lib) {
+                        return;
+                    }
 
                     if((topic == "http-on-examine-response") || 
                         (topic == "http-on-examine-cached-response")) {
@@ -43,6 +48,7 @@ TrajLogging.ns(function() {
                                                .nsIHttpChannel);
                         lib.addResponseStatus(subject.name, 
                                               subject.responseStatus);
+                        lib.requestFinished(subject);
 
                         // Handle 30X headers
                         response = String(subject.responseStatus);
@@ -80,8 +86,7 @@ TrajLogging.ns(function() {
                                     redirectHeader.tail = tail;
                                     redirectHeader.chain = [head];
 
-                                    TrajLogging.LIB.redirectsHeaders
-                                                        .push(redirectHeader);
+                                    lib.redirectsHeaders.push(redirectHeader);
                                 }
                             }
                         }
@@ -91,6 +96,7 @@ TrajLogging.ns(function() {
                                        this.headerVisitor.theHeaders);
                         this.headerVisitor.clearheaders();
                     } else if(topic == "http-on-modify-request") {
+                        lib.requestStarted(subject);
                         for(var i in lib.requestHeaders) {
                             subject.setRequestHeader(i, lib.requestHeaders[i], 
                                                     false);
@@ -84,6 +84,38 @@ TrajLogging.LIB = {
      */
     pageError: false,
     
+    /*
+     * Number of HTTP requests of this visit that have started but not yet
+     * received a response. Maintained by httpobserver.js and webprogress.js
+     * through requestStarted() and requestFinished().
+     */
+    inFlight: 0,
+
+    /*
+     * Incremented on every reset. Requests are tagged with the visit they
+     * started in so that stragglers from an old visit aren't counted.
+     */
+    visitId: 0,
+
+    /*
+     * Completion policy for the visit, set with SET_LOAD_POLICY. A visit is
+     * settled once the page has loaded and no request has been in flight
+     * for idleTime milliseconds, or cap milliseconds after DOMContentLoaded,
+     * whichever comes first. A cap of 0 means no cap.
+     */
+    loadPolicy: {idleTime: 0, cap: 0},
+
+    /*
+     * Set when the visit is settled according to loadPolicy.
+     */
+    settled: false,
+
+    /*
+     * nsITimers for the idle window and the cap of loadPolicy.
+     */
+    idleTimer: null,
+    capTimer: null,
+
     /*
      * Calculated using toolbar.google.com's API. Not in use.
      */
@@ -106,6 +138,21 @@ TrajLogging.LIB = {
      */
     customPrefs: [],
 
+    /*
+     * The tab whose visit this object tracks, or null for the selected tab.
+     * Only set for the tab states made by openTabs().
+     */
+    tab: null,
+
+    /*
+     * States of the tabs opened with OPEN_TABS, in the order of their ids.
+     * Each one is an object inheriting from LIB with its own copy of the 
+     * visit's state, so the commands below work on the tab they are sent
+     * for. Empty unless the crawler uses several tabs, in which case every
+     * request and event is attributed to the tab it belongs to.
+     */
+    tabs: [],
+
     /*
      * Init is the first function to be called. Any components should be
      * initialized here.
@@ -143,11 +190,20 @@ TrajLogging.LIB = {
         this.htmlString = "";
         this.pageLoaded = false;
         this.pageError = false;
+        this.inFlight = 0;
+        this.visitId++;
+        this.loadPolicy = {idleTime: 0, cap: 0};
+        this.clearSettled();
         this.pagerank = -1;
         this.pagerankRequest = null;
         this.requestHeaders = {};
 
         TrajLogging.Pageranker.init();
+        if (this.tab) {
+            // Prefs and the proxy are shared by all tabs. They are only 
+            //     reset for the whole browser.
+            return;
+        }
         // Custom prefs need to be cleared before the array can be reset.
         this.clearCustomPrefs();
         this.customPrefs = [];
@@ -155,6 +211,221 @@ TrajLogging.LIB = {
         this.handleCommand("DISABLE_PROXY");
     },
 
+    /*
+     * Replaces the tab states with num new ones. The first uses the 
+     * selected tab, the others new tabs.
+     */
+    openTabs: function(num) {
+        for (var i = 0; i < this.tabs.length; i++) {
+            this.tabs[i].clearSettled();
+            if (i > 0) {
+                gBrowser.removeTab(this.tabs[i].tab);
+            }
+        }
+        this.tabs = [];
+        for (var i = 0; i < num; i++) {
+            var tab = gBrowser.selectedTab;
+            if (i > 0) {
+                tab = gBrowser.addTab("about:blank");
+            }
+            var state = Object.create(this);
+            state.tab = tab;
+            // Everything reset() doesn't replace.
+            state.idleTimer = null;
+            state.capTimer = null;
+            state.customPrefs = [];
+            state.reset();
+            this.tabs.push(state);
+        }
+    },
+
+    /*
+     * Returns the state of the tab with id tabId, this if tabId is not 
+     * given, or null if there is no such tab.
+     */
+    stateForTab: function(tabId) {
+        if (tabId === undefined || tabId === null) {
+            return this;
+        }
+        return this.tabs[tabId] || null;
+    },
+
+    /*
+     * Returns the state of the tab showing win or one of its frames. Without
+     * tabs that is always this. Returns null if win belongs to no tab.
+     */
+    stateForWindow: function(win) {
+        if (!this.tabs.length) {
+            return this;
+        }
+        try {
+            var top = win.top;
+            for (var i = 0; i < this.tabs.length; i++) {
+                if (this.tabs[i].contentWindow() == top) {
+                    return this.tabs[i];
+                }
+            }
+        } catch(e) {
+        }
+        return null;
+    },
+
+    /*
+     * Returns the state of the tab that made the HTTP request channel. See
+     * stateForWindow().
+     */
+    stateForChannel: function(channel) {
+        if (!this.tabs.length) {
+            return this;
+        }
+        var callbacks = channel.notificationCallbacks;
+        if (!callbacks && channel.loadGroup) {
+            callbacks = channel.loadGroup.notificationCallbacks;
+        }
+        try {
+            var loadContext = callbacks.getInterface(Components.interfaces
+                                                     .nsILoadContext);
+            return this.stateForWindow(loadContext.associatedWindow);
+        } catch(e) {
+            return null;
+        }
+    },
+
+    /*
+     * Returns the <browser> of the tab.
+     */
+    browser: function() {
+        if (this.tab) {
+            return gBrowser.getBrowserForTab(this.tab);
+        }
+        return gBrowser.selectedBrowser;
+    },
+
+    /*
+     * Returns the content window of the tab.
+     */
+    contentWindow: function() {
+        return this.browser().contentWindow;
+    },
+
+    /*
+     * Wipes what earlier visits left in the browser, so that the next visit
+     * sees a fresh profile without restarting Firefox: other windows and
+     * tabs, session history and session storage (by replacing the tab),
+     * cookies and local storage, the cache, history, offline data, HTTP 
+     * auth and site permissions. Then checks that no cookies, permissions,
+     * history or extra windows and tabs are left. Returns a list of what 
+     * couldn't be cleared, which is empty on success.
+     */
+    clearState: function() {
+        var Cc = Components.classes;
+        var Ci = Components.interfaces;
+        var failed = [];
+        // Close every other browser window, and every other tab of this
+        //     one. The fresh tab comes with empty session history and 
+        //     session storage.
+        var mediator = Cc["@mozilla.org/appshell/window-mediator;1"]
+                            .getService(Ci.nsIWindowMediator);
+        var windows = mediator.getEnumerator(null);
+        while (windows.hasMoreElements()) {
+            var win = windows.getNext();
+            if (win != window) {
+                win.close();
+            }
+        }
+        var fresh = gBrowser.addTab("about:blank");
+        gBrowser.selectedTab = fresh;
+        gBrowser.removeAllTabsBut(fresh);
+        // The same items as Clear Recent History. Clearing cookies clears
+        //     local storage too.
+        var scope = {};
+        try {
+            Cc["@mozilla.org/moz/jssubscript-loader;1"]
+                .getService(Ci.mozIJSSubScriptLoader)
+                .loadSubScript("chrome://browser/content/sanitize.js", scope);
+        } catch(e) {
+            this.log("ERROR", "Can't load the sanitizer: " + e.toString());
+        }
+        var items = ["cache", "cookies", "offlineApps", "history", 
+                     "formdata", "downloads", "sessions", "siteSettings"];
+        for (var i = 0; i < items.length; i++) {
+            try {
+                var item = new scope.Sanitizer().items[items[i]];
+                if (item.canClear) {
+                    item.clear();
+                }
+            } catch(e) {
+                this.log("ERROR", "Clearing " + items[i] + " failed: " +
+                         e.toString());
+            }
+        }
+        // Whether or not the sanitizer worked, clear the things that are 
+        //     checked below directly.
+        var cookies = Cc["@mozilla.org/cookiemanager;1"]
+                        .getService(Ci.nsICookieManager);
+        var permissions = Cc["@mozilla.org/permissionmanager;1"]
+                            .getService(Ci.nsIPermissionManager);
+        var history = Cc["@mozilla.org/browser/nav-history-service;1"]
+                        .getService(Ci.nsINavHistoryService);
+        try {
+            cookies.removeAll();
+            permissions.removeAll();
+            history.QueryInterface(Ci.nsIBrowserHistory).removeAllPages();
+        } catch(e) {
+            this.log("ERROR", "Clearing state failed: " + e.toString());
+        }
+        // Verify
+        if (cookies.enumerator.hasMoreElements()) {
+            failed.push("cookies");
+        }
+        if (permissions.enumerator.hasMoreElements()) {
+            failed.push("permissions");
+        }
+        if (history.hasHistoryEntries) {
+            failed.push("history");
+        }
+        windows = mediator.getEnumerator(null);
+        var numWindows = 0;
+        while (windows.hasMoreElements()) {
+            windows.getNext();
+            numWindows++;
+        }
+        // Closed windows may take a moment to go away, so only this 
+        //     window's tabs are checked strictly.
+        if (gBrowser.tabs.length != 1) {
+            failed.push("tabs");
+        }
+        if (numWindows > 1) {
+            this.log("INFO", numWindows + " windows still open.");
+        }
+        return failed;
+    },
+
+    /*
+     * Returns the UTF-8 encoded byte string for the unicode string aString.
+     * Used for writing frames on the command socket.
+     */
+    toUTF8: function(aString) {
+        var converter = Components
+                    .classes["@mozilla.org/intl/scriptableunicodeconverter"]
+                    .createInstance(Components.interfaces
+                    .nsIScriptableUnicodeConverter);
+        converter.charset = "UTF-8";
+        return converter.ConvertFromUnicode(aString) + converter.Finish();
+    },
+
+    /*
+     * Inverse of toUTF8().
+     */
+    fromUTF8: function(aBytes) {
+        var converter = Components
+                    .classes["@mozilla.org/intl/scriptableunicodeconverter"]
+                    .createInstance(Components.interfaces
+                    .nsIScriptableUnicodeConverter);
+        converter.charset = "UTF-8";
+        return converter.ConvertToUnicode(aBytes);
+    },
+
     /*
      * Takes a message string and returns a JSON encoded string of the form:
      * '{"result": "ERROR", "message": aMessage}'
@@ -295,17 +566,159 @@ TrajLogging.LIB = {
         return JSON.stringify(chain);
     },
 
+    /*
+     * Returns the JSON encoded {url: {header: value}} string, building it
+     * only once per visit.
+     */
+    getHeaderString: function() {
+        if(this.headerString == '') {
+            var urlHeaderObj = {};
+            for(var url in this.urlInfo) {
+                urlHeaderObj[url] = this.urlInfo[url]["headers"];
+            }
+            this.headerString = JSON.stringify(urlHeaderObj);
+        }
+        return this.headerString;
+    },
+
+    /*
+     * Returns the JSON encoded {url: responsecode} string, building it only
+     * once per visit.
+     */
+    getResponsecodesString: function() {
+        if(this.responsecodesString == '') {
+            var tempObj = {};
+            for(var url in this.urlInfo) {
+                tempObj[url] = this.urlInfo[url]["responsecode"];
+            }
+            this.responsecodesString = JSON.stringify(tempObj);
+        }
+        return this.responsecodesString;
+    },
+
+    /*
+     * Serializes the page, including the contents of frames and iframes,
+     * into this.htmlString. The page is serialized only once per visit and
+     * the cached string is returned on later calls. Returns an empty string
+     * if the document has no HTML.
+     */
+    getHtmlString: function() {
+        if (this.htmlString == '') {
+            var doc = this.contentWindow().document;
+            if (!doc.documentElement || !doc.documentElement.innerHTML) {
+                return '';
+            }
+            var serializer = new XMLSerializer();
+            this.htmlString = serializer.serializeToString(doc);
+            var frames = doc.getElementsByTagName('frame');
+            var len = frames.length;
+            for(var i=0; i < len; i++) {
+                var srcVal = serializer.serializeToString(frames[i].src)
+                //get and add source name.
+                this.htmlString += '\n\n\n ' +
+                                '<!--Added for Trajectory. Src: ' +
+                                srcVal + '--> \n\n\n';
+            }
+            var iframes = doc.getElementsByTagName('iframe');
+            len = iframes.length;
+            for(var i=0; i < len; i++) {
+                var srcVal = iframes[i].contentDocument
+                                        .documentElement
+                                        .innerHTML
+                //get and add source name.
+                this.htmlString +=  '\n\n\n ' +
+                                    '<!--Added by Stallone. Src: ' +
+                                    '--> \n\n\n' + srcVal;
+            }
+        }
+        return this.htmlString;
+    },
+
     /*
      * Firefox displays a custom page with URI about:neterror if it fails
      * to reach a page due to network errors. This function checks for this
      * condition and updates the this.pageError variable. 
      */
     getPageError: function() {
-        if(content.document.documentURI.substr(0,14)=="about:neterror") {
+        var doc = this.contentWindow().document;
+        if(doc.documentURI.substr(0,14)=="about:neterror") {
             this.pageError = true;
         } else {
             this.pageError = false;
         }
+        return this.pageError;
+    },
+
+    /*
+     * Returns the error code Firefox put in the about:neterror URI, like
+     * "proxyConnectFailure", "proxyResolveFailure" or "netTimeout", or ""
+     * if the page isn't an error page.
+     */
+    getPageErrorCode: function() {
+        var doc = this.contentWindow().document;
+        var match = /^about:neterror\?(?:.*&)?e=([^&]*)/.exec(
+                                                        doc.documentURI);
+        if(!match) {
+            return "";
+        }
+        return decodeURIComponent(match[1]);
+    },
+
+    /*
+     * Evals the JS snippet and returns the result. Exceptions are returned
+     * as their string representation.
+     */
+    evalJS: function(js) {
+        var result;
+        // Snippets refer to the page as content.
+        var content = this.contentWindow();
+        try {
+            result = eval(js);
+            this.log("INFO", "eval results: " + result);
+            if (!result) {
+                result = "";
+            }
+        } catch(e) {
+            result = e.toString();
+        }
+        return result;
+    },
+
+    /*
+     * Returns an object with everything the crawler records about a visit:
+     * {
+     *     "loaded": true/false,
+     *     "error": true/false,
+     *     "error_code": see getPageErrorCode(),
+     *     "redirects": [url, url, ...],
+     *     "headers": {url: {header: value}},
+     *     "response_codes": {url: responsecode},
+     *     "eval_results": [result, result, ...]
+     * }
+     * evals is a list of JS snippets, evaluated in order.
+     */
+    collectVisit: function(evals) {
+        var headers = {};
+        var responseCodes = {};
+        for(var url in this.urlInfo) {
+            headers[url] = this.urlInfo[url]["headers"];
+            responseCodes[url] = this.urlInfo[url]["responsecode"];
+        }
+        var evalResults = [];
+        if(evals) {
+            for(var i = 0; i < evals.length; i++) {
+                evalResults.push(this.evalJS(evals[i]));
+            }
+        }
+        return {
+            "loaded": this.pageLoaded,
+            "error": this.getPageError(),
+            "error_code": this.getPageErrorCode(),
+            "redirects": JSON.parse(this.buildRedirectsString()),
+            "headers": headers,
+            "response_codes": responseCodes,
+            "eval_results": evalResults
+        };
     },
 
     /*
@@ -314,8 +727,161 @@ TrajLogging.LIB = {
      */
     setPageLoaded: function(e) {
         if (e.originalTarget instanceof HTMLDocument) {
-            TrajLogging.LIB.log("INFO", "Setting page loaded to true");
-            TrajLogging.LIB.pageLoaded = true;
+            var lib = TrajLogging.LIB.stateForWindow(e.originalTarget
+                                                     .defaultView);
+            if (!lib) {
+                return;
+            }
+            lib.log("INFO", "Setting page loaded to true");
+            lib.pageLoaded = true;
+            TrajLogging.Command.notify("load", lib);
+            if (lib.inFlight == 0) {
+                TrajLogging.Command.notify("idle", lib);
+                lib.startIdleTimer();
+            }
+        }
+    },
+
+    /*
+     * Forgets that the visit settled and stops the policy timers. Called
+     * on reset and whenever a new URL is loaded.
+     */
+    clearSettled: function() {
+        this.settled = false;
+        if (this.idleTimer) {
+            this.idleTimer.cancel();
+            this.idleTimer = null;
+        }
+        if (this.capTimer) {
+            this.capTimer.cancel();
+            this.capTimer = null;
+        }
+    },
+
+    /*
+     * Marks the visit settled and pushes the "settled" event.
+     */
+    settle: function() {
+        if (this.settled) {
+            return;
+        }
+        this.clearSettled();
+        this.settled = true;
+        TrajLogging.Command.notify("settled", this);
+    },
+
+    /*
+     * Returns a one-shot nsITimer that calls settle() after delay ms.
+     */
+    settleTimer: function(delay) {
+        var lib = this;
+        var timer = Components.classes["@mozilla.org/timer;1"]
+                              .createInstance(Components.interfaces.nsITimer);
+        timer.initWithCallback({
+            notify : function(aTimer) {
+                lib.settle();
+            }
+        }, delay, Components.interfaces.nsITimer.TYPE_ONE_SHOT);
+        return timer;
+    },
+
+    /*
+     * Starts the idle window of loadPolicy. Called when the page has loaded
+     * and the last in-flight request finished.
+     */
+    startIdleTimer: function() {
+        if (this.settled) {
+            return;
+        }
+        if (this.idleTimer) {
+            this.idleTimer.cancel();
+        }
+        this.idleTimer = this.settleTimer(this.loadPolicy.idleTime);
+    },
+
+    /*
+     * Called by webprogress.js on DOMContentLoaded of the top document.
+     * Starts the cap of loadPolicy.
+     */
+    domReady: function() {
+        if (this.settled || this.capTimer || !this.loadPolicy.cap) {
+            return;
+        }
+        this.capTimer = this.settleTimer(this.loadPolicy.cap);
+    },
+
+    /*
+     * Called by webprogress.js when a document finishes loading, whether it
+     * succeeded or not. Pushes the "error" event for network errors.
+     */
+    documentStopped: function() {
+        if (this.getPageError()) {
+            TrajLogging.Command.notify("error", this);
+        }
+    },
+
+    /*
+     * Returns whether eventName ("load", "error" or "idle") has already 
+     * happened during this visit.
+     */
+    hasEventFired: function(eventName) {
+        if (eventName === "load") {
+            return this.pageLoaded;
+        } else if (eventName === "error") {
+            return this.pageError;
+        } else if (eventName === "idle") {
+            return this.pageLoaded && this.inFlight == 0;
+        } else if (eventName === "settled") {
+            return this.settled;
+        }
+        return false;
+    },
+
+    /*
+     * Counts request as in flight. The request is tagged through its
+     * property bag, so that it is only counted once in requestFinished().
+     */
+    requestStarted: function(request) {
+        try {
+            var bag = request.QueryInterface(Components.interfaces
+                                             .nsIWritablePropertyBag2);
+            bag.setPropertyAsUint32("trajlogger.visit", this.visitId);
+            this.inFlight++;
+            // The page isn't idle anymore. Restart the idle window once
+            //     this request finishes.
+            if (this.idleTimer) {
+                this.idleTimer.cancel();
+                this.idleTimer = null;
+            }
+        } catch(e) {
+            // Requests without a property bag aren't tracked.
+        }
+    },
+
+    /*
+     * Stops counting request as in flight. Pushes "idle" if this was the
+     * last request of a loaded page.
+     */
+    requestFinished: function(request) {
+        var bag;
+        try {
+            bag = request.QueryInterface(Components.interfaces
+                                         .nsIWritablePropertyBag2);
+        } catch(e) {
+            return;
+        }
+        if (!bag.hasKey("trajlogger.visit")) {
+            return;
+        }
+        var visitId = bag.getPropertyAsUint32("trajlogger.visit");
+        bag.deleteProperty("trajlogger.visit");
+        if (visitId != this.visitId || this.inFlight == 0) {
+            return;
+        }
+        this.inFlight--;
+        if (this.inFlight == 0 && this.pageLoaded) {
+            TrajLogging.Command.notify("idle", this);
+            this.startIdleTimer();
         }
     },
 
@@ -366,40 +932,67 @@ TrajLogging.LIB = {
                 this.reset();
                 return '{"result":"DONE"}';
 
+            case "OPEN_TABS":
+                // Takes the number of tabs. Commands with a "tab" id are
+                //     then run for that tab. See tabs.
+                this.log("INFO", "Opening " + args + " tabs");
+                this.openTabs(parseInt(args));
+                return '{"result":"DONE"}';
+
+            case "CLEAR_STATE":
+                // See clearState(). Also does a RESET.
+                if (this.tabs.length) {
+                    return this.getErrorJSONString("Can't clear the state " +
+                                                   "of a browser with tabs");
+                }
+                this.log("INFO", "Clearing browser state");
+                this.reset();
+                try {
+                    var failed = this.clearState();
+                } catch(e) {
+                    var errorMsg = "Clearing state failed: " + e.toString();
+                    this.log("ERROR", errorMsg);
+                    return this.getErrorJSONString(errorMsg);
+                }
+                if (failed.length) {
+                    var errorMsg = "Not cleared: " + failed.join(", ");
+                    this.log("ERROR", errorMsg);
+                    return this.getErrorJSONString(errorMsg);
+                }
+                return '{"result":"DONE"}';
+
             case "GET_REDIRECTS":
                 // Returns JSON encoded list of redirects.
-                if (this.redirectsString === "") {
-                    this.redirectsString = this.buildRedirectsString();
-                }
+                this.redirectsString = this.buildRedirectsString();
                 return this.redirectsString;
 
             case "GET_REDIRECTS_LEN":
                 this.redirectsString = this.buildRedirectsString();
                 return this.redirectsString.length.toString();
 
+            case "SET_LOAD_POLICY":
+                // Expects [idleTime, cap] in milliseconds. See loadPolicy.
+                this.loadPolicy = {idleTime: parseInt(args[0]),
+                                   cap: parseInt(args[1])};
+                return '{"result":"DONE"}';
+
             case "GET_URL":
                 var loc = {};
-                loc["href"] = content.document.location;
+                loc["href"] = this.contentWindow().document.location;
                 return JSON.stringify(loc);
                 
             case "SET_URL":
-                gBrowser.stop();
+                this.browser().stop();
                 this.pageError = false;
                 this.pageLoaded = false;
-                content.document.location = args;
+                this.clearSettled();
+                this.contentWindow().document.location = args;
                 return '{"result":"DONE"}';
                 
             case "GET_HEADERS_LEN":
                 // Returns the length of header string. See get_headers for
                 //  string description.
-                if(this.headerString == '') {
-                    var urlHeaderObj = {};
-                    for(var url in this.urlInfo) {
-                        urlHeaderObj[url] = this.urlInfo[url]["headers"];
-                    }
-                    this.headerString = JSON.stringify(urlHeaderObj);
-                }
-                return this.headerString.length.toString();
+                return this.getHeaderString().length.toString();
 
             case "GET_HEADERS":
                 // Returns a JSON encoded header string. The JSON object is a 
@@ -407,47 +1000,11 @@ TrajLogging.LIB = {
                 //                    header: value 
                 //                    }
                 //             }
-                if(this.headerString == '') {
-                    var urlHeaderObj = {};
-                    for(var url in this.urlInfo) {
-                        urlHeaderObj[url] = this.urlInfo[url]["headers"];
-                    }
-                    this.headerString = JSON.stringify(urlHeaderObj);
-                }
-                return this.headerString;
+                return this.getHeaderString();
 
             case "GET_HTML":
                  // Returns HTML string. 
-                 if (this.htmlString == '') {
-                    var serializer = new XMLSerializer();
-                    this.htmlString = serializer.serializeToString(
-                                                   content.document);
-                    var frames = content.document
-                                        .getElementsByTagName('frame');
-                    var len = frames.length;
-                    for(var i=0; i < len; i++) {
-                        var srcVal = serializer.serializeToString(frames[i]
-                                                                  .src)
-                        //get and add source name.
-                        this.htmlString += '\n\n\n ' +
-                                        '<!--Added for Trajectory. Src: ' + 
-                                        srcVal + '--> \n\n\n';
-                    }
-                    var iframes = content.document
-                                        .getElementsByTagName('iframe');
-                    
-                    len = iframes.length;
-                    for(var i=0; i < len; i++) {
-                        var srcVal = iframes[i].contentDocument
-                                                .documentElement
-                                                .innerHTML
-                        //get and add source name.
-                        this.htmlString +=  '\n\n\n ' + 
-                                            '<!--Added by Stallone. Src: ' + 
-                                            '--> \n\n\n' + srcVal;
-                    }
-                 }
-                 if (!this.htmlString) {
+                 if (!this.getHtmlString()) {
                         var errorMsg = "Document has no inner HTML.";
                         this.log("ERROR", errorMsg);
                         return this.getErrorJSONString(errorMsg);
@@ -457,15 +1014,11 @@ TrajLogging.LIB = {
             case "SAVE_HTML_FILE":
                  // Takes a filename as an argument and saves the HTML to 
                  // to the file.
-                 if (!this.htmlString && 
-                     !content.document.documentElement.innerHTML) {
+                 if (!this.getHtmlString()) {
                         var errorMsg = "Document has no inner HTML.";
                         this.log("ERROR", errorMsg);
                         return this.getErrorJSONString(errorMsg);
                  }
-                 if (this.htmlString == '') {
-                    this.htmlString = this.handleCommand("GET_HTML", "");
-                 }
                  var file = Components.classes["@mozilla.org/file/local;1"]
                                       .createInstance(Components.interfaces
                                                       .nsILocalFile);
@@ -489,15 +1042,11 @@ TrajLogging.LIB = {
   
              case "GET_HTML_LEN":
                  // Returns a string encoded length of the HTML.
-                 if (!this.htmlString && 
-                     !content.document.documentElement.innerHTML) {
+                 if (!this.getHtmlString()) {
                         var errorMsg = "Document has no inner HTML.";
                         this.log("ERROR", errorMsg);
                         return this.getErrorJSONString(errorMsg);
                  }             
-                 if (this.htmlString == '') { 
-                    this.htmlString = this.handleCommand("GET_HTML", "");
-                 }
                  return this.htmlString.length.toString();
                              
              case "SET_HEADER":
@@ -561,7 +1110,8 @@ TrajLogging.LIB = {
                  */
                 var filePath = args;
                 try {
-                    var canvas = TrajLogging.Screenshooter.grab();
+                    var canvas = TrajLogging.Screenshooter.grab(
+                                                            this.browser());
                     if (canvas) {
                         TrajLogging.Screenshooter.save(canvas, filePath);
                     } else {
@@ -584,21 +1134,10 @@ TrajLogging.LIB = {
                  *     url: responseCode
                  * }
                  */
-                if(!this.responsecodesString) {
-                    var tempObj = {};
-                    for(var url in this.urlInfo) {
-                        tempObj[url] = this.urlInfo[url]["responsecode"];
-                    }
-                    this.responsecodesString = JSON.stringify(tempObj);
-                }
-                return this.responsecodesString;
+                return this.getResponsecodesString();
 
              case "GET_RESPONSE_CODES_LEN":
-                if(this.responsecodesString == "") {
-                    this.responsecodesString = 
-                                this.handleCommand("GET_RESPONSE_CODES", "");
-                }
-                return this.responsecodesString.length.toString();
+                return this.getResponsecodesString().length.toString();
 
              case "HAS_PAGE_LOADED":
                 if(this.pageLoaded)
@@ -622,7 +1161,8 @@ TrajLogging.LIB = {
                 try {
                     if(!this.pagerankRequest) {
                         this.pagerankRequest = TrajLogging.Pageranker
-                                               .reqPagerank(content.document
+                                               .reqPagerank(this.contentWindow()
+                                               .document
                                                .location);
                     }
                     this.pagerank = TrajLogging.Pageranker.getPagerank();
@@ -637,18 +1177,22 @@ TrajLogging.LIB = {
                  * Evals the argument passed, and returns the result. 
                  */  
                 result_obj = {};
+                result_obj['result'] = this.evalJS(args);
+                this.log("INFO", "stringified: " + JSON.stringify(result_obj));
+                return JSON.stringify(result_obj);
+
+             case "COLLECT_VISIT":
+                /*
+                 * Returns the JSON encoded object built by collectVisit().
+                 * Takes a list of JS snippets to eval as the args.
+                 */
                 try {
-                    result = eval(args);
-                    this.log("INFO", "eval results: " + result);
-                    if (!result) {
-                    	result = "";
-                    } 
-                    result_obj['result'] = result;
+                    return JSON.stringify(this.collectVisit(args));
                 } catch(e) {
-                    result_obj['result'] = e.toString();
+                    var errorMsg = "Collecting visit failed: " + e.toString();
+                    this.log("ERROR", errorMsg);
+                    return this.getErrorJSONString(errorMsg);
                 }
-                this.log("INFO", "stringified: " + JSON.stringify(result_obj));
-                return JSON.stringify(result_obj);
         }
         }
 };
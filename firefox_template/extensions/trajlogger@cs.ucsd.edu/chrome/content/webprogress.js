@@ -13,6 +13,9 @@ TrajLogging.ns(function() {
         STATE_IS_DOCUMENT : Components.interfaces.nsIWebProgressListener
                             .STATE_IS_DOCUMENT,
 
+        STATE_IS_REQUEST : Components.interfaces.nsIWebProgressListener
+                            .STATE_IS_REQUEST,
+
         STATE_STOP : Components.interfaces.nsIWebProgressListener.STATE_STOP,
 
         srcLoggerWebListener : {
@@ -25,15 +28,40 @@ TrajLogging.ns(function() {
             },
            
             onStateChange : function(aProgress, aRequest, aFlag, aStatus) {
-                if((aFlag & this.STATE_STOP) && 
-                    (aFlag & this.STATE_IS_DOCUMENT)) {
+                var webProgress = TrajLogging.WebProgress;
+                if(!(aFlag & webProgress.STATE_STOP)) {
+                    return 0;
+                }
+                try {
+                    var lib = TrajLogging.LIB.stateForWindow(
+                                                        aProgress.DOMWindow);
+                    if(!lib) {
+                        return 0;
+                    }
+                    if(aFlag & webProgress.STATE_IS_DOCUMENT) {
+                        lib.documentStopped();
+                    }
+                    if(aFlag & webProgress.STATE_IS_REQUEST) {
+                        // Covers requests that failed before a response
+                        // reached httpobserver.js.
+                        lib.requestFinished(aRequest);
+                    }
+                } catch(e) {
+                    TrajLogging.LIB.log("ERROR", "onStateChange: " + 
+                                        e.toString());
                 }
                 return 0;
             },
             
             onLocationChange : function(aProgress, aRequest, aURI) {
-                if(aURI.asciiSpec == content.document.location) {
-                    TrajLogging.LIB.addRedirect(aURI.asciiSpec);
+                var lib = null;
+                try {
+                    lib = TrajLogging.LIB.stateForWindow(aProgress.DOMWindow);
+                } catch(e) {
+                }
+                if(lib && 
+                   aURI.asciiSpec == lib.contentWindow().document.location) {
+                    lib.addRedirect(aURI.asciiSpec);
                 }
                 return 0;
             },
@@ -61,8 +89,15 @@ TrajLogging.ns(function() {
                 .classes["@mozilla.org/docloaderservice;1"]
                 .getService(Components.interfaces.nsIWebProgress);
             progress.addProgressListener(this.srcLoggerWebListener, 
-                   Components.interfaces.nsIWebProgress.NOTIFY_LOCATION);
+                   Components.interfaces.nsIWebProgress.NOTIFY_LOCATION |
+                   Components.interfaces.nsIWebProgress.NOTIFY_STATE_DOCUMENT |
+                   Components.interfaces.nsIWebProgress.NOTIFY_STATE_REQUEST);
             getBrowser().addEventListener('DOMContentLoaded', function(aEvent){
+                    var lib = TrajLogging.LIB.stateForWindow(
+                                                    aEvent.target.defaultView);
+                    if(lib && aEvent.target == lib.contentWindow().document) {
+                        lib.domReady();
+                    }
                     if(aEvent.target.nodeName == '#document') {
                         //TODO: If DOMWillOpenModalDialog fires, set a flag to 
                         // true. Soon after, if this event is fired, the 
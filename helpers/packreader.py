@@ -0,0 +1,62 @@
+"""
+Lists and extracts the records in pack files written with the crawler's
+--pack-dir option.
+
+See:
+python packreader.py -h
+for documentation.
+
+
+Author: nchachra@cs.ucsd.edu
+"""
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from packfile import PackReader
+
+
+if __name__== '__main__':
+    description = ('This script lists and extracts records from the ' +
+                   'crawler\'s pack files.')
+    parser = argparse.ArgumentParser(
+                        description=description,
+                        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-p', '--pack-dir', required=True,
+            help='Directory with the .pack and .idx files.')
+    parser.add_argument('-k', '--kind',
+            choices=['dom', 'screenshot', 'visitchain'],
+            help='Only consider records of this kind.')
+    parser.add_argument('-l', '--list', action='store_true', default=False,
+            help='List kind, key, pack, offset and length of the records.')
+    parser.add_argument('-g', '--get', action='append', default=[],
+            help='Key of a record to write to stdout. Requires --kind.')
+    parser.add_argument('-x', '--extract',
+            help='Directory to extract all records (of --kind) into. A \n' +
+                 'record is written to <extract>/<kind>/<key>.')
+    args = parser.parse_args()
+
+    reader = PackReader(args.pack_dir)
+    if args.list:
+        for (kind, key) in reader.keys(args.kind):
+            (pack, offset, length) = reader.location(kind, key)
+            print "%s\t%s\t%s\t%s\t%s" % (kind, key, pack, offset, length)
+    for key in args.get:
+        if not args.kind:
+            parser.error("--get requires --kind")
+        data = reader.get(args.kind, key)
+        if data is None:
+            print >> sys.stderr, "No %s record with key %s" % (args.kind, key)
+            sys.exit(1)
+        sys.stdout.write(data)
+    if args.extract:
+        for (kind, key) in reader.keys(args.kind):
+            path = os.path.join(args.extract, kind, key.lstrip('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            fh = open(path, 'wb')
+            fh.write(reader.get(kind, key))
+            fh.close()
@@ -0,0 +1,60 @@
+"""
+Lists and looks up visit chains in the jsonl result shards written with the
+crawler's --results-format jsonl option.
+
+See:
+python resultreader.py -h
+for documentation.
+
+
+Author: nchachra@cs.ucsd.edu
+"""
+
+import argparse
+import os
+import simplejson as json
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from resultsink import read_index, read_visit
+
+
+if __name__== '__main__':
+    description = ('This script lists and looks up visit chains in the ' +
+                   'crawler\'s jsonl result shards.')
+    parser = argparse.ArgumentParser(
+                        description=description,
+                        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-r', '--results-dir', required=True,
+            help='Directory with the .jsonl shards and .index files.')
+    parser.add_argument('-l', '--list', action='store_true', default=False,
+            help='List file name, shard, offset and length of the visits.')
+    parser.add_argument('-g', '--get', action='append', default=[],
+            help='Visit chain file name of a visit to write to stdout as\n'+
+                 'pretty printed JSON.')
+    parser.add_argument('-x', '--extract',
+            help='Directory to write every visit chain into, as the file\n'+
+                 'it would have had with --results-format json.')
+    args = parser.parse_args()
+
+    index = read_index(args.results_dir)
+    if args.list:
+        for fname in sorted(index):
+            (shard, offset, length) = index[fname]
+            print "%s\t%s\t%s\t%s" % (fname, shard, offset, length)
+    for fname in args.get:
+        if not index.has_key(fname):
+            print >> sys.stderr, "No visit with file name %s" % fname
+            sys.exit(1)
+        print json.dumps(read_visit(args.results_dir, *index[fname]),
+                         indent=4)
+    if args.extract:
+        for fname in sorted(index):
+            path = os.path.join(args.extract, fname.lstrip('/'))
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            fh = open(path, 'w')
+            json.dump(read_visit(args.results_dir, *index[fname]), fh,
+                      indent=4)
+            fh.close()
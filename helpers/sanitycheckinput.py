@@ -105,6 +105,21 @@ def check_setup_dict(setup_dict, req_id):
                         logging.error("For boolean preference types, the " +
                                "only valid arguments are \"true\" and " +
                                "\"false\"")
+    # Check load policy
+    if setup_dict.has_key("load_policy"):
+        load_policy = setup_dict["load_policy"]
+        if not isinstance(load_policy, dict):
+            logging.error("load_policy should be a dict for ID %s" % req_id)
+        else:
+            if (load_policy.has_key("policy") and 
+                load_policy["policy"] not in ("onload", "idle")):
+                    logging.error("load_policy policy should be \"onload\" "+
+                                  "or \"idle\" for ID %s" % req_id)
+            for key in ("idle_time", "idle_cap"):
+                if (load_policy.has_key(key) and 
+                    not isinstance(load_policy[key], (int, float))):
+                        logging.error("load_policy %s should be a number " 
+                                      % key + "for ID %s" % req_id)
     # Check headers
     if not setup_dict.has_key("headers"):
         logging.info("No headers will be sent for ID %s " % req_id)
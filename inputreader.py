@@ -0,0 +1,177 @@
+"""Streaming readers for input files, so that input files don't need to fit in
+memory and crawling starts as soon as the first job is parsed.
+
+Two input formats are supported:
+    .json files hold one JSON object {"<id>": <job>, ...}. The object is
+        parsed incrementally, one id/job pair at a time.
+    .jsonl files hold one JSON object per line, each with one or more
+        "<id>": <job> pairs. Empty lines are skipped.
+
+Author: nchachra@cs.ucsd.edu
+"""
+
+import Queue
+import simplejson as json
+import threading
+
+import config
+
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+
+class _Stream:
+    """Buffer over a file handle for incremental parsing.
+    """
+    def __init__(self, fh, chunk_size):
+        self.fh = fh
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self):
+        """Reads another chunk into the buffer, dropping what has already
+        been parsed. Returns False at the end of the file.
+        """
+        if self.eof:
+            return False
+        chunk = self.fh.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def next_char(self):
+        """Skips whitespace and returns the next character without consuming
+        it, or '' at the end of the file.
+        """
+        while True:
+            while (self.pos < len(self.buf) and
+                   self.buf[self.pos] in _WHITESPACE):
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.read_more():
+                return ''
+
+    def expect(self, chars):
+        """Consumes and returns the next non whitespace character, which
+        must be one of chars.
+        """
+        char = self.next_char()
+        if not char or char not in chars:
+            raise ValueError("Expected one of %r at offset %s, found %r"
+                             % (chars, self.pos, char))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Parses and returns the next JSON value.
+        """
+        self.next_char()
+        while True:
+            try:
+                (obj, end) = _decoder.raw_decode(self.buf, self.pos)
+                # A number may continue in the next chunk.
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return obj
+            except ValueError:
+                if self.eof:
+                    raise
+            if not self.read_more():
+                (obj, self.pos) = _decoder.raw_decode(self.buf, self.pos)
+                return obj
+
+
+def iter_json_object(fh, chunk_size=config.INPUT_CHUNK_SIZE):
+    """Yields the (key, value) pairs of the JSON object in file handle fh
+    without loading the whole object into memory.
+    """
+    stream = _Stream(fh, chunk_size)
+    stream.expect('{')
+    if stream.next_char() == '}':
+        return
+    while True:
+        key = stream.value()
+        if not isinstance(key, basestring):
+            raise ValueError("Expected a string key, found %r" % key)
+        stream.expect(':')
+        yield (key, stream.value())
+        if stream.expect(',}') == '}':
+            return
+
+
+def iter_jsonl(fh):
+    """Yields the (key, value) pairs of the JSON objects in file handle fh,
+    one object per line.
+    """
+    for line in fh:
+        line = line.strip()
+        if line:
+            for item in json.loads(line).iteritems():
+                yield item
+
+
+def iter_jobs(path):
+    """Yields the (id, job) pairs in the input file at path. Files ending in
+    .jsonl are read as JSON lines, anything else as a single JSON object.
+    """
+    fh = open(path, 'rb')
+    try:
+        if path.endswith('.jsonl'):
+            items = iter_jsonl(fh)
+        else:
+            items = iter_json_object(fh)
+        for item in items:
+            yield item
+    finally:
+        fh.close()
+
+
+class InputReader:
+    """Reads jobs from a list of input files in a background thread. At most
+    prefetch jobs are held in memory; the thread moves on to parsing the
+    next file while the jobs of the previous one are still being handed
+    out.
+    """
+    # Returned by get_nowait() once all input files have been read.
+    END = 'END'
+
+    def __init__(self, file_list, logger, prefetch=config.INPUT_PREFETCH):
+        self.file_list = list(file_list)
+        self.logger = logger
+        self.jobs = Queue.Queue(prefetch)
+        self.thread = threading.Thread(target=self._read)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read(self):
+        for path in self.file_list:
+            self.logger.info("Reading jobs from %s" % path)
+            count = 0
+            try:
+                for job in iter_jobs(path):
+                    self.jobs.put(job)
+                    count += 1
+            except Exception, e:
+                self.logger.error("Error reading %s after %s jobs: %s"
+                                  % (path, count, e))
+            self.logger.info("Read %s jobs from %s" % (count, path))
+        self.jobs.put(self.END)
+
+    def get_nowait(self):
+        """Returns the next (id, job) pair, or END once all input has been
+        read. Raises Queue.Empty if the next job hasn't been parsed yet.
+        """
+        return self.jobs.get_nowait()
+
+    def get(self, timeout=None):
+        """Like get_nowait(), but waits up to timeout seconds for the next
+        job.
+        """
+        return self.jobs.get(True, timeout)
@@ -0,0 +1,263 @@
+"""Persistent record of the jobs of a crawl, so that a crawl that died can be
+resumed without visiting finished jobs again. The queue controller records
+every job it puts on the request queue as in flight, with its JSON, and
+marks it finished once its results have been written.
+
+Author: nchachra@cs.ucsd.edu
+"""
+
+import os
+import simplejson as json
+import sqlite3
+import threading
+import time
+import urlparse
+
+import config
+
+
+class Ledger:
+    """Job ledger in the SQLite database at path. Thread safe, but must only
+    be used in one process, which opens the database on first use.
+    """
+    QUEUED = 'queued'
+    FINISHED = 'finished'
+
+    def __init__(self, path, resume=False, logger=None):
+        """Unless resume is set, the jobs recorded by an earlier crawl are
+        dropped when the database is opened.
+        """
+        self.path = path
+        self.resume = resume
+        self.logger = logger
+        self.lock = threading.Lock()
+        self._db = None
+
+    def db(self):
+        """Returns the connection to the ledger, creating the ledger if it
+        doesn't exist. Call with the lock held.
+        """
+        if self._db is None:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self._db = sqlite3.connect(self.path,
+                                       timeout=config.SQLITE_TIMEOUT,
+                                       check_same_thread=False)
+            # Cheap commits that still survive a crash of the crawler.
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._create_tables(self._db)
+            if not self.resume:
+                self._db.execute("DELETE FROM jobs")
+            self._db.commit()
+        return self._db
+
+    def _create_tables(self, db):
+        db.execute("CREATE TABLE IF NOT EXISTS jobs (" +
+                   "id TEXT PRIMARY KEY, " +
+                   "status TEXT NOT NULL, " +
+                   "job TEXT, " +
+                   "queued REAL, " +
+                   "finished REAL)")
+        db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+
+    def _execute(self, query, args=(), many=False, commit=False):
+        self.lock.acquire()
+        try:
+            db = self.db()
+            if many:
+                cursor = db.executemany(query, args)
+            else:
+                cursor = db.execute(query, args)
+            rows = cursor.fetchall()
+            if commit:
+                db.commit()
+            return rows
+        finally:
+            self.lock.release()
+
+    def is_finished(self, job_id):
+        """Returns whether the job's results have been written.
+        """
+        rows = self._execute("SELECT 1 FROM jobs WHERE id=? AND status=?",
+                             (job_id, self.FINISHED))
+        return bool(rows)
+
+    def in_flight(self):
+        """Returns [(job id, job)] for the jobs that were put on the request
+        queue but never finished.
+        """
+        rows = self._execute("SELECT id, job FROM jobs WHERE status=?",
+                             (self.QUEUED,))
+        return [(job_id, json.loads(job)) for (job_id, job) in rows]
+
+    def mark_queued(self, job_id, job):
+        self._execute(("INSERT OR REPLACE INTO jobs (id, status, job, " +
+                       "queued) VALUES (?, ?, ?, ?)"),
+                      (job_id, self.QUEUED, json.dumps(job), time.time()),
+                      commit=True)
+
+    def mark_finished(self, jobs):
+        """Marks the jobs in the list of (job id, result list) tuples 
+        finished. The job JSON is dropped, since it is only needed to 
+        re-enqueue jobs.
+        """
+        now = time.time()
+        self._execute(("UPDATE jobs SET status=?, job=NULL, finished=? " +
+                       "WHERE id=?"),
+                      [(self.FINISHED, now, job_id) for (job_id, _) in jobs],
+                      many=True, commit=True)
+
+    def counts(self):
+        """Returns {status: number of jobs}.
+        """
+        return dict(self._execute("SELECT status, COUNT(*) FROM jobs " +
+                                  "GROUP BY status"))
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+        finally:
+            self.lock.release()
+
+
+class JobDB(Ledger):
+    """Jobs database for SqliteQController. Input files are imported into
+    the jobs table once, and jobs are handed out from it in order of
+    priority. A crawl using the same database always picks up where the 
+    last one stopped.
+
+    Besides the ledger's columns, a job has the url's host, a priority
+    (the job's "priority" key, default 0; higher goes first) and the number
+    of attempts made. Each visit chain of a finished job gets a row in the
+    results table with its file name, number of pages, final url, final
+    status code, and the dom and screenshot entries as JSON.
+    """
+    PENDING = 'pending'
+
+    def __init__(self, path, logger=None):
+        Ledger.__init__(self, path, resume=True, logger=logger)
+
+    def _create_tables(self, db):
+        db.execute("CREATE TABLE IF NOT EXISTS jobs (" +
+                   "id TEXT PRIMARY KEY, " +
+                   "status TEXT NOT NULL, " +
+                   "job TEXT, " +
+                   "url TEXT, " +
+                   "host TEXT, " +
+                   "priority INTEGER NOT NULL DEFAULT 0, " +
+                   "attempts INTEGER NOT NULL DEFAULT 0, " +
+                   "queued REAL, " +
+                   "finished REAL)")
+        db.execute("CREATE INDEX IF NOT EXISTS jobs_next " +
+                   "ON jobs (status, priority DESC)")
+        db.execute("CREATE INDEX IF NOT EXISTS jobs_host " +
+                   "ON jobs (host, status)")
+        db.execute("CREATE TABLE IF NOT EXISTS results (" +
+                   "job_id TEXT NOT NULL, " +
+                   "fname TEXT NOT NULL, " +
+                   "pages INTEGER, " +
+                   "final_url TEXT, " +
+                   "status_code TEXT, " +
+                   "dom TEXT, " +
+                   "screenshot TEXT, " +
+                   "finished REAL, " +
+                   "PRIMARY KEY (job_id, fname))")
+        db.execute("CREATE TABLE IF NOT EXISTS imports (" +
+                   "path TEXT PRIMARY KEY, " +
+                   "jobs INTEGER, " +
+                   "imported REAL)")
+
+    def is_imported(self, path):
+        return bool(self._execute("SELECT 1 FROM imports WHERE path=?",
+                                  (os.path.abspath(path),)))
+
+    def import_jobs(self, path, items, batch_size=config.JOB_IMPORT_BATCH):
+        """Adds the (job id, job) pairs in the iterable items, read from the
+        input file at path, as pending jobs. Jobs with an id that's already
+        known are ignored. Returns the number of pairs read.
+        """
+        query = ("INSERT OR IGNORE INTO jobs (id, status, job, url, host, " +
+                 "priority) VALUES (?, ?, ?, ?, ?, ?)")
+        count = 0
+        batch = []
+        for (job_id, job) in items:
+            url = job.get('url')
+            host = None
+            if url:
+                host = urlparse.urlsplit(url).hostname
+            batch.append((job_id, self.PENDING, json.dumps(job), url, host,
+                          job.get('priority', 0)))
+            count += 1
+            if len(batch) >= batch_size:
+                self._execute(query, batch, many=True, commit=True)
+                batch = []
+        if batch:
+            self._execute(query, batch, many=True)
+        self._execute(("INSERT OR REPLACE INTO imports (path, jobs, " +
+                       "imported) VALUES (?, ?, ?)"),
+                      (os.path.abspath(path), count, time.time()),
+                      commit=True)
+        return count
+
+    def requeue_in_flight(self):
+        """Makes jobs that were handed out but never finished pending again.
+        Returns their number.
+        """
+        self.lock.acquire()
+        try:
+            db = self.db()
+            cursor = db.execute("UPDATE jobs SET status=? WHERE status=?",
+                                (self.PENDING, self.QUEUED))
+            db.commit()
+            return cursor.rowcount
+        finally:
+            self.lock.release()
+
+    def next_jobs(self, limit):
+        """Hands out up to limit pending jobs with the highest priority,
+        marking them queued. Returns [(job id, job)].
+        """
+        self.lock.acquire()
+        try:
+            db = self.db()
+            rows = db.execute(("SELECT id, job FROM jobs WHERE status=? " +
+                               "ORDER BY priority DESC LIMIT ?"),
+                              (self.PENDING, limit)).fetchall()
+            now = time.time()
+            db.executemany(("UPDATE jobs SET status=?, " +
+                            "attempts=attempts+1, queued=? WHERE id=?"),
+                           [(self.QUEUED, now, job_id)
+                            for (job_id, _) in rows])
+            db.commit()
+        finally:
+            self.lock.release()
+        return [(job_id, json.loads(job)) for (job_id, job) in rows]
+
+    def mark_finished(self, jobs):
+        """Marks the jobs in the list of (job id, result list) tuples 
+        finished and records their results. Unlike the ledger, the job JSON
+        is kept.
+        """
+        now = time.time()
+        results = []
+        for (job_id, result_list) in jobs:
+            for (fname, visit) in result_list or []:
+                if not visit:
+                    continue
+                final = visit[-1]
+                results.append((job_id, fname, len(visit), final.get('url'),
+                                final.get('status_code'),
+                                json.dumps(final.get('dom')),
+                                json.dumps(final.get('screenshot')), now))
+        self._execute(("INSERT OR REPLACE INTO results (job_id, fname, " +
+                       "pages, final_url, status_code, dom, screenshot, " +
+                       "finished) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"),
+                      results, many=True)
+        self._execute("UPDATE jobs SET status=?, finished=? WHERE id=?",
+                      [(self.FINISHED, now, job_id) for (job_id, _) in jobs],
+                      many=True, commit=True)
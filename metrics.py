@@ -0,0 +1,385 @@
+"""Metrics of a running crawl, served over HTTP in the Prometheus text format
+for watching throughput and queue health while the crawl runs:
+
+    curl http://127.0.0.1:<metrics-port>/metrics
+
+Crawlers report events through the count_*() functions, which put small
+tuples on crawlglobs.metrics_q. A MetricsCollector thread in the main
+process adds them up in a Registry, which the MetricsServer renders on each
+request. The queue depths are sampled when the metrics are requested.
+
+Author: nchachra@cs.ucsd.edu
+"""
+
+import BaseHTTPServer
+import collections
+import os
+import threading
+import time
+import traceback
+
+import blobstore
+import config
+import crawlglobs
+
+
+# (name, type, help) of the metrics collected.
+METRICS = [
+    ('stallone_visits_total', 'counter',
+     'Visits finished, by status. ok is a visit without errors.'),
+    ('stallone_visit_rate', 'gauge',
+     'Visits finished per second over the last %s seconds.'
+     % config.METRICS_RATE_WINDOW),
+    ('stallone_proxy_visits_total', 'counter',
+     'Visits through each proxy, by status.'),
+    ('stallone_visit_seconds', 'histogram',
+     'Time of a visit, from taking the job off the request queue to ' +
+     'putting its results on the result queue.'),
+    ('stallone_phase_seconds', 'histogram',
+     'Time of each phase of a visit. See phasetimer.py.'),
+    ('stallone_browser_starts_total', 'counter',
+     'Browsers started, by whether their extension came up.'),
+    ('stallone_browser_ready_seconds', 'histogram',
+     'Time from launching a browser to its extension answering.'),
+    ('stallone_browser_slot_wait_seconds', 'histogram',
+     'Time a browser waited for its turn to start. See startup.py.'),
+    ('stallone_browser_restarts_total', 'counter',
+     'Browsers stopped to be restarted, or replaced by a standby.'),
+    ('stallone_browser_rss_bytes', 'gauge',
+     'RSS of the process tree of the browser at each port, after its last ' +
+     'visit.'),
+    ('stallone_browser_cpu_percent', 'gauge',
+     'CPU used by the browser at each port between its last two visits, ' +
+     'in percent of a core.'),
+    ('stallone_browser_processes', 'gauge',
+     'Processes in the tree of the browser at each port.'),
+    ('stallone_bytes_written_total', 'counter',
+     'Bytes of new DOM and screenshot files or pack records, by kind.'),
+    ('stallone_request_queue_depth', 'gauge', 'Jobs on the request queue.'),
+    ('stallone_result_queue_depth', 'gauge',
+     'Results on the result queue, waiting to be written.'),
+]
+
+# File extension of each kind of stored feature.
+_EXTENSIONS = {'dom': 'html', 'screenshot': 'png'}
+
+
+def report(*event):
+    """Puts event on crawlglobs.metrics_q for the MetricsCollector of the
+    main process. Does nothing if metrics are off.
+    """
+    queue = crawlglobs.metrics_q
+    if queue is not None:
+        queue.put(event)
+
+def count_visit(attempt, timings):
+    """Counts a finished visit with its attempt (see retryqueue) and the
+    timings of its VisitTimer.
+    """
+    proxy = None
+    if attempt['proxy']:
+        proxy = "%s:%s" % (attempt['proxy'][0], attempt['proxy'][1])
+    report('visit', attempt['status'] or 'ok', proxy, timings)
+
+def count_phases(timings):
+    """Counts timings of a visit that was counted already.
+    """
+    report('phases', timings)
+
+def count_browser_start(ready_time, slot_wait=None):
+    """Counts a browser start, after waiting slot_wait seconds for a 
+    startup slot. ready_time is None if it failed.
+    """
+    report('browser_start', ready_time, slot_wait)
+
+def count_browser_restart():
+    report('browser_restart')
+
+def count_browser_sample(port, sample):
+    """Sets the gauges of the browser at port to a sample of its
+    ResourceMonitor.
+    """
+    report('browser_sample', str(port), sample['rss'], sample['cpu_pct'],
+           sample['procs'])
+
+def count_stored(kind, result, dest_dir, store_root=None):
+    """Counts the bytes written for a 'dom' or 'screenshot' result of
+    Extension.html_file(), screenshot_file() or the screenshot pool, saved
+    to dest_dir or the blob store at store_root. Nothing was written if the
+    file existed already.
+    """
+    if crawlglobs.metrics_q is None:
+        return
+    if not result or result.get('exists', True):
+        return
+    ext = _EXTENSIONS[kind]
+    if result.has_key('length'):
+        # A pack record.
+        size = result['length']
+    else:
+        if result.has_key('file'):
+            path = os.path.join(dest_dir, result['file'])
+        elif store_root:
+            path = blobstore.get_store(store_root).path(result['md5'], ext)
+        else:
+            path = os.path.join(dest_dir, "%s.%s" % (result['md5'], ext))
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+    report('stored', kind, size)
+
+
+def _format_value(value):
+    if isinstance(value, (int, long)):
+        return str(value)
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for (label, value) in labels:
+        value = unicode(value).encode('utf-8')
+        value = (value.replace('\\', '\\\\').replace('"', '\\"')
+                      .replace('\n', '\\n'))
+        parts.append('%s="%s"' % (label, value))
+    return '{%s}' % ','.join(parts)
+
+
+class Registry:
+    """Counters, gauges and histograms with labels, described by a list like
+    METRICS. Thread safe.
+    """
+    def __init__(self, described=METRICS, buckets=config.METRICS_BUCKETS):
+        self.lock = threading.Lock()
+        self.described = list(described)
+        self.buckets = tuple(buckets)
+        # {name: {labels: value}}, labels being a sorted tuple of
+        #    (label, value) pairs. For histograms, the value is
+        #    [count per bucket, ..., count above the buckets, sum].
+        self.values = {}
+        # {name: function returning the value of the gauge}
+        self.gauge_funcs = {}
+
+    def inc(self, name, value=1, **labels):
+        self.lock.acquire()
+        try:
+            samples = self.values.setdefault(name, {})
+            key = tuple(sorted(labels.items()))
+            samples[key] = samples.get(key, 0) + value
+        finally:
+            self.lock.release()
+
+    def set(self, name, value, **labels):
+        self.lock.acquire()
+        try:
+            key = tuple(sorted(labels.items()))
+            self.values.setdefault(name, {})[key] = value
+        finally:
+            self.lock.release()
+
+    def observe(self, name, value, **labels):
+        self.lock.acquire()
+        try:
+            samples = self.values.setdefault(name, {})
+            key = tuple(sorted(labels.items()))
+            if key not in samples:
+                samples[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram = samples[key]
+            i = 0
+            while i < len(self.buckets) and value > self.buckets[i]:
+                i += 1
+            histogram[i] += 1
+            histogram[-1] += value
+        finally:
+            self.lock.release()
+
+    def gauge_func(self, name, func):
+        """The gauge name takes the value func() returns whenever the
+        metrics are rendered.
+        """
+        self.gauge_funcs[name] = func
+
+    def render(self):
+        """Returns the metrics in the Prometheus text format.
+        """
+        lines = []
+        for (name, metric_type, help_text) in self.described:
+            samples = self._samples(name)
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            for (labels, value) in sorted(samples.items()):
+                if metric_type == 'histogram':
+                    lines.extend(self._histogram_lines(name, labels, value))
+                else:
+                    lines.append("%s%s %s" % (name, _format_labels(labels),
+                                              _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def _samples(self, name):
+        if name in self.gauge_funcs:
+            try:
+                return {(): self.gauge_funcs[name]()}
+            except Exception:
+                # qsize() isn't available on every platform.
+                return {}
+        self.lock.acquire()
+        try:
+            samples = {}
+            for (labels, value) in self.values.get(name, {}).iteritems():
+                if isinstance(value, list):
+                    value = list(value)
+                samples[labels] = value
+            return samples
+        finally:
+            self.lock.release()
+
+    def _histogram_lines(self, name, labels, histogram):
+        lines = []
+        count = 0
+        for (i, bound) in enumerate(self.buckets + (float('inf'),)):
+            count += histogram[i]
+            bucket_labels = labels + (('le', _format_value(bound)),)
+            lines.append("%s_bucket%s %d" % (name,
+                                             _format_labels(bucket_labels),
+                                             count))
+        lines.append("%s_sum%s %s" % (name, _format_labels(labels),
+                                      _format_value(histogram[-1])))
+        lines.append("%s_count%s %d" % (name, _format_labels(labels), count))
+        return lines
+
+
+class MetricsCollector(threading.Thread):
+    """Thread of the main process that adds up the events the crawlers put
+    on queue in registry.
+    """
+    def __init__(self, queue, registry, logger,
+                 rate_window=config.METRICS_RATE_WINDOW):
+        threading.Thread.__init__(self, name="MetricsCollector")
+        self.daemon = True
+        self.queue = queue
+        self.registry = registry
+        self.logger = logger
+        self.rate_window = rate_window
+        self.started = time.time()
+        # Times the visits in the rate window finished.
+        self.visit_times = collections.deque()
+        self.rate_lock = threading.Lock()
+        registry.inc('stallone_browser_restarts_total', 0)
+        registry.gauge_func('stallone_visit_rate', self.visit_rate)
+
+    def run(self):
+        while True:
+            try:
+                event = self.queue.get()
+                self.add(event)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except EOFError:
+                break
+            except:
+                self.logger.error("Error adding up metrics: %s"
+                                  % traceback.format_exc())
+
+    def add(self, event):
+        registry = self.registry
+        kind = event[0]
+        if kind == 'visit':
+            (status, proxy, timings) = event[1:]
+            registry.inc('stallone_visits_total', status=status)
+            if proxy:
+                registry.inc('stallone_proxy_visits_total', proxy=proxy,
+                             status=status)
+            self._add_timings(timings)
+            registry.observe('stallone_visit_seconds',
+                             sum([seconds for (phase, seconds)
+                                  in timings.iteritems()
+                                  if phase != 'queue_wait']))
+            self.rate_lock.acquire()
+            try:
+                self.visit_times.append(time.time())
+            finally:
+                self.rate_lock.release()
+        elif kind == 'phases':
+            self._add_timings(event[1])
+        elif kind == 'browser_start':
+            (ready_time, slot_wait) = event[1:]
+            if slot_wait is not None:
+                registry.observe('stallone_browser_slot_wait_seconds',
+                                 slot_wait)
+            if ready_time is None:
+                registry.inc('stallone_browser_starts_total',
+                             result='failed')
+            else:
+                registry.inc('stallone_browser_starts_total', result='ok')
+                registry.observe('stallone_browser_ready_seconds',
+                                 ready_time)
+        elif kind == 'browser_restart':
+            registry.inc('stallone_browser_restarts_total')
+        elif kind == 'browser_sample':
+            (port, rss, cpu_pct, procs) = event[1:]
+            registry.set('stallone_browser_rss_bytes', rss, port=port)
+            registry.set('stallone_browser_cpu_percent', cpu_pct, port=port)
+            registry.set('stallone_browser_processes', procs, port=port)
+        elif kind == 'stored':
+            registry.inc('stallone_bytes_written_total', event[2],
+                         kind=event[1])
+
+    def _add_timings(self, timings):
+        for (phase, seconds) in timings.iteritems():
+            self.registry.observe('stallone_phase_seconds', seconds,
+                                  phase=phase)
+
+    def visit_rate(self):
+        """Returns the visits per second over the rate window, or since the
+        collector started if that was more recent, but at least a second ago.
+        """
+        now = time.time()
+        self.rate_lock.acquire()
+        try:
+            while (self.visit_times and
+                   self.visit_times[0] < now - self.rate_window):
+                self.visit_times.popleft()
+            visits = len(self.visit_times)
+        finally:
+            self.rate_lock.release()
+        window = max(1, min(self.rate_window, now - self.started))
+        return round(visits / window, 3)
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes would fill the terminal.
+        pass
+
+
+class MetricsServer(threading.Thread):
+    """Serves the metrics of registry at http://host:port/metrics from a
+    thread.
+    """
+    def __init__(self, registry, port, host=config.METRICS_HOST):
+        threading.Thread.__init__(self, name="MetricsServer")
+        self.daemon = True
+        self.server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+        self.server.registry = registry
+
+    def run(self):
+        self.server.serve_forever()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,212 @@
+"""Pack files bundle many small output files (DOMs, screenshots, visit
+chains) into a few large files that are only ever appended to, which suits
+HDFS and NFS much better than millions of file creates.
+
+A writer appends records to <prefix>-<seq>.pack and rolls over to the next
+sequence number once the pack reaches a maximum size. Each record is
+
+    <kind> <key> <length>\n<length bytes of data>\n
+
+and is listed in the companion index <prefix>-<seq>.idx with one line per
+record:
+
+    <kind>\t<key>\t<offset of data>\t<length>\n
+
+Each writer should use its own prefix, see pack_prefix(), since a pack has a
+single writer.
+
+Author: nchachra@cs.ucsd.edu
+"""
+
+import os
+import re
+import shutil
+import threading
+
+import config
+
+
+def _pack_names(directory, prefix):
+    """Returns the sorted sequence numbers of the packs with prefix in
+    directory.
+    """
+    pattern = re.compile(re.escape(prefix) + r'-(\d+)\.pack$')
+    seqs = []
+    for fname in os.listdir(directory):
+        match = pattern.match(fname)
+        if match:
+            seqs.append(int(match.group(1)))
+    return sorted(seqs)
+
+def pack_prefix(role):
+    """Returns the pack prefix for a writer of this host and process. role
+    tells apart the writers of one process, like the crawlers' and the 
+    result sink's when the async engine runs both in the same process.
+    """
+    return '%s_%s_%s' % (os.uname()[1], os.getpid(), role)
+
+
+class PackWriter:
+    """Appends records to rolling packs named <prefix>-<seq>.pack in
+    directory. Thread safe.
+    """
+    def __init__(self, directory, prefix, max_size=config.PACK_MAX_SIZE,
+                 logger=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_size = max_size
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.pack_fh = None
+        self.index_fh = None
+        # Keys written by this writer, for skipping duplicate md5 named
+        #    files.
+        self.keys = set()
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass
+        # Never append to packs left by an earlier run.
+        seqs = _pack_names(directory, prefix)
+        if seqs:
+            self.seq = seqs[-1]
+        else:
+            self.seq = -1
+
+    def pack_name(self):
+        """Returns the file name of the current pack.
+        """
+        return '%s-%05d.pack' % (self.prefix, self.seq)
+
+    def _roll(self):
+        """Closes the current pack, if any, and opens the next one.
+        """
+        self._close_files()
+        self.seq += 1
+        base = os.path.join(self.directory, '%s-%05d' % (self.prefix,
+                                                         self.seq))
+        self.pack_fh = open(base + '.pack', 'ab')
+        self.index_fh = open(base + '.idx', 'ab')
+        if self.logger:
+            self.logger.info("Writing to pack %s" % self.pack_name())
+
+    def _close_files(self):
+        if self.pack_fh:
+            self.pack_fh.close()
+            self.index_fh.close()
+            self.pack_fh = None
+            self.index_fh = None
+
+    def has_key(self, kind, key):
+        """Returns whether this writer already appended the record.
+        """
+        return (kind, key) in self.keys
+
+    def _append(self, kind, key, length, write_data):
+        """Appends a record. write_data(fh) writes exactly length bytes to
+        fh. Returns {'pack': pack name, 'offset': offset, 'length': length}.
+        """
+        if ' ' in kind or '\t' in key or '\n' in key:
+            raise ValueError('Invalid pack record key %r' % key)
+        self.lock.acquire()
+        try:
+            if self.pack_fh is None or self.pack_fh.tell() >= self.max_size:
+                self._roll()
+            self.pack_fh.write('%s %s %d\n' % (kind, key, length))
+            offset = self.pack_fh.tell()
+            write_data(self.pack_fh)
+            self.pack_fh.write('\n')
+            self.pack_fh.flush()
+            # The index only points at data that has been written.
+            self.index_fh.write('%s\t%s\t%d\t%d\n' % (kind, key, offset,
+                                                      length))
+            self.index_fh.flush()
+            self.keys.add((kind, key))
+            return {'pack': self.pack_name(), 'offset': offset,
+                    'length': length}
+        finally:
+            self.lock.release()
+
+    def append(self, kind, key, data):
+        """Appends the string data as a record of kind with key.
+        """
+        return self._append(kind, key, len(data), lambda fh: fh.write(data))
+
+    def append_file(self, kind, key, path, remove=True):
+        """Appends the contents of the file at path as a record of kind
+        with key. The file is removed afterwards unless remove is False.
+        """
+        length = os.path.getsize(path)
+        def write_data(fh):
+            src = open(path, 'rb')
+            try:
+                shutil.copyfileobj(src, fh)
+            finally:
+                src.close()
+        result = self._append(kind, key, length, write_data)
+        if remove:
+            os.remove(path)
+        return result
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self._close_files()
+        finally:
+            self.lock.release()
+
+
+class PackReader:
+    """Random access to the records of all packs in directory, using their
+    indexes.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        # {(kind, key): (pack file name, offset, length)}. Later records
+        #    win over earlier ones with the same key.
+        self.records = {}
+        for fname in sorted(os.listdir(directory)):
+            if not fname.endswith('.idx'):
+                continue
+            pack = fname[:-4] + '.pack'
+            fh = open(os.path.join(directory, fname), 'rb')
+            for line in fh:
+                if not line.endswith('\n'):
+                    # Partially written by a crashed writer.
+                    break
+                (kind, key, offset, length) = line[:-1].split('\t')
+                self.records[(kind, key)] = (pack, int(offset), int(length))
+            fh.close()
+
+    def keys(self, kind=None):
+        """Returns the (kind, key) tuples of all records, or only those of
+        kind.
+        """
+        return sorted(k for k in self.records if kind is None or
+                      k[0] == kind)
+
+    def location(self, kind, key):
+        """Returns (pack file name, offset, length) for the record, or None.
+        """
+        return self.records.get((kind, key))
+
+    def get(self, kind, key):
+        """Returns the data of the record, or None if there is none.
+        """
+        location = self.location(kind, key)
+        if location is None:
+            return None
+        (pack, offset, length) = location
+        return read_record(os.path.join(self.directory, pack), offset, length)
+
+
+def read_record(pack_path, offset, length):
+    """Returns length bytes at offset in the pack at pack_path.
+    """
+    fh = open(pack_path, 'rb')
+    try:
+        fh.seek(offset)
+        return fh.read(length)
+    finally:
+        fh.close()
@@ -0,0 +1,95 @@
+"""Timing the phases of visits. A crawler marks the end of each phase of a
+visit on its VisitTimer, and the timings are reported with the visit, in
+its visit chain and its attempt (see retryqueue). Each crawler process adds
+them up in a PhaseSummary, which it logs every config.TIMING_SUMMARY_VISITS
+visits.
+
+Author: nchachra@cs.ucsd.edu
+"""
+
+import threading
+import time
+
+
+# Phases of a visit, in order:
+#    queue_wait: waiting for the job on the request queue
+#    browser_start: restarting or starting the browser
+#    reset, setup, navigate, load: resetting the extension, setting prefs,
+#        headers and proxy, setting the URL, and waiting for the page load
+#    dom, screenshot: saving them. screenshot_store is the time a
+#        screenshot then spent in the screenshot pool, pngnq included.
+#    eval: collecting the visit, which runs the eval snippets
+#    tags: fetching the HTML for tags if needed, and tagging
+#    error: from the end of the last phase until the visit failed with an
+#        exception or timed out
+#    monitor: sampling the browser's resource usage
+#    enqueue: putting the results on the result queue
+PHASES = ('queue_wait', 'browser_start', 'reset', 'setup', 'navigate',
+          'load', 'dom', 'screenshot', 'screenshot_store', 'eval', 'tags',
+          'error', 'monitor', 'enqueue')
+
+
+class VisitTimer:
+    """Times the phases of a single visit. Each mark() ends a phase, which
+    started at the previous mark(), or when the timer was created.
+    """
+    def __init__(self):
+        self.last = time.time()
+        # {phase: seconds}
+        self.timings = {}
+
+    def mark(self, phase):
+        now = time.time()
+        self.add(phase, now - self.last)
+        self.last = now
+
+    def add(self, phase, seconds):
+        """Adds seconds to phase, which took place outside of the marks.
+        """
+        self.timings[phase] = round(self.timings.get(phase, 0) + seconds, 3)
+
+
+class PhaseSummary:
+    """Number, total and maximum of the timings of each phase over many
+    visits. Thread safe.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.visits = 0
+        # {phase: [count, total seconds, max seconds]}
+        self.phases = {}
+
+    def add(self, timings, visit=True):
+        """Adds the timings of a visit. visit is False for timings that
+        belong to a visit that was added already. Returns the number of
+        visits added so far.
+        """
+        self.lock.acquire()
+        try:
+            if visit:
+                self.visits += 1
+            for (phase, seconds) in timings.iteritems():
+                stats = self.phases.setdefault(phase, [0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += seconds
+                stats[2] = max(stats[2], seconds)
+            return self.visits
+        finally:
+            self.lock.release()
+
+    def report(self):
+        """Returns a line with the mean and maximum seconds of each phase.
+        """
+        self.lock.acquire()
+        try:
+            order = [phase for phase in PHASES if phase in self.phases]
+            order += sorted(set(self.phases) - set(PHASES))
+            parts = []
+            for phase in order:
+                (count, total, longest) = self.phases[phase]
+                parts.append("%s %.3f/%.3f" % (phase, total / count,
+                                               longest))
+            return ("%d visits, mean/max seconds per phase: %s"
+                    % (self.visits, ', '.join(parts)))
+        finally:
+            self.lock.release()
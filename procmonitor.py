@@ -0,0 +1,130 @@
+"""Resource usage of browsers. Samples the memory and CPU time of a browser's
+process tree from /proc, so that crawlers can recycle browsers that grow too
+large instead of restarting them after a fixed number of visits.
+
+Author: nchachra@cs.ucsd.edu
+"""
+
+import collections
+import os
+import time
+
+import config
+
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+
+def _stat(pid):
+    """Returns the fields of /proc/<pid>/stat after the command name, or
+    None if the process is gone.
+    """
+    try:
+        fh = open('/proc/%s/stat' % pid)
+        try:
+            data = fh.read()
+        finally:
+            fh.close()
+    except (IOError, OSError):
+        return None
+    # The command name is in parentheses and may contain spaces.
+    return data[data.rindex(')') + 2:].split()
+
+
+def process_tree(pid):
+    """Returns the pids of pid and all its descendants.
+    """
+    children = collections.defaultdict(list)
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        fields = _stat(entry)
+        if fields:
+            children[int(fields[1])].append(int(entry))
+    tree = [pid]
+    i = 0
+    while i < len(tree):
+        tree.extend(children.get(tree[i], []))
+        i += 1
+    return tree
+
+
+def sample_tree(pid):
+    """Returns {'rss': bytes, 'cpu': seconds of CPU time, 'procs': number
+    of processes, 'time': time of the sample} summed over the process tree
+    of pid, or None if pid is gone.
+    """
+    rss = 0
+    cpu = 0
+    procs = 0
+    for member in process_tree(pid):
+        fields = _stat(member)
+        if not fields:
+            continue
+        # utime and stime, fields 14 and 15 of stat.
+        cpu += int(fields[11]) + int(fields[12])
+        try:
+            fh = open('/proc/%s/statm' % member)
+            try:
+                rss += int(fh.read().split()[1]) * PAGE_SIZE
+            finally:
+                fh.close()
+        except (IOError, OSError):
+            continue
+        procs += 1
+    if not procs:
+        return None
+    return {'rss': rss, 'cpu': float(cpu) / CLOCK_TICKS, 'procs': procs,
+            'time': time.time()}
+
+
+class ResourceMonitor:
+    """Samples the process tree of a browser once per visit. The browser is
+    due for recycling once its RSS exceeds max_rss bytes, or it grew by more
+    than max_growth bytes per visit on average over the last growth_visits
+    visits. A limit of 0 is off.
+    """
+    def __init__(self, pid, max_rss=config.BROWSER_MAX_RSS,
+                 max_growth=config.BROWSER_MAX_GROWTH,
+                 growth_visits=config.BROWSER_GROWTH_VISITS):
+        self.pid = pid
+        self.max_rss = max_rss
+        self.max_growth = max_growth
+        self.growth_visits = growth_visits
+        self.samples = collections.deque(maxlen=growth_visits + 1)
+
+    def sample(self):
+        """Takes a sample and returns it as a dictionary with the keys of
+        sample_tree() and 'cpu_pct', the CPU used since the last sample as a
+        percentage of one core. Returns None if the browser is gone.
+        """
+        current = sample_tree(self.pid)
+        if current is None:
+            return None
+        current['cpu_pct'] = 0.0
+        if self.samples:
+            last = self.samples[-1]
+            elapsed = current['time'] - last['time']
+            if elapsed > 0:
+                current['cpu_pct'] = round(100 * (current['cpu'] -
+                                                  last['cpu']) / elapsed, 1)
+        self.samples.append(current)
+        return current
+
+    def over_limit(self):
+        """Returns why the browser should be recycled, or None.
+        """
+        if not self.samples:
+            return None
+        rss = self.samples[-1]['rss']
+        if self.max_rss and rss > self.max_rss:
+            return "RSS of %d MB" % (rss / 2**20)
+        if (self.max_growth and
+            len(self.samples) == self.samples.maxlen):
+                growth = ((rss - self.samples[0]['rss']) /
+                          (len(self.samples) - 1))
+                if growth > self.max_growth:
+                    return ("RSS growing by %d MB per visit"
+                            % (growth / 2**20))
+        return None
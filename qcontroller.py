@@ -1,12 +1,15 @@
-import simplejson as json
 import multiprocessing as mp
 # Slightly retarded. We need Queue only for the Full and Empty exception,
 #    even though we are actually using multiprocessing.JoinableQueue
 import Queue
-import time
+import threading
+import traceback
 
 import config
 import mplogging
+from inputreader import InputReader, iter_jobs
+from ledger import JobDB
+from resultsink import FileSink
 
 '''The Queue Controller classes control filling and emptying request and
 result queue. 
@@ -17,9 +20,8 @@ Author: nchachra@cs.ucsd.edu
 class QController:
     '''Base class for queue controller classes. The run() function is 
     executed as a separate process. Direct objects of this class wont work. 
-    empty_q() and fill_q() are implemented by subclasses. In order to 
-    implement empty and fill functions using database, this will need to be
-    extended.
+    fill_q() and write_to_file() are implemented by subclasses. In order to 
+    implement them using database, this will need to be extended.
     '''
     def __init__(self, log_q):
         """log_q is the multiprocessing queue that we place records on for
@@ -30,111 +32,323 @@ class QController:
         
     
     def run(self, req_q, res_q):
-        """Runs until the cleanup flag is set. Waits for request and result 
-        queues to join before exiting. Loops and fills the request queue when 
-        it is less than a half full and empties result queue when it is over 
-        half full. The fill_q and empty_q functions are implemented by 
-        subclasses.
+        """Runs a feeder thread that keeps the request queue full, and a
+        drainer thread that writes results as soon as they arrive, and 
+        returns once the drainer is done. Neither thread polls: the feeder
+        blocks on put() while req_q is full and the drainer blocks on get().
+        The main process puts the special item "CRAWLERS_DONE" on res_q once
+        all crawler processes have exited, which ends the drainer.
         """
+        feeder = threading.Thread(target=self._feed, args=(req_q,), 
+                                  name="QFeeder")
+        # Crawlers that die early may leave the feeder blocked on a full
+        #    queue.
+        feeder.daemon = True
+        drainer = threading.Thread(target=self._drain, args=(res_q,),
+                                   name="QDrainer")
+        feeder.start()
+        drainer.start()
+        drainer.join()
+        self.finish()
+        self.logger.info("Terminating q manager")
+
+    def _feed(self, req_q):
+        try:
+            self.fill_q(req_q)
+        except Exception, e:
+            self.logger.critical("Error filling request queue: %s" 
+                                 % traceback.format_exc())
+            # Let the crawlers exit.
+            if not self.cleanup:
+                req_q.put("CLEANUP")
+                self.cleanup = True
+
+    def _drain(self, res_q):
         while True:
-            self.logger.debug("In QController's run()")
-            if self.cleanup: 
-                # Wait for all jobs in req_q to finish
-                self.logger.debug(("Cleanup flag set."))
-                self.logger.debug("Emptying result queue")
-                self.empty_q(res_q)
-                self.logger.debug("Waiting for result queue to join")
-            if res_q.qsize() > config.RESULT_Q_SIZE/2:
-                self.logger.info("Emptying queue")
-                self.empty_q(res_q)
-            else: 
-                self.logger.info("Result q size: %s" % res_q.qsize())
-            if req_q.qsize() < config.REQUEST_Q_SIZE/2:
-                self.logger.info("Filling queue")
-                self.fill_q(req_q)
-            else: 
-                self.logger.info("request_q size: %s" % req_q.qsize())
-            if req_q.qsize() == 0 and res_q.qsize() == 0 and self.cleanup:
-                req_q.join()
-                res_q.join()
-                self.logger.debug("req_q and res_q joined.")
-                self.logger.info("Terminating q manager")
+            try:
+                # Wake up only to write buffered results when they're due.
+                result_list = res_q.get(True, config.RESULT_FLUSH_INTERVAL)
+            except Queue.Empty:
+                self.flush()
+                continue
+            if result_list == "CRAWLERS_DONE":
+                self.logger.debug("All crawlers are done.")
+                res_q.task_done()
                 break
-            time.sleep(10)
+            # Crawlers put (job id, result list, attempt) for every job they
+            #    finish. The result list may be None. See retryqueue for
+            #    attempt.
+            (job_id, result_list, attempt) = result_list
+            try:
+                self.handle_result(job_id, result_list, attempt)
+            except Exception, e:
+                self.logger.error("Error writing results: %s" 
+                                  % traceback.format_exc())
+            res_q.task_done()
 
-    def fill_q(self, res_q):
+    def fill_q(self, req_q):
         raise NotImplementedError('Subclass must implement fill_q method.')
 
-    def empty_q(self, req_q):
-        raise NotImplementedError('Subclass must implement empty_q method.')
+    def write_to_file(self, result_list):
+        raise NotImplementedError(
+                'Subclass must implement write_to_file method.')
+
+    def handle_result(self, job_id, result_list, attempt):
+        """Writes the results of a job a crawler finished.
+        """
+        if result_list:
+            self.write_to_file(result_list)
+        self.job_done(job_id, result_list)
+
+    def job_done(self, job_id, result_list):
+        """Called after the results of job_id have been handed to 
+        write_to_file().
+        """
+        pass
+
+    def flush(self):
+        """Called when no result arrived for a while. Subclasses that buffer
+        results write them out here when due.
+        """
+        pass
+
+    def finish(self):
+        """Called once all results have been emptied, before run() returns.
+        """
+        pass
 
 class FileQController(QController):
-    """Handles input queue for crawler based on input and output json files. A 
-    database based crawler will need similar classes for handling request 
-    and result queues.
+    """Handles input queue for crawler based on input and output json files.
+    Input files are streamed, see inputreader. A database based crawler will
+    need similar classes for handling request and result queues.
     """
-    def __init__(self, req_file_list, num_browser, log_q):
+    def __init__(self, req_file_list, num_browser, log_q, sink=None,
+                 ledger=None, scheduler=None, retries=None):
+        """sink is the resultsink.ResultSink results are written to. By
+        default every visit chain is written to its own file. If ledger, a
+        ledger.Ledger, is given, jobs are recorded in it. When it resumes
+        an earlier crawl, finished jobs are skipped and jobs that were in
+        flight are put on the request queue first. If scheduler, a 
+        scheduler.HostScheduler, is given, jobs are interleaved across hosts
+        by it. If retries, a retryqueue.RetryQueue, is given, failed jobs 
+        are visited again once their retry is due, after fresh jobs.
+        """
         QController.__init__(self, log_q)
         self.req_file_list = req_file_list
-        # Keep track of items currently unprocessed. These are obtained from
-        #    the json file. Whenever the queue has a slot, the items are added
-        #    to it.
-        self.jobs = []
+        if sink is None:
+            sink = FileSink()
+        self.sink = sink
+        self.sink.logger = self.logger
+        self.ledger = ledger
+        if self.ledger:
+            self.ledger.logger = self.logger
+        self.scheduler = scheduler
+        self.retries = retries
+        # (job id, result list) of jobs whose results the sink still 
+        #    buffers. They're marked finished in the ledger once the results
+        #    are written.
+        self.unwritten = []
+        # Streams jobs from the input files. Created in the controller's
+        #    process by fill_q().
+        self.reader = None
 
     def fill_q(self, req_q):
-        """ Creates and maintains a jobs list using the input files. Uses
-        the jobs list to fill the request queue. When no input files or jobs
-        are left, it inserts a special item "CLEANUP". This item works to 
-        synchronize the crawler processes that join on encountering "CLEANUP"
-        item.
+        """Puts jobs from the input reader, which parses the input files in
+        the background, on the request queue, blocking while it is full. 
+        When all input files are exhausted, it inserts a special item 
+        "CLEANUP". This item works to synchronize the crawler processes that
+        join on encountering "CLEANUP" item.
         """
-        if not self.jobs and self.req_file_list:
-            # Note that pop() gets the last element in the list.
-            self.logger.debug("jobs list has 0 jobs. Adding some.")
-            fh = file(self.req_file_list.pop())
-            obj = json.load(fh)
-            self.jobs.extend(obj.iteritems())
-            self.logger.debug("Jobs in queue: %s" % self.jobs)
-        if self.jobs:
-            self.logger.info("Adding jobs to request q from jobs list")
-            # Pop elements from self.job and put them into request q.
-            while self.jobs:
-                job = self.jobs.pop()
-                try:
-                    req_q.put_nowait(job)
-                    print job
-                except Queue.Full:
-                    self.logger.debug("Request queue is full")
-                    # Add the job back to the self list and leave.
-                    self.jobs.append(job)
-                    break
-        else:
-            self.logger.info(("No more input files or request urls left.\n"))
-            # The queue will have a special entry called "CLEANUP". This 
-            #    serves as a flag to cleanup and avoids needless inter-process
-            #    communication.
-            if not self.cleanup:
-                self.logger.info("Setting CLEANUP flag.")
-                req_q.put("CLEANUP")
-                self.cleanup = True
-        
-    def empty_q(self, res_q):
-        """Grabs entries from result q and writes them to file.
+        self._put_jobs(req_q, self._input_jobs())
+        self._put_cleanup(req_q)
+
+    def _with_retries(self, jobs):
+        """Yields the jobs from the iterator jobs, each followed by a retry 
+        if one is due. Once jobs is exhausted, yields retries as they fall
+        due until no job can fail anymore.
+        """
+        for job in jobs:
+            self.retries.track(job)
+            yield job
+            retry = self.retries.pop_due()
+            if retry:
+                self.retries.track(retry)
+                yield retry
+        self.logger.info("Waiting for jobs that may need retrying.")
+        while True:
+            retry = self.retries.wait_due()
+            if retry is None:
+                break
+            self.retries.track(retry)
+            yield retry
+
+    def _input_jobs(self):
+        """Yields the jobs to visit. When resuming, jobs that were in flight
+        come first, and finished jobs are skipped.
         """
-        self.logger.debug("Writing results to file")
+        # Ids of in flight jobs that were put on the queue again.
+        requeued = set()
+        if self.ledger and self.ledger.resume:
+            counts = self.ledger.counts()
+            self.logger.info("Resuming crawl. Jobs in ledger: %s" % counts)
+            for job in self.ledger.in_flight():
+                requeued.add(job[0])
+                yield job
+        self.reader = InputReader(self.req_file_list, self.logger)
+        self.logger.info("Adding jobs to request q from input reader")
+        skipped = 0
         while True:
+            job = self.reader.get()
+            if job == InputReader.END:
+                break
+            if (self.ledger and self.ledger.resume and 
+                (job[0] in requeued or self.ledger.is_finished(job[0]))):
+                    skipped += 1
+                    continue
+            yield job
+        if skipped:
+            self.logger.info("Skipped %s jobs finished or requeued earlier"
+                             % skipped)
+
+    def _put_jobs(self, req_q, jobs):
+        """Puts the jobs from the iterator jobs on the request queue. With a
+        scheduler, a thread adds the jobs to it, and they are put on the 
+        queue in the order the scheduler hands them out.
+        """
+        if self.retries:
+            jobs = self._with_retries(jobs)
+        if not self.scheduler:
+            for job in jobs:
+                self._put_job(req_q, job)
+                if self.retries:
+                    self.retries.handed_out(job[0])
+            return
+        def add_jobs():
             try:
-                result_list = res_q.get_nowait()
-                self.write_to_file(result_list)
-                res_q.task_done()
-            except Queue.Empty:
-                self.logger.debug("Emptied results to file.")
+                for job in jobs:
+                    self.scheduler.add(job)
+            except Exception, e:
+                self.logger.critical("Error reading jobs: %s" 
+                                     % traceback.format_exc())
+            self.scheduler.close()
+        adder = threading.Thread(target=add_jobs, name="QScheduler")
+        adder.daemon = True
+        adder.start()
+        while True:
+            job = self.scheduler.next()
+            if job is None:
                 break
+            self._put_job(req_q, job)
+            if self.retries:
+                self.retries.handed_out(job[0])
+
+    def _put_job(self, req_q, job):
+        if self.ledger:
+            self.ledger.mark_queued(job[0], job[1])
+        req_q.put(job)
+        print job
+
+    def _put_cleanup(self, req_q):
+        self.logger.info(("No more input files or request urls left.\n"))
+        # The queue will have a special entry called "CLEANUP". This 
+        #    serves as a flag to cleanup and avoids needless inter-process
+        #    communication.
+        self.logger.info("Setting CLEANUP flag.")
+        req_q.put("CLEANUP")
+        self.cleanup = True
             
     def write_to_file(self, result_list):
-        """Writes the visit to filename fname in json format.
+        """Writes the visits in result_list to the result sink.
+        """
+        self.sink.write(result_list)
+
+    def handle_result(self, job_id, result_list, attempt):
+        if self.retries and self.retries.finished(job_id, attempt):
+            self.logger.info("Visit of %s failed with %s. Retrying later." 
+                             % (job_id, attempt['status']))
+            if self.scheduler:
+                self.scheduler.done(job_id)
+            return
+        QController.handle_result(self, job_id, result_list, attempt)
+
+    def job_done(self, job_id, result_list):
+        if self.scheduler:
+            self.scheduler.done(job_id)
+        if self.ledger:
+            self.unwritten.append((job_id, result_list))
+            self._mark_written()
+
+    def _mark_written(self):
+        """Marks the jobs finished in the ledger once the sink has written
+        all their results.
         """
-        for (fname, result_dict) in result_list:
-            fh = open(fname, "w")
-            json.dump(result_dict, fh, indent=4)
-            fh.close()
+        if self.unwritten and not self.sink.pending():
+            self.ledger.mark_finished(self.unwritten)
+            self.unwritten = []
+
+    def flush(self):
+        self.sink.flush()
+        if self.ledger:
+            self._mark_written()
+
+    def finish(self):
+        if self.retries and self.retries.pending():
+            self.logger.error("Crawlers exited with %s jobs waiting for a "
+                              "retry" % self.retries.pending())
+        self.logger.debug("Closing result sink")
+        self.sink.close()
+        if self.ledger:
+            self._mark_written()
+            self.logger.info("Jobs in ledger: %s" % self.ledger.counts())
+            self.ledger.close()
+
+
+class SqliteQController(FileQController):
+    """Handles the queues using a jobs database, see ledger.JobDB. Input 
+    files are imported into the database once, and jobs are handed out with
+    indexed queries, so the number of jobs isn't limited by memory. Results
+    are written to the sink as with FileQController, and their metadata is
+    kept in the database. Running again with the same database continues 
+    the crawl: jobs that were handed out but never finished are handed out
+    again.
+    """
+    def __init__(self, db_path, req_file_list, num_browser, log_q, 
+                 sink=None, scheduler=None, retries=None):
+        FileQController.__init__(self, req_file_list, num_browser, log_q, 
+                                 sink, JobDB(db_path), scheduler, retries)
+
+    def fill_q(self, req_q):
+        """Imports new input files, then puts pending jobs on the request 
+        queue in order of priority, blocking while it is full. Inserts the 
+        special item "CLEANUP" when no pending jobs are left.
+        """
+        self._put_jobs(req_q, self._input_jobs())
+        self._put_cleanup(req_q)
+
+    def _input_jobs(self):
+        requeued = self.ledger.requeue_in_flight()
+        if requeued:
+            self.logger.info("%s jobs in flight in the last crawl are "
+                             "pending again" % requeued)
+        for path in self.req_file_list:
+            if self.ledger.is_imported(path):
+                self.logger.info("%s was imported before" % path)
+                continue
+            self.logger.info("Importing jobs from %s" % path)
+            try:
+                count = self.ledger.import_jobs(path, iter_jobs(path))
+                self.logger.info("Imported %s jobs from %s" % (count, path))
+            except Exception, e:
+                self.logger.error("Error importing %s: %s" % (path, e))
+        self.logger.info("Jobs in database: %s" % self.ledger.counts())
+        while True:
+            jobs = self.ledger.next_jobs(config.REQUEST_Q_SIZE)
+            if not jobs:
+                break
+            for job in jobs:
+                yield job
+
+    def _put_job(self, req_q, job):
+        # The database marked the job queued when handing it out.
+        req_q.put(job)
+        self.logger.debug("Queued job %s" % job[0])
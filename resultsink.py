@@ -0,0 +1,232 @@
+"""Sinks that the queue controller writes visit results to. A result is a
+list of (fname, visit) tuples as returned by CrawlerProcess.grab(), where
+fname is the visit chain file name for the visit.
+
+Author: nchachra@cs.ucsd.edu
+"""
+
+import gzip
+import os
+import simplejson as json
+import time
+
+import config
+from packfile import pack_prefix, PackWriter
+
+
+class ResultSink:
+    """Base class for result sinks. Sinks open their files on first use, so
+    they can be created before the queue controller's process is forked.
+    """
+    def __init__(self, logger=None):
+        self.logger = logger
+
+    def write(self, result_list):
+        raise NotImplementedError('Subclass must implement write method.')
+
+    def flush(self, force=False):
+        """Writes out buffered results. Unless force is set, sinks may keep
+        buffering if it's not yet time to flush.
+        """
+        pass
+
+    def pending(self):
+        """Returns the number of visits handed to write() that haven't been
+        written out yet.
+        """
+        return 0
+
+    def close(self):
+        self.flush(force=True)
+
+
+class FileSink(ResultSink):
+    """Writes every visit to its own file fname, as pretty printed JSON.
+    """
+    def write(self, result_list):
+        for (fname, result_dict) in result_list:
+            fh = open(fname, "w")
+            json.dump(result_dict, fh, indent=4)
+            fh.close()
+
+
+class PackSink(ResultSink):
+    """Appends every visit to a pack in directory as a 'visitchain' record
+    with fname as the key. See packfile.
+    """
+    def __init__(self, directory, logger=None):
+        ResultSink.__init__(self, logger)
+        self.directory = directory
+        self.pack_writer = None
+
+    def write(self, result_list):
+        if self.pack_writer is None:
+            self.pack_writer = PackWriter(self.directory,
+                                          pack_prefix('sink'),
+                                          logger=self.logger)
+        for (fname, result_dict) in result_list:
+            self.pack_writer.append('visitchain', fname,
+                                    json.dumps(result_dict))
+
+    def close(self):
+        if self.pack_writer:
+            self.pack_writer.close()
+
+
+class JsonlSink(ResultSink):
+    """Writes visits as compact JSON, one per line, into shards in directory
+    named <host>_<pid>-<seq>.jsonl (or .jsonl.gz with compress). A line is
+    {"id": fname, "visit": visit}. Lines are buffered and written in batches
+    of batch_size, or once the oldest buffered line is flush_interval
+    seconds old. A new shard is started once a shard holds max_size bytes
+    of JSON, or is max_age seconds old.
+
+    The mapping of fname to shard is kept in <host>_<pid>.index next to the
+    shards, with one line per visit:
+
+        <fname>\t<shard>\t<offset>\t<length>
+
+    where offset and length locate the line in the uncompressed shard.
+    """
+    def __init__(self, directory, compress=False,
+                 max_size=config.RESULT_SHARD_SIZE,
+                 max_age=config.RESULT_SHARD_AGE,
+                 batch_size=config.RESULT_BATCH_SIZE,
+                 flush_interval=config.RESULT_FLUSH_INTERVAL, logger=None):
+        ResultSink.__init__(self, logger)
+        self.directory = directory
+        self.compress = compress
+        self.max_size = max_size
+        self.max_age = max_age
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.prefix = None
+        self.seq = -1
+        self.shard_fh = None
+        self.index_fh = None
+        self.shard_opened = 0
+        # Uncompressed bytes written to the current shard.
+        self.shard_size = 0
+        # [(fname, line)] not yet written.
+        self.buffer = []
+        self.buffered_since = None
+
+    def shard_name(self):
+        name = '%s-%05d.jsonl' % (self.prefix, self.seq)
+        if self.compress:
+            name += '.gz'
+        return name
+
+    def _open(self):
+        """Opens the index and the first shard. Shards from an earlier run
+        with the same prefix are never appended to.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.prefix = '%s_%s' % (os.uname()[1], os.getpid())
+        while True:
+            self.seq += 1
+            path = os.path.join(self.directory, self.shard_name())
+            if not os.path.exists(path):
+                break
+        self.seq -= 1
+        self.index_fh = open(os.path.join(self.directory,
+                                          self.prefix + '.index'), 'ab')
+        self._rotate()
+
+    def _rotate(self):
+        """Closes the current shard, if any, and starts the next one.
+        """
+        if self.shard_fh:
+            self.shard_fh.close()
+        self.seq += 1
+        path = os.path.join(self.directory, self.shard_name())
+        if self.compress:
+            self.shard_fh = gzip.open(path, 'wb')
+        else:
+            self.shard_fh = open(path, 'wb')
+        self.shard_opened = time.time()
+        self.shard_size = 0
+        if self.logger:
+            self.logger.info("Writing results to %s" % path)
+
+    def write(self, result_list):
+        for (fname, result_dict) in result_list:
+            line = json.dumps({'id': fname, 'visit': result_dict},
+                              separators=(',', ':')) + '\n'
+            if not self.buffer:
+                self.buffered_since = time.time()
+            self.buffer.append((fname, line))
+        self.flush()
+
+    def flush(self, force=False):
+        if not self.buffer:
+            return
+        if (not force and len(self.buffer) < self.batch_size and
+            time.time() - self.buffered_since < self.flush_interval):
+                return
+        if self.shard_fh is None:
+            self._open()
+        index_lines = []
+        for (fname, line) in self.buffer:
+            if (self.shard_size >= self.max_size or
+                time.time() - self.shard_opened >= self.max_age):
+                    self._rotate()
+            self.shard_fh.write(line)
+            index_lines.append('%s\t%s\t%d\t%d\n' % (fname,
+                                                     self.shard_name(),
+                                                     self.shard_size,
+                                                     len(line)))
+            self.shard_size += len(line)
+        self.shard_fh.flush()
+        # The index only lists visits that have been written.
+        self.index_fh.write(''.join(index_lines))
+        self.index_fh.flush()
+        self.buffer = []
+        self.buffered_since = None
+
+    def pending(self):
+        return len(self.buffer)
+
+    def close(self):
+        self.flush(force=True)
+        if self.shard_fh:
+            self.shard_fh.close()
+            self.index_fh.close()
+            self.shard_fh = None
+            self.index_fh = None
+
+
+def read_index(directory):
+    """Returns {fname: (shard, offset, length)} for all JsonlSink indexes in
+    directory. Later entries win.
+    """
+    index = {}
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.index'):
+            continue
+        fh = open(os.path.join(directory, name), 'rb')
+        for line in fh:
+            if not line.endswith('\n'):
+                break
+            (fname, shard, offset, length) = line[:-1].split('\t')
+            index[fname] = (shard, int(offset), int(length))
+        fh.close()
+    return index
+
+
+def read_visit(directory, shard, offset, length):
+    """Returns the visit stored at offset in shard, as located by
+    read_index().
+    """
+    path = os.path.join(directory, shard)
+    if shard.endswith('.gz'):
+        fh = gzip.open(path, 'rb')
+    else:
+        fh = open(path, 'rb')
+    try:
+        # Seeking in a gzip file decompresses up to the offset.
+        fh.seek(offset)
+        return json.loads(fh.read(length))['visit']
+    finally:
+        fh.close()
@@ -0,0 +1,150 @@
+"""Retrying failed visits. Crawlers report every attempt at a job as a
+dictionary {'status': status, 'proxy': proxy, 'time': start time}, where
+status is None for a visit that worked, or config.PAGE_TIMEOUT_ST,
+PROXY_ERR_ST, FIREFOX_ERR_ST or VISIT_EXCEPTION_ST. The queue controller
+hands failed jobs to a RetryQueue, which makes them due again after an
+exponential backoff.
+
+The attempts made so far travel with the job as its "attempts" list, which
+crawlers add to the visit chain.
+
+Author: nchachra@cs.ucsd.edu
+"""
+
+import heapq
+import threading
+import time
+
+import config
+
+
+RETRY_STATUSES = (config.PAGE_TIMEOUT_ST, config.PROXY_ERR_ST,
+                  config.FIREFOX_ERR_ST, config.VISIT_EXCEPTION_ST)
+
+
+class RetryQueue:
+    """Tracks the jobs out for visiting and holds failed ones until they are
+    due again. A job is tried at most max_attempts times. The n-th retry is
+    due backoff * 2^(n-1) seconds after the failure, but no later than
+    max_backoff seconds. With new_proxy, the job asks crawlers to avoid the
+    proxy of the failed attempt. A job that hasn't been reported on stale
+    seconds after it was handed out, because its crawler died, is 
+    forgotten. Thread safe.
+    """
+    def __init__(self, max_attempts, backoff=config.RETRY_BACKOFF,
+                 max_backoff=config.RETRY_MAX_BACKOFF, new_proxy=False,
+                 stale=2 * config.ALARM_TIME):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.new_proxy = new_proxy
+        self.stale = stale
+        self.cond = threading.Condition()
+        # {job id: (job, time handed out)} for jobs out for visiting. The
+        #    time is None while the job waits to be handed out, e.g. in a
+        #    scheduler.
+        self.out = {}
+        # Heap of (due time, job id, job).
+        self.delayed = []
+
+    def track(self, job):
+        """Called for every (job id, job) tuple to be visited, before it is
+        handed out.
+        """
+        self.cond.acquire()
+        try:
+            self.out[job[0]] = (job, None)
+        finally:
+            self.cond.release()
+
+    def handed_out(self, job_id):
+        """Called once the job is on the request queue. It goes stale from
+        then on.
+        """
+        self.cond.acquire()
+        try:
+            if self.out.has_key(job_id):
+                self.out[job_id] = (self.out[job_id][0], time.time())
+                self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def finished(self, job_id, attempt):
+        """Called with the attempt reported for job_id. Returns True if the
+        job failed and will be retried, in which case its results should be
+        dropped.
+        """
+        self.cond.acquire()
+        try:
+            (job, _) = self.out.pop(job_id, (None, None))
+            try:
+                if (job is None or not attempt or
+                    attempt.get('status') not in RETRY_STATUSES):
+                        return False
+                attempts = job[1].get('attempts', []) + [attempt]
+                if len(attempts) >= self.max_attempts:
+                    return False
+                # The job dictionary may be shared, e.g. with a ledger.
+                retry = dict(job[1])
+                retry['attempts'] = attempts
+                if self.new_proxy and attempt.get('proxy'):
+                    retry['avoid_proxy'] = attempt['proxy']
+                delay = min(self.backoff * 2 ** (len(attempts) - 1),
+                            self.max_backoff)
+                heapq.heappush(self.delayed,
+                               (time.time() + delay, job_id, (job_id, retry)))
+                return True
+            finally:
+                self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def pop_due(self):
+        """Returns a job whose retry is due, or None.
+        """
+        self.cond.acquire()
+        try:
+            if self.delayed and self.delayed[0][0] <= time.time():
+                return heapq.heappop(self.delayed)[2]
+            return None
+        finally:
+            self.cond.release()
+
+    def wait_due(self):
+        """Blocks until a retry is due and returns it. Returns None once no
+        jobs are out and no retries are left.
+        """
+        self.cond.acquire()
+        try:
+            while True:
+                now = time.time()
+                for (job_id, (job, since)) in self.out.items():
+                    if since is not None and since + self.stale < now:
+                        del self.out[job_id]
+                if not self.delayed and not self.out:
+                    return None
+                if self.delayed and self.delayed[0][0] <= now:
+                    return heapq.heappop(self.delayed)[2]
+                # Check again when the first retry is due or the first job
+                #    goes stale.
+                waits = [self.delayed[0][0] - now] if self.delayed else []
+                handed_out = [since for (job, since) in self.out.itervalues()
+                              if since is not None]
+                if handed_out:
+                    waits.append(min(handed_out) + self.stale - now)
+                wait = None
+                if waits:
+                    wait = min(waits)
+                # finished() and handed_out() wake us up as well.
+                self.cond.wait(wait)
+        finally:
+            self.cond.release()
+
+    def pending(self):
+        """Returns the number of jobs waiting for a retry.
+        """
+        self.cond.acquire()
+        try:
+            return len(self.delayed)
+        finally:
+            self.cond.release()
@@ -15,9 +15,11 @@ import logging
 import logging.handlers
 import multiprocessing as mp
 import os
+import Queue
 import simplejson as json
 import subprocess
 import sys
+import threading
 import time
 import traceback
 
@@ -54,11 +56,21 @@ except ImportError:
     import re
 
 # Stallone specific
+from asynccrawler import Supervisor
+from browser import stage_profile_template
 import config
 from crawlerprocess import CrawlerProcess
 import crawlglobs
+from distributed import (JobBroker, parse_address, RemoteRequestQueue, 
+                         RemoteResultQueue, serve_broker)
+from ledger import Ledger
+import metrics
 import mplogging
-from qcontroller import FileQController
+from qcontroller import FileQController, SqliteQController
+from resultsink import FileSink, JsonlSink, PackSink
+from retryqueue import RetryQueue
+from scheduler import HostScheduler
+from startup import StartupSlots
 import utils
 
 def setup_args():
@@ -140,18 +152,162 @@ def setup_args():
                  'in the input files, then the files will be saved as their\n'+
                  ' md5.extension. If visit chains are not being saved, the \n'+
                  'mapping of feature:filename will be lost.')
+    parser.add_argument('--blob-store',
+            help='Directory for a content addressed store of DOMs and \n' +
+                 'screenshots. When given, files that would be named \n' +
+                 'with their md5 go into this store instead of the \n' +
+                 'directory chosen by --screenshot-dir/--dom-dir. Files \n' +
+                 'are sharded into subdirectories by the leading digits of\n'+
+                 'their md5, e.g. <blob-store>/ab/cd/abcd...png, and an \n' +
+                 'index of md5 -> size, first seen time is kept in \n' +
+                 '<blob-store>/index.sqlite. Files with a user specified \n'+
+                 'name are not affected.')
+    parser.add_argument('--pack-dir',
+            help='Pack mode. DOMs, screenshots and visit chains are \n' +
+                 'appended to large rolling pack files in this directory \n'+
+                 'instead of being written one file each, so that the \n' +
+                 'storage only sees large sequential writes. Each process \n'+
+                 'writes its own <host>_<pid>-<seq>.pack files, and every \n'+
+                 'pack has a .idx file listing the kind, key, offset and \n'+
+                 'length of its records. The key is the path the file \n' +
+                 'would have had outside pack mode, or <md5>.<ext> for \n' +
+                 'files named with their md5. Use helpers/packreader.py \n' +
+                 'to list and extract records.')
+    parser.add_argument('--results-format', choices=['json', 'jsonl'],
+            default='json',
+            help='How visit chains are written. json writes every visit \n'+
+                 'chain to its own pretty printed file as described for \n'+
+                 '--visit-chain-dir. jsonl appends them as compact JSON, \n'+
+                 'one visit per line, to <host>_<pid>-<seq>.jsonl shard \n'+
+                 'files in --results-dir. Each line is \n' +
+                 '    {"id": <visit chain file name>, "visit": [...]} \n' +
+                 'and <host>_<pid>.index lists the file name, shard, \n' +
+                 'offset and length of every visit, so a visit can still \n'+
+                 'be found by the file name it would have had. Ignored \n' +
+                 'with --pack-dir. Default: json')
+    parser.add_argument('--results-dir',
+            help='Directory for jsonl result shards. Default: \n' +
+                 '--visit-chain-dir, or the current directory.')
+    parser.add_argument('--results-gzip', action='store_true', default=False,
+            help='gzip jsonl result shards (.jsonl.gz).')
+    parser.add_argument('--results-shard-size', type=int,
+            default=config.RESULT_SHARD_SIZE / (1024 * 1024),
+            help='Start a new jsonl shard once the current one holds \n' +
+                 'this many MB of JSON. Default: %(default)s')
+    parser.add_argument('--results-shard-age', type=int,
+            default=config.RESULT_SHARD_AGE,
+            help='Start a new jsonl shard once the current one is this \n' +
+                 'many seconds old. Default: %(default)s')
+    parser.add_argument('--results-batch', type=int,
+            default=config.RESULT_BATCH_SIZE,
+            help='Write jsonl results in batches of this many visits. \n'+
+                 'Buffered visits are also written once the oldest is \n' +
+                 '%s seconds old. Default: %%(default)s'
+                 % config.RESULT_FLUSH_INTERVAL)
+    parser.add_argument('--ledger',
+            help='SQLite database recording which jobs are in flight and \n'+
+                 'which have finished, for --resume. Default: \n' +
+                 '<log-dir>/%s' % config.LEDGER_FILENAME)
+    parser.add_argument('--resume', action='store_true', default=False,
+            help='Resume a crawl that died, using its --ledger (or \n' +
+                 '--log-dir). Jobs that finished are skipped, and jobs \n' +
+                 'that were in flight are visited first. Give the same \n' +
+                 'input files as before. Without --resume, the ledger is \n'+
+                 'started afresh.')
+    parser.add_argument('--queue-db',
+            help='Use an SQLite jobs database at this path instead of \n' +
+                 'streaming the input files. New input files are \n' +
+                 'imported into it once, jobs are handed out by priority \n'+
+                 '(the optional "priority" key of a job, higher first), \n'+
+                 'and the metadata of every visit chain is recorded in \n' +
+                 'its results table. Running again with the same database\n'+
+                 'continues the crawl; --ledger and --resume are not \n' +
+                 'needed.')
+    parser.add_argument('--polite', action='store_true', default=False,
+            help='Interleave jobs across hosts and limit how hard a \n' +
+                 'single host is hit, see --host-max-jobs and \n' +
+                 '--host-delay. Jobs are looked ahead at, up to \n' +
+                 '--host-window of them, to keep the browsers busy with \n'+
+                 'other hosts while one host cools down.')
+    parser.add_argument('--host-max-jobs', type=int, 
+            default=config.HOST_MAX_JOBS,
+            help='With --polite, the most jobs of one host being visited\n'+
+                 'at once. 0 for no limit. Default: %(default)s')
+    parser.add_argument('--host-delay', type=float, 
+            default=config.HOST_MIN_DELAY,
+            help='With --polite, the least seconds between starting \n' +
+                 'visits to one host. Default: %(default)s')
+    parser.add_argument('--host-window', type=int, default=config.HOST_WINDOW,
+            help='With --polite, the most jobs looked ahead at. \n' +
+                 'Default: %(default)s')
+    parser.add_argument('--host-window-per-host', type=int, 
+            default=config.HOST_WINDOW_PER_HOST,
+            help='With --polite, the most jobs of one host looked \n' +
+                 'ahead at. The rest of its jobs wait for their turn, \n' +
+                 'up to --host-window of them. Default: %(default)s')
+    parser.add_argument('--retries', type=int, default=0,
+            help='Retry visits that time out (%s), fail with a proxy \n'
+                 % config.PAGE_TIMEOUT_ST +
+                 '(%s) or Firefox (%s) error, or raise an exception \n'
+                 % (config.PROXY_ERR_ST, config.FIREFOX_ERR_ST) +
+                 '(%s) up to this many times. Retries are due after \n'
+                 % config.VISIT_EXCEPTION_ST +
+                 '--retry-backoff seconds, doubling with every attempt, \n'+
+                 'and are queued behind fresh jobs. The earlier attempts \n'+
+                 'are listed under "attempts" in the last page of the \n' +
+                 'visit chain. Default: %(default)s')
+    parser.add_argument('--retry-backoff', type=float, 
+            default=config.RETRY_BACKOFF,
+            help='Seconds before the first retry of a failed visit. \n' +
+                 'Default: %(default)s')
+    parser.add_argument('--retry-new-proxy', action='store_true', 
+            default=False,
+            help='Retry failed visits through a different proxy from \n' +
+                 '--proxy-file than the failed attempt used.')
+    parser.add_argument('--coordinator', metavar='HOST:PORT',
+            help='Also serve the jobs to workers on other machines at \n' +
+                 'this address, see --worker. Results come back here and \n'+
+                 'are written as usual. A job handed to a worker is \n' +
+                 'leased to it, and handed out again if the worker stops \n'+
+                 'renewing its leases for %s seconds. The coordinator \n'
+                 % config.DIST_LEASE_TIME +
+                 'runs <num_browser> browsers of its own, which may be 0.')
+    parser.add_argument('--worker', metavar='HOST:PORT',
+            help='Run <num_browser> browsers visiting jobs from the \n' +
+                 'coordinator at this address instead of input files. \n'+
+                 'DOMs and screenshots are stored on the worker as given \n'+
+                 'by its --dom-dir/--screenshot-dir/--pack-dir, so these \n'+
+                 'usually point at shared storage. Visit chains are sent \n'+
+                 'to the coordinator. Several workers on one machine need \n'+
+                 'different --ext-start-port values, which are twice \n' +
+                 '<num_browser> apart with --standby-browser.')
+    parser.add_argument('--authkey',
+            help='Shared secret of the coordinator and its workers, \n' +
+                 'required with --coordinator and --worker. It can also \n'+
+                 'be given with --authkey-file or the %s \n' 
+                 % config.DIST_AUTHKEY_ENV +
+                 'environment variable, which keeps it out of the process\n'+
+                 'list. The coordinator runs code sent by anyone who has \n'+
+                 'the key, so use a long random one, and never expose \n' +
+                 'the coordinator\'s port to untrusted networks.')
+    parser.add_argument('--authkey-file', type=file,
+            help='File whose first line is the shared secret, see \n' +
+                 '--authkey.')
     parser.add_argument('-i', '--input-file', action='append',
             help='Input file/directory containing URLs. Either specify \n'+
                  'any number of input files or a single input directory \n'+
                  'containing the input files. For example: \n' +
                  '    python run.py -i input1.json -i input2.json \n' +
                  'or \n' +
-                 '    python run.py -i /path/to/input/directory \n',
-            required=True)
+                 '    python run.py -i /path/to/input/directory \n' +
+                 'Files ending in .jsonl hold one JSON object of \n' +
+                 '{"<id>": <job>} per line, other files a single JSON \n' +
+                 'object of all jobs. Both are read incrementally. \n' +
+                 'Required unless --queue-db or --worker is given.')
     parser.add_argument('-n', '--num_browser', type=int, 
             help='Maximum number of browser instances to run in parallel. \n'+
-                 'A single browser instance visits only a single URL at a \n'+
-                 'time.', 
+                 'Unless --tabs is given, a browser instance visits only \n'+
+                 'a single URL at a time.', 
             required=True)
     parser.add_argument('--ext-start-port', default=4000, type=int, 
             help='This script communicates with Firefox extension \n' +
@@ -163,7 +319,99 @@ def setup_args():
             help='Giving this argument forces browser restart for every \n' +
                  'visit. While this will provide sanity, the browser \n' +
                  'typically takes up to 5 seconds to be set up so for \n' +
-                 'efficiency, this option is disabled by default')
+                 'efficiency, this option is disabled by default. Same \n'+
+                 'as --restart-policy always.')
+    parser.add_argument('--restart-policy', 
+            choices=['visits', 'always', 'reset', 'memory'], 
+            default=config.RESTART_POLICY,
+            help='When to restart the browser. "visits" restarts it \n' +
+                 'every %s visits, "always" for every visit. \n'
+                 % config.MAX_BROWSER_VISITS_PER_RESTART +
+                 '"reset" keeps the browser, but wipes cookies, cache, \n'+
+                 'storage, history, permissions and extra windows between\n'+
+                 'visits, which isolates visits almost as well as a \n' +
+                 'restart in a fraction of the time. The browser is then \n'+
+                 'only restarted if it crashed, its state could not be \n' +
+                 'wiped, or every %s visits. "memory" only \n' 
+                 % config.RESET_MAX_VISITS_PER_RESTART +
+                 'restarts it if it crashed. Except for "always", a \n' +
+                 'browser is also restarted once it exceeds \n' +
+                 '--browser-max-rss or --browser-max-growth. \n' +
+                 'Default: %(default)s')
+    parser.add_argument('--browser-max-rss', type=int, 
+            default=config.BROWSER_MAX_RSS / 2**20,
+            help='Restart a browser once its processes use more than \n' +
+                 'this many MB of memory. 0 for no limit. Memory and CPU\n'+
+                 'use of browsers is logged after every visit and \n' +
+                 'reported with its results. Default: %(default)s')
+    parser.add_argument('--browser-max-growth', type=int, 
+            default=config.BROWSER_MAX_GROWTH / 2**20,
+            help='Restart a browser once its memory use grew by more \n' +
+                 'than this many MB per visit on average over its last \n' +
+                 '%s visits. 0 for no limit. Default: %%(default)s'
+                 % config.BROWSER_GROWTH_VISITS)
+    parser.add_argument('--tabs', type=int, default=1,
+            help='Number of URLs each browser visits at once, each in a \n'+
+                 'tab of its own. Tabs take far less memory than \n' +
+                 'browsers. The tabs of a browser share its cookies, \n' +
+                 'cache, Firefox prefs and proxy, which is picked from \n' +
+                 '--proxy-file when the browser starts. Pages in \n' +
+                 'background tabs run their timers at most once a \n' +
+                 'second. Can\'t be used with --restart-policy always or \n'+
+                 'reset. Default: %(default)s')
+    parser.add_argument('--engine', choices=['processes', 'async'],
+            default='processes',
+            help='"processes" runs every browser in a crawler process of \n'+
+                 'its own. "async" drives all browsers from the main \n' +
+                 'process with an event loop, which needs far less \n' +
+                 'memory and CPU per browser, and runs the queue \n' +
+                 'controller in the main process as well, so jobs and \n' +
+                 'results are never pickled. Screenshots are still \n' +
+                 'compressed by --screenshot-workers processes per \n' +
+                 'browser. A visit that takes longer than %s seconds \n'
+                 % config.ALARM_TIME +
+                 'is cancelled and its browser restarted. Can\'t be used \n'+
+                 'with --tabs, --standby-browser or --restart-policy \n' +
+                 'reset. Default: %(default)s')
+    parser.add_argument('--standby-browser', action='store_true', 
+            default=False,
+            help='Keep a spare browser per crawler starting up in the \n' +
+                 'background, and switch to it when the browser is due \n' +
+                 'for a restart, instead of waiting for a new one. This \n'+
+                 'makes --restart-browser cheap, at the cost of twice as \n'+
+                 'many browsers in memory. The spare browsers use the \n' +
+                 '<num-browser> ports following those of the crawlers.')
+    parser.add_argument('--startup-concurrency', type=int, 
+            default=config.STARTUP_CONCURRENCY,
+            help='Number of browsers that may be starting up at once. \n' +
+                 'Starting all of them at once thrashes the disk and CPU,\n'+
+                 'so that they come up later than if they had started a \n'+
+                 'few at a time. The time each browser took to come up is \n'+
+                 'logged. 0 for no limit. Default: %(default)s')
+    parser.add_argument('--screenshot-workers', type=int,
+            default=config.SCREENSHOT_WORKERS,
+            help='Number of processes per browser that compress (pngnq),\n'+
+                 'hash and store screenshots in the background while the \n'+
+                 'browser moves on to the next URL. 0 compresses the \n' +
+                 'screenshot before the next visit. Default: %(default)s')
+    parser.add_argument('--load-policy', choices=['onload', 'idle'],
+            default=config.LOAD_POLICY,
+            help='Decides when a page counts as loaded. "onload" waits \n' +
+                 'for the load event. "idle" waits for the load event \n' +
+                 'followed by --idle-time seconds without any request in \n'+
+                 'flight, but no more than --idle-cap seconds after the \n' +
+                 'DOM is ready. Pages that never stop making requests then\n'+
+                 'finish in seconds instead of taking the full page \n' +
+                 'timeout. Can be overridden per visit with "load_policy"\n'+
+                 'in the setup of the input file. Default: %(default)s')
+    parser.add_argument('--idle-time', type=float, default=config.IDLE_TIME,
+            help='Seconds without requests in flight after which a page \n'+
+                 'is loaded under the "idle" load policy. \n' +
+                 'Default: %(default)s')
+    parser.add_argument('--idle-cap', type=float, default=config.IDLE_CAP,
+            help='Maximum seconds after the DOM is ready that the "idle" \n'+
+                 'load policy waits for the network to go idle. 0 means \n' +
+                 'no cap. Default: %(default)s')
     parser.add_argument('--version', action='version', version='Stallone 0.1',
             help='displays the crawler version.')
     parser.add_argument('-b', '--browser', choices=['Firefox'],
@@ -191,6 +439,16 @@ def setup_args():
             default=False, 
             help="By default the logs are shown on stdout and sent to the \n"+
             "the log files. Use this option to suppress output on stdout.")
+    parser.add_argument('--metrics-port', type=int, default=0,
+            help='Serve metrics of the crawl at \n' +
+                 'http://%s:<metrics-port>/metrics in the \n' 
+                 % config.METRICS_HOST +
+                 'Prometheus text format: visits and visit rate by status\n'+
+                 'and proxy, latency of each phase of the visits, browser\n'+
+                 'starts and restarts, bytes of DOMs and screenshots \n' +
+                 'written and the depth of the request and result queues.\n'+
+                 'Workers serve the metrics of their own browsers. \n' +
+                 '0 for none. Default: %(default)s')
     parser.add_argument('--tags-file', type=file, 
             help="JSON file with dictionaries of tags:\n" +
             '{ \n' +
@@ -216,7 +474,107 @@ def setup_args():
             cause the crawler to crash to this recipient. The crash summary is\
             also saved in log folder.')
     '''
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.tabs > 1 and (args.restart_browser or 
+                          args.restart_policy in ('always', 'reset')):
+        parser.error("--tabs can't be used with restarts for every visit")
+    if args.engine == 'async' and (args.tabs > 1 or args.standby_browser or
+                                   args.restart_policy == 'reset'):
+        parser.error("--engine async can't be used with --tabs, " +
+                     "--standby-browser or --restart-policy reset")
+    if not args.input_file and not args.queue_db and not args.worker:
+        parser.error("argument -i/--input-file is required")
+    if args.authkey_file:
+        args.authkey = args.authkey_file.readline().strip()
+        args.authkey_file.close()
+    elif not args.authkey:
+        args.authkey = os.environ.get(config.DIST_AUTHKEY_ENV)
+    if (args.coordinator or args.worker) and not args.authkey:
+        parser.error("--coordinator and --worker need a shared secret, " +
+                     "from --authkey, --authkey-file or %s" 
+                     % config.DIST_AUTHKEY_ENV)
+    return args
+
+def run_crawlers(args, logger, request_q, result_q, broker=None):
+    """Starts <num_browser> crawler processes visiting jobs from request_q
+    and returns once they have all exited. With --engine async, the browsers
+    are driven from this process instead. In worker mode, the crawlers use
+    the coordinator's queues instead. broker is the coordinator's JobBroker
+    in coordinator mode, which is served once the crawlers are started, and
+    this only returns once the workers are done as well.
+    """
+    logger.info("Starting browser and visiting URLs")
+    restart_policy = args.restart_policy
+    if args.restart_browser:
+        restart_policy = 'always'
+    crawler_procs = []
+    supervisor = None
+    if args.engine == 'async':
+        supervisor = Supervisor(crawlglobs.log_q, args.screenshot_workers,
+                                args.startup_concurrency)
+        for i in range(args.num_browser):
+            supervisor.add_crawler(restart_policy, args.ext_start_port + i, 
+                                   args.proxy_file, args.proxy_scheme)
+    else:
+        crawler_procs = start_crawler_procs(args, logger, request_q, 
+                                            result_q, restart_policy)
+    if broker:
+        logger.info("Serving jobs to workers at %s" % args.coordinator)
+        serve_broker(broker, parse_address(args.coordinator), args.authkey)
+    if supervisor:
+        if args.worker:
+            request_q = RemoteRequestQueue(parse_address(args.worker), 
+                                           args.authkey, crawlglobs.log_q)
+            result_q = RemoteResultQueue(request_q)
+        supervisor.run(request_q, result_q)
+        
+    # Wait for all children to die. Exit when they are all done. This is also
+    #     important because the dead children will only join() when this is
+    #     called. Once the crawlers are gone, all their results are on the 
+    #     result q, and "CRAWLERS_DONE" after them tells the q manager to 
+    #     finish up.
+    # TODO (nchachra): This should be called in case of exceptions in main too.
+    for crawler_p in crawler_procs:
+        crawler_p.join()
+        logger.debug("Crawler %s exited" % crawler_p.name)
+    if broker:
+        logger.info("Waiting for workers to finish.")
+        while not broker.finished():
+            broker.check_cleanup()
+            time.sleep(1)
+        broker.stop()
+
+def start_crawler_procs(args, logger, request_q, result_q, restart_policy):
+    """Starts a CrawlerProcess per browser, and returns the processes.
+    """
+    # Spawn CrawlerController processes.
+    ext_port = args.ext_start_port
+    crawler_procs = []
+    for i in range(args.num_browser):
+        standby_port = None
+        if args.standby_browser:
+            standby_port = ext_port + args.num_browser
+        crawler = CrawlerProcess(restart = restart_policy, 
+                                browser = args.browser, 
+                                ext_port = ext_port,
+                                proxy_file = args.proxy_file,
+                                proxy_scheme = args.proxy_scheme,
+                                log_q = crawlglobs.log_q,
+                                screenshot_workers = args.screenshot_workers,
+                                standby_port = standby_port,
+                                tabs = args.tabs)
+        if args.worker:
+            request_q = RemoteRequestQueue(parse_address(args.worker), 
+                                           args.authkey, crawlglobs.log_q)
+            result_q = RemoteResultQueue(request_q)
+        logger.debug(("Starting crawler process on Firefox port: %s")
+                     % ext_port)
+        crawler_p = mp.Process(target=CrawlerProcess.run, 
+                               args=(crawler, request_q, result_q))
+        crawler_p.start()
+        crawler_procs.append(crawler_p)
+        ext_port += 1
+    return crawler_procs
 
 def setup_logging(args):
     """Sets up logging. The logger is stored in crawlglobs.logger.
@@ -256,6 +614,27 @@ def setup_logging(args):
     crawlglobs.logger  = logger
     return logger
 
+def setup_metrics(args, logger):
+    """Starts collecting the crawlers' metrics on crawlglobs.metrics_q
+    and serving them at --metrics-port. Returns the metrics.Registry, or 
+    None if metrics are off.
+    """
+    if not args.metrics_port:
+        return None
+    registry = metrics.Registry()
+    try:
+        server = metrics.MetricsServer(registry, args.metrics_port)
+    except Exception, e:
+        logger.critical("Can't serve metrics at port %s: %s" 
+                        % (args.metrics_port, e))
+        exit()
+    crawlglobs.metrics_q = mp.Queue()
+    metrics.MetricsCollector(crawlglobs.metrics_q, registry, logger).start()
+    server.start()
+    logger.info("Serving metrics at http://%s:%s/metrics" 
+                % (config.METRICS_HOST, args.metrics_port))
+    return registry
+
 def display(args, logger):
     """Sets up Xvfb if necessary.
     """
@@ -298,15 +677,8 @@ def prep_firefox(args, logger):
                    "trajlogger@cs.ucsd.edu to the system firefox version \n" +
                    "might work. \nExiting.") % crawler_ff_version)
         exit(1)
-    # Create tmp directory for storing firefox profiles.
-    profile_dir = os.path.join(utils.default_tmp_location(), 
-                               config.PROFILE_DIR)
-    if not os.path.exists(profile_dir):
-        logger.info("Creating directory for firefox profiles")
-        os.makedirs(profile_dir)
-    else:
-        logger.error("Firefox profile directory already exists. Something's"+
-                     "wrong. Please file a bug.")
+    # Stage the profile template that firefox profiles are cloned from.
+    stage_profile_template(logger)
 
 def run():
     args = setup_args()
@@ -324,20 +696,33 @@ def run():
         crawlglobs.dom_dir = args.dom_dir
     if args.visit_chain_dir:
         crawlglobs.visit_chain_dir = args.visit_chain_dir
+    if args.blob_store:
+        crawlglobs.blob_store_dir = args.blob_store
+    if args.pack_dir:
+        crawlglobs.pack_dir = args.pack_dir
     if args.proxy_file:
         crawlglobs.proxy_file = args.proxy_file
     if args.proxy_scheme:
         crawlglobs.proxy_scheme = args.proxy_scheme
+    crawlglobs.load_policy = {'policy': args.load_policy,
+                              'idle_time': args.idle_time,
+                              'idle_cap': args.idle_cap}
+    crawlglobs.browser_limits = {'max_rss': args.browser_max_rss * 2**20,
+                                 'max_growth': 
+                                    args.browser_max_growth * 2**20}
+    crawlglobs.startup_slots = StartupSlots(args.startup_concurrency)
+    registry = setup_metrics(args, logger)
         
     # Get all files given as input.
-    input_file = args.input_file
+    input_file = args.input_file or []
     # Check if the input file is a directory.
-    if os.path.isdir(args.input_file[0]):
-        logger.info(("All .json files in %s will be crawled") 
+    if input_file and os.path.isdir(args.input_file[0]):
+        logger.info(("All .json and .jsonl files in %s will be crawled") 
                      % args.input_file[0])
         input_file = [args.input_file[0] + "/" + f 
                       for f in os.listdir(args.input_file[0]) 
-                                        if f[-5:] == '.json']
+                                        if f[-5:] == '.json' or
+                                           f[-6:] == '.jsonl']
     if args.tags_file:
         logger.debug("Tag file supplied. Loading tags.")
         # Create a tags list with [(tag_name, {"threshold": value, "regexes":
@@ -354,48 +739,72 @@ def run():
             exit()
             
 
+    if args.worker:
+        run_crawlers(args, logger, None, None)
+        logger.critical("Final cleanup.")
+        utils.cleanup(logger)
+        logger.critical("Byebye!")
+        return
     # Spawn process to parse input request URLs.
     logger.debug("Creating queues and starting queue controller process")
-    queue_cc = FileQController(input_file, args.num_browser, crawlglobs.log_q)
-    request_q = mp.JoinableQueue(config.REQUEST_Q_SIZE)
-    result_q = mp.JoinableQueue(config.RESULT_Q_SIZE)
-    queue_cc_p = mp.Process(target=FileQController.run, 
-                            args=(queue_cc, request_q, result_q)).start()
-    logger.info("Starting browser and visiting URLs")
-    # Spawn CrawlerController processes.
-    ext_port = args.ext_start_port
-    for i in range(args.num_browser):
-        crawler = CrawlerProcess(restart = args.restart_browser, 
-                                browser = args.browser, 
-                                ext_port = ext_port,
-                                proxy_file = args.proxy_file,
-                                proxy_scheme = args.proxy_scheme,
-                                log_q = crawlglobs.log_q)
-        logger.debug(("Starting crawler process on Firefox port: %s")
-                     % ext_port)
-        crawler_p = mp.Process(target=CrawlerProcess.run, 
-                               args=(crawler, request_q, result_q)).start()
-        ext_port += 1
-        
-    # Wait for all children to die. Exit when they are all done. This is also
-    #     important because the dead children will only join() when this is
-    #     called. 
-    # TODO (nchachra): This should be called in case of exceptions in main too.
-    while len(mp.active_children()) != 0:
-        logger.info("Request q size: %s" % request_q.qsize())
-        logger.info("Result q size: %s" % result_q.qsize())
-        if (len(mp.active_children()) == 1 and request_q.qsize() == 1 
-                and result_q.qsize() == 0):
-            task = request_q.get()
-            if task == "CLEANUP":
-                # Removing this final task will cause the qcontroller process
-                #    to join. Finally there will be 0 child processes left, 
-                #    and main will join as well.
-                logger.info("Only the q manager seems to be attempting " +
-                            "to join q. Joining in main and exiting.")
-                request_q.task_done()
-        logger.debug("Active processes: %s " % mp.active_children())
-        time.sleep(10)
+    if args.pack_dir:
+        sink = PackSink(args.pack_dir)
+    elif args.results_format == 'jsonl':
+        sink = JsonlSink(args.results_dir or args.visit_chain_dir or '.',
+                         compress=args.results_gzip,
+                         max_size=args.results_shard_size * 1024 * 1024,
+                         max_age=args.results_shard_age,
+                         batch_size=args.results_batch)
+    else:
+        sink = FileSink()
+    scheduler = None
+    if args.polite:
+        scheduler = HostScheduler(args.host_max_jobs, args.host_delay,
+                                  args.host_window, args.host_window_per_host)
+    retries = None
+    if args.retries > 0:
+        retries = RetryQueue(args.retries + 1, args.retry_backoff,
+                             new_proxy=args.retry_new_proxy)
+    if args.queue_db:
+        logger.info("Using jobs database %s" % args.queue_db)
+        queue_cc = SqliteQController(args.queue_db, input_file, 
+                                     args.num_browser, crawlglobs.log_q, sink,
+                                     scheduler, retries)
+    else:
+        ledger_path = args.ledger or os.path.join(args.log_dir, 
+                                                  config.LEDGER_FILENAME)
+        if args.resume and not os.path.exists(ledger_path):
+            logger.critical("Can't resume, no ledger at %s" % ledger_path)
+            exit()
+        logger.info("Recording jobs in ledger %s" % ledger_path)
+        queue_cc = FileQController(input_file, args.num_browser, 
+                                   crawlglobs.log_q, sink, 
+                                   Ledger(ledger_path, args.resume), 
+                                   scheduler, retries)
+    if args.engine == 'async':
+        # Everything runs in this process. The result queue is unbounded, 
+        #    so that putting results never blocks the event loop.
+        request_q = Queue.Queue(config.REQUEST_Q_SIZE)
+        result_q = Queue.Queue()
+        queue_cc_p = threading.Thread(target=FileQController.run, 
+                                      args=(queue_cc, request_q, result_q),
+                                      name="QController")
+    else:
+        request_q = mp.JoinableQueue(config.REQUEST_Q_SIZE)
+        result_q = mp.JoinableQueue(config.RESULT_Q_SIZE)
+        queue_cc_p = mp.Process(target=FileQController.run, 
+                                args=(queue_cc, request_q, result_q))
+    queue_cc_p.start()
+    if registry:
+        registry.gauge_func('stallone_request_queue_depth', request_q.qsize)
+        registry.gauge_func('stallone_result_queue_depth', result_q.qsize)
+    broker = None
+    if args.coordinator:
+        broker = JobBroker(request_q, result_q, logger)
+    run_crawlers(args, logger, request_q, result_q, broker)
+    logger.info("All crawlers exited. Waiting for q manager.")
+    result_q.put("CRAWLERS_DONE")
+    queue_cc_p.join()
     logger.critical("Final cleanup.")
     utils.cleanup(logger)
     logger.critical("Byebye!")
@@ -0,0 +1,201 @@
+"""Politeness scheduling of jobs across hosts. The queue controller adds the
+jobs it reads to a HostScheduler, which hands them out interleaved across
+hosts, so that the browsers don't all visit the same site at once when the
+input is sorted by domain.
+
+Author: nchachra@cs.ucsd.edu
+"""
+
+import collections
+import threading
+import time
+import urlparse
+
+import config
+
+
+def job_host(job):
+    """Returns the host of a (job id, job) tuple's url, or '' if it has
+    none.
+    """
+    try:
+        return urlparse.urlsplit(job[1].get('url', '')).hostname or ''
+    except Exception:
+        return ''
+
+
+class HostScheduler:
+    """Holds up to window jobs and hands them out round-robin across their
+    hosts. At most max_per_host jobs of a host are out at once (0 for no
+    limit), and jobs of a host are handed out at least min_delay seconds
+    apart. A job is out from next() until done() is called with its id, or
+    until it has been out for stale seconds, in case its result never comes
+    back. Thread safe: one thread adds, another hands out.
+
+    Only host_window jobs of a host (0 for no limit) are held in the 
+    window, so that a big host in sorted input doesn't crowd the other 
+    hosts out of it. Its further jobs wait in an overflow of up to window
+    jobs, and move into the window as its jobs are handed out.
+    """
+    def __init__(self, max_per_host=config.HOST_MAX_JOBS,
+                 min_delay=config.HOST_MIN_DELAY, window=config.HOST_WINDOW,
+                 host_window=config.HOST_WINDOW_PER_HOST,
+                 stale=config.ALARM_TIME):
+        self.max_per_host = max_per_host
+        self.min_delay = min_delay
+        self.window = window
+        self.host_window = host_window
+        self.stale = stale
+        self.cond = threading.Condition()
+        # {host: deque of jobs}
+        self.pending = {}
+        # Hosts with pending jobs, in round-robin order.
+        self.hosts = collections.deque()
+        self.num_pending = 0
+        # {host: deque of jobs} that come after the host's pending jobs.
+        self.overflow = {}
+        self.num_overflow = 0
+        # {host: {job id: time handed out}}
+        self.out = {}
+        # {job id: host}
+        self.out_hosts = {}
+        # {host: time a job of the host was last handed out}
+        self.last_out = {}
+        self.closed = False
+
+    def add(self, job):
+        """Adds a (job id, job) tuple, blocking while window jobs are held,
+        or while the overflow is full if the job's host has host_window jobs
+        in the window.
+        """
+        host = job_host(job)
+        self.cond.acquire()
+        try:
+            while True:
+                self._purge_stale(time.time())
+                if (self.overflow.get(host) or (self.host_window and
+                        len(self.pending.get(host, ())) >= self.host_window)):
+                    if self.num_overflow < self.window:
+                        self.overflow.setdefault(
+                                        host, collections.deque()).append(job)
+                        self.num_overflow += 1
+                        break
+                elif self.num_pending < self.window:
+                    if not self.pending.get(host):
+                        self.pending[host] = collections.deque()
+                        self.hosts.append(host)
+                    self.pending[host].append(job)
+                    self.num_pending += 1
+                    break
+                self.cond.wait()
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def close(self):
+        """Called once all jobs have been added.
+        """
+        self.cond.acquire()
+        try:
+            self.closed = True
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def done(self, job_id):
+        """Called once the job is finished, which frees its host's slot.
+        """
+        self.cond.acquire()
+        try:
+            host = self.out_hosts.pop(job_id, None)
+            if host is not None:
+                del self.out[host][job_id]
+                if not self.out[host]:
+                    del self.out[host]
+                self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def _purge_stale(self, now, hosts=None):
+        """Forgets the jobs of hosts, or of all hosts, that have been out
+        for stale seconds. Call with the lock held.
+        """
+        if hosts is None:
+            hosts = self.out.keys()
+        purged = False
+        for host in hosts:
+            out = self.out.get(host)
+            if not out:
+                continue
+            for (job_id, since) in out.items():
+                if since + self.stale <= now:
+                    del out[job_id]
+                    del self.out_hosts[job_id]
+                    purged = True
+            if not out:
+                del self.out[host]
+        if purged:
+            self.cond.notify_all()
+
+    def _ready_in(self, host, now):
+        """Returns the seconds until a job of host may be handed out. If 
+        that depends on a job of the host finishing, it's the seconds until
+        the oldest one goes stale. Call with the lock held.
+        """
+        if self.max_per_host:
+            self._purge_stale(now, [host])
+            out = self.out.get(host, {})
+            if len(out) >= self.max_per_host:
+                return min(out.values()) + self.stale - now
+        return max(0, self.last_out.get(host, 0) + self.min_delay - now)
+
+    def next(self):
+        """Returns the next job, blocking until one may be handed out, or
+        None once all jobs have been handed out after close().
+        """
+        self.cond.acquire()
+        try:
+            while True:
+                if not self.num_pending and self.closed:
+                    return None
+                now = time.time()
+                # Seconds until the first host cools down.
+                wait = None
+                for i in range(len(self.hosts)):
+                    host = self.hosts[0]
+                    self.hosts.rotate(-1)
+                    ready_in = self._ready_in(host, now)
+                    if ready_in == 0:
+                        return self._take(host, now)
+                    if wait is None or ready_in < wait:
+                        wait = ready_in
+                # Woken up by add(), done() or close() as well.
+                self.cond.wait(wait)
+        finally:
+            self.cond.release()
+
+    def _take(self, host, now):
+        """Call with the lock held.
+        """
+        job = self.pending[host].popleft()
+        self.num_pending -= 1
+        if self.overflow.get(host):
+            self.pending[host].append(self.overflow[host].popleft())
+            self.num_pending += 1
+            self.num_overflow -= 1
+            if not self.overflow[host]:
+                del self.overflow[host]
+        if not self.pending[host]:
+            del self.pending[host]
+            self.hosts.remove(host)
+        if self.max_per_host:
+            self.out.setdefault(host, {})[job[0]] = now
+            self.out_hosts[job[0]] = host
+        self.last_out[host] = now
+        if len(self.last_out) > 2 * self.window:
+            # Forget hosts that have cooled down.
+            for (other, since) in self.last_out.items():
+                if since + self.min_delay < now:
+                    del self.last_out[other]
+        self.cond.notify_all()
+        return job
@@ -0,0 +1,141 @@
+"""Post-processing of screenshots off the crawler's critical path. A raw
+screenshot taken by the extension is quantized with pngnq, hashed and moved
+to its destination by a pool of worker processes, while the crawler moves on
+to the next URL.
+
+Author: nchachra@cs.ucsd.edu
+"""
+
+import logging
+import multiprocessing as mp
+import os
+import shutil
+import subprocess
+import traceback
+
+import blobstore
+import utils
+
+
+def store_screenshot(raw_path, dest_dir, fname, store_root=None, 
+                     compress_only=False):
+    """Compresses the raw screenshot at raw_path using pngnq and stores it in
+    dest_dir. If fname is valid, the file is named fname, otherwise it is
+    named with its md5 and, if store_root is given, goes into the blob store
+    at store_root instead of dest_dir. The raw screenshot is removed.
+
+    Returns a dictionary {'md5': md5, 'exists': True/False} or
+    {'file': fname, 'exists': True/False}, or None on error. 'exists'
+    indicates if a file with the name already existed, in which case no new
+    file is created. Never raises, so it is safe to run in a pool.
+
+    With compress_only, the compressed file is left where it is and the
+    return value is {'md5': md5, 'path': path of the compressed file}, for
+    pack_screenshot().
+    """
+    nq8_path = raw_path[:-4] + '-nq8.png'
+    try:
+        try:
+            if os.path.exists(nq8_path):
+                os.remove(nq8_path)
+            subprocess.call(['pngnq', raw_path])
+            if not os.path.exists(nq8_path):
+                return None
+            if compress_only:
+                return {'md5': utils.file_md5(nq8_path), 'path': nq8_path}
+            if not fname and store_root:
+                md5 = utils.file_md5(nq8_path)
+                store = blobstore.get_store(store_root)
+                # Move into the store's file system before hashing it in.
+                store_tmp_path = os.path.join(store.tmp_dir(), 
+                                              os.path.basename(nq8_path))
+                shutil.move(nq8_path, store_tmp_path)
+                return {'md5': md5, 
+                        'exists': store.put(store_tmp_path, md5, 'png')}
+            if not fname:
+                md5 = utils.file_md5(nq8_path)
+                dest_path = os.path.join(dest_dir, md5 + '.png')
+                result = {'md5': md5}
+            else:
+                if fname[-4:] != '.png':
+                    fname += '.png'
+                dest_path = os.path.join(dest_dir, fname)
+                result = {'file': fname}
+            if os.path.exists(dest_path):
+                os.remove(nq8_path)
+                result['exists'] = True
+            else:
+                # Move into the destination's file system first, so the
+                #    final rename is atomic.
+                store_tmp_path = os.path.join(dest_dir, '.' +
+                                              os.path.basename(nq8_path) +
+                                              '.part')
+                shutil.move(nq8_path, store_tmp_path)
+                os.rename(store_tmp_path, dest_path)
+                result['exists'] = False
+            return result
+        except Exception, e:
+            logging.getLogger("Crawler").error(
+                    "Error storing screenshot %s: %s"
+                    % (raw_path, traceback.format_exc()))
+            return None
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+
+
+def pack_screenshot(pack, compressed, dest_dir, fname):
+    """Appends a screenshot compressed by store_screenshot() with 
+    compress_only to the PackWriter pack, as a 'screenshot' record. The key
+    is the path the file would have had in dest_dir, or <md5>.png if fname
+    isn't valid. Returns the dictionary described in store_screenshot() 
+    with the 'pack', 'offset' and 'length' of the record added, or None on
+    error.
+    """
+    if compressed is None:
+        return None
+    if fname:
+        if fname[-4:] != '.png':
+            fname += '.png'
+        key = os.path.join(dest_dir, fname)
+        result = {'file': fname}
+    else:
+        key = compressed['md5'] + '.png'
+        result = {'md5': compressed['md5']}
+    if pack.has_key('screenshot', key):
+        os.remove(compressed['path'])
+        result['exists'] = True
+    else:
+        result.update(pack.append_file('screenshot', key, 
+                                       compressed['path']))
+        result['exists'] = False
+    return result
+
+
+class ScreenshotPool:
+    """Pool of processes running store_screenshot(). Each crawler process
+    owns one. Callbacks run in a thread of the crawler process.
+    """
+    def __init__(self, num_workers, logger):
+        self.logger = logger
+        self.pool = mp.Pool(num_workers)
+
+    def submit(self, raw_path, dest_dir, fname, callback, store_root=None,
+               compress_only=False):
+        """Queues the raw screenshot for storing. callback is called with
+        the result of store_screenshot() once it's done.
+        """
+        self.logger.debug("Queueing screenshot %s for compression"
+                          % raw_path)
+        self.pool.apply_async(store_screenshot, 
+                              (raw_path, dest_dir, fname, store_root, 
+                               compress_only),
+                              callback=callback)
+
+    def close(self):
+        """Waits for all queued screenshots to be stored, and stops the
+        workers.
+        """
+        self.logger.debug("Waiting for screenshot workers to finish")
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,52 @@
+"""Bringing browsers up quickly. Starting many Firefox instances at once
+thrashes the disk and CPU, so that all of them take longer than if they had
+started a few at a time. StartupSlots limits the browsers starting at once
+across all crawler processes, and readiness of a started browser's extension
+is probed at short intervals that back off, instead of once a second.
+
+Author: nchachra@cs.ucsd.edu
+"""
+
+import multiprocessing as mp
+import time
+
+import config
+
+
+def probe_intervals(timeout, first=config.READY_PROBE_INTERVAL,
+                    backoff=config.READY_PROBE_BACKOFF,
+                    longest=config.READY_PROBE_MAX_INTERVAL):
+    """Yields the pauses between readiness probes until timeout seconds 
+    have passed. The pauses grow from first by a factor of backoff, up to 
+    longest seconds.
+    """
+    deadline = time.time() + timeout
+    interval = first
+    while time.time() < deadline:
+        yield max(0, min(interval, deadline - time.time()))
+        interval = min(interval * backoff, longest)
+
+
+class StartupSlots:
+    """Limits the browsers that start up at once to concurrency, 0 for no
+    limit. Created before the crawler processes, which share it.
+    """
+    def __init__(self, concurrency=config.STARTUP_CONCURRENCY):
+        self.concurrency = concurrency
+        self.semaphore = None
+        if concurrency:
+            self.semaphore = mp.BoundedSemaphore(concurrency)
+
+    def acquire(self):
+        """Blocks until a browser may start, and returns the seconds it 
+        waited.
+        """
+        if self.semaphore is None:
+            return 0
+        start = time.time()
+        self.semaphore.acquire()
+        return time.time() - start
+
+    def release(self):
+        if self.semaphore is not None:
+            self.semaphore.release()
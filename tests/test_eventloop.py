@@ -0,0 +1,150 @@
+"""Tests for eventloop.py.
+"""
+
+import os
+import threading
+import time
+import unittest
+
+from eventloop import (Cancelled, EventLoop, Future, Return, Semaphore,
+                       ThreadRunner, Timeout)
+
+
+class EventLoopTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = EventLoop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_return_value(self):
+        def inner(value):
+            yield self.loop.sleep(0.01)
+            raise Return(value * 2)
+        def outer():
+            first = yield inner(1)
+            second = yield self.loop.spawn(inner(2))
+            raise Return(first + second)
+        self.assertEqual(self.loop.run_until_complete(outer()), 6)
+
+    def test_exceptions_propagate(self):
+        def failing():
+            yield None
+            raise KeyError('x')
+        def catching():
+            try:
+                yield failing()
+            except KeyError:
+                raise Return('caught')
+        self.assertEqual(self.loop.run_until_complete(catching()), 'caught')
+        self.assertRaises(KeyError, self.loop.run_until_complete, failing())
+
+    def test_sleeps_run_concurrently(self):
+        order = []
+        def sleeper(delay):
+            yield self.loop.sleep(delay)
+            order.append(delay)
+        def main():
+            tasks = [self.loop.spawn(sleeper(delay))
+                     for delay in (0.2, 0.1, 0.15)]
+            for task in tasks:
+                yield task
+        start = time.time()
+        self.loop.run_until_complete(main())
+        self.assertEqual(order, [0.1, 0.15, 0.2])
+        self.assertTrue(time.time() - start < 0.4)
+
+    def test_with_timeout_cancels(self):
+        cleaned = []
+        def slow():
+            try:
+                yield self.loop.sleep(10)
+            finally:
+                cleaned.append(True)
+        def main():
+            try:
+                yield self.loop.with_timeout(slow(), 0.05)
+            except Timeout:
+                raise Return('timeout')
+        self.assertEqual(self.loop.run_until_complete(main()), 'timeout')
+        self.assertEqual(cleaned, [True])
+
+    def test_with_timeout_in_time(self):
+        def quick():
+            yield self.loop.sleep(0.01)
+            raise Return('done')
+        self.assertEqual(self.loop.run_until_complete(
+                                self.loop.with_timeout(quick(), 5)), 'done')
+
+    def test_cancel(self):
+        def waiting():
+            yield self.loop.sleep(10)
+        task = self.loop.spawn(waiting())
+        def main():
+            yield self.loop.sleep(0.01)
+            task.cancel()
+            try:
+                yield task
+            except Cancelled:
+                raise Return('cancelled')
+        self.assertEqual(self.loop.run_until_complete(main()), 'cancelled')
+
+    def test_wait_readable(self):
+        (read_fd, write_fd) = os.pipe()
+        def reader():
+            yield self.loop.wait_readable(read_fd, 5)
+            raise Return(os.read(read_fd, 10))
+        self.loop.call_later(0.05, os.write, write_fd, 'data')
+        try:
+            self.assertEqual(self.loop.run_until_complete(reader()), 'data')
+            self.assertRaises(Timeout, self.loop.run_until_complete,
+                              self.loop.wait_readable(read_fd, 0.05))
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+    def test_semaphore(self):
+        semaphore = Semaphore(self.loop, 2)
+        state = {'holding': 0, 'most': 0}
+        def worker():
+            yield semaphore.acquire()
+            state['holding'] += 1
+            state['most'] = max(state['most'], state['holding'])
+            yield self.loop.sleep(0.02)
+            state['holding'] -= 1
+            semaphore.release()
+        def main():
+            tasks = [self.loop.spawn(worker()) for i in range(5)]
+            for task in tasks:
+                yield task
+        self.loop.run_until_complete(main())
+        self.assertEqual(state, {'holding': 0, 'most': 2})
+
+    def test_thread_runner(self):
+        runner = ThreadRunner(self.loop, "TestRunner")
+        threads = []
+        def blocking(value):
+            threads.append(threading.current_thread().name)
+            time.sleep(0.02)
+            return value + 1
+        def main():
+            result = yield runner.call(blocking, 1)
+            try:
+                yield runner.call(int, 'x')
+            except ValueError:
+                raise Return(result)
+        try:
+            self.assertEqual(self.loop.run_until_complete(main()), 2)
+        finally:
+            runner.close()
+        self.assertEqual(threads, ["TestRunner"])
+
+    def test_future_result_set_once(self):
+        future = Future(self.loop)
+        future.set_result(1)
+        future.set_exception(ValueError())
+        self.assertEqual(self.loop.run_until_complete(future), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
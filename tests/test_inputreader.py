@@ -0,0 +1,101 @@
+"""Tests for inputreader.py.
+"""
+
+import logging
+import os
+import shutil
+import simplejson as json
+import StringIO
+import tempfile
+import unittest
+
+from inputreader import InputReader, iter_jobs, iter_json_object, iter_jsonl
+
+
+JOBS = [
+    ('1', {'url': 'http://example.com/', 'features': 'all'}),
+    ('2', {'url': u'http://\xe9xample.com/', 'priority': 12345,
+           'setup': {'headers': {'X-Test': 'a, b'}}}),
+    ('3', {'url': 'http://example.org/"quoted"}', 'timeout': 1.5e3,
+           'actions': {'eval': ['1 + 1', '[{}]']}}),
+    ('4', {}),
+]
+
+
+def _object(jobs):
+    return '{\n' + ',\n'.join('  %s : %s' % (json.dumps(job_id),
+                                             json.dumps(job))
+                              for (job_id, job) in jobs) + '\n}\n'
+
+
+class IterJsonObjectTest(unittest.TestCase):
+    def test_any_chunk_size(self):
+        text = _object(JOBS)
+        for chunk_size in range(1, len(text) + 1):
+            items = list(iter_json_object(StringIO.StringIO(text),
+                                          chunk_size))
+            self.assertEqual(items, JOBS, chunk_size)
+
+    def test_number_across_chunks(self):
+        text = '{"a": 1234567, "b": 89}'
+        for chunk_size in range(1, len(text) + 1):
+            items = list(iter_json_object(StringIO.StringIO(text),
+                                          chunk_size))
+            self.assertEqual(items, [('a', 1234567), ('b', 89)])
+
+    def test_empty(self):
+        self.assertEqual(list(iter_json_object(StringIO.StringIO(' {} '))),
+                         [])
+
+    def test_invalid(self):
+        for text in ['[1, 2]', '{"a": 1', '{"a" 1}', '{1: 2}', '']:
+            items = iter_json_object(StringIO.StringIO(text), 4)
+            self.assertRaises(ValueError, list, items)
+
+
+class IterJobsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, name, text):
+        path = os.path.join(self.directory, name)
+        fh = open(path, 'wb')
+        fh.write(text)
+        fh.close()
+        return path
+
+    def test_jsonl(self):
+        text = '\n'.join(json.dumps(dict([job])) for job in JOBS[:2])
+        text += '\n\n' + json.dumps(dict(JOBS[2:])) + '\n'
+        self.assertEqual(list(iter_jsonl(StringIO.StringIO(text)))[:2],
+                         JOBS[:2])
+        path = self._write('jobs.jsonl', text)
+        self.assertEqual(sorted(iter_jobs(path)), JOBS)
+
+    def test_json(self):
+        path = self._write('jobs.json', _object(JOBS))
+        self.assertEqual(list(iter_jobs(path)), JOBS)
+
+    def test_reader_reads_all_files(self):
+        paths = [self._write('a.json', _object(JOBS[:2])),
+                 self._write('bad.json', '{"5": {}, oops'),
+                 self._write('b.jsonl', json.dumps(dict(JOBS[2:3])))]
+        logger = logging.getLogger('test_inputreader')
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+        reader = InputReader(paths, logger, prefetch=1)
+        jobs = []
+        while True:
+            job = reader.get(10)
+            if job == InputReader.END:
+                break
+            jobs.append(job)
+        # The jobs of the broken file before the error are kept.
+        self.assertEqual(jobs, JOBS[:2] + [('5', {})] + JOBS[2:3])
+
+
+if __name__ == '__main__':
+    unittest.main()
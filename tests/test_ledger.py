@@ -0,0 +1,105 @@
+"""Tests for ledger.py.
+"""
+
+import shutil
+import os
+import tempfile
+import unittest
+
+from ledger import JobDB, Ledger
+
+
+class LedgerTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'logs', 'ledger.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_resume(self):
+        ledger = Ledger(self.path)
+        ledger.mark_queued('a', {'url': 'http://a/'})
+        ledger.mark_queued('b', {'url': 'http://b/'})
+        ledger.mark_finished([('a', [])])
+        ledger.close()
+        ledger = Ledger(self.path, resume=True)
+        self.assertTrue(ledger.is_finished('a'))
+        self.assertFalse(ledger.is_finished('b'))
+        self.assertEqual(ledger.in_flight(), [('b', {'url': 'http://b/'})])
+        self.assertEqual(ledger.counts(), {Ledger.QUEUED: 1,
+                                           Ledger.FINISHED: 1})
+        ledger.close()
+
+    def test_fresh_crawl_drops_jobs(self):
+        ledger = Ledger(self.path)
+        ledger.mark_queued('a', {'url': 'http://a/'})
+        ledger.close()
+        ledger = Ledger(self.path)
+        self.assertEqual(ledger.in_flight(), [])
+        self.assertEqual(ledger.counts(), {})
+        ledger.close()
+
+
+class JobDBTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'jobs.sqlite')
+        self.input_path = os.path.join(self.directory, 'input.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _import(self, db, jobs):
+        return db.import_jobs(self.input_path, jobs, batch_size=2)
+
+    def test_priority_order(self):
+        db = JobDB(self.path)
+        jobs = [('low', {'url': 'http://a/', 'priority': -1}),
+                ('mid', {'url': 'http://b/'}),
+                ('high', {'url': 'http://c/', 'priority': 5})]
+        self.assertEqual(self._import(db, jobs), 3)
+        self.assertTrue(db.is_imported(self.input_path))
+        self.assertEqual([job_id for (job_id, job) in db.next_jobs(2)],
+                         ['high', 'mid'])
+        self.assertEqual(db.next_jobs(2), [jobs[0]])
+        self.assertEqual(db.next_jobs(2), [])
+        db.close()
+
+    def test_import_ignores_known_jobs(self):
+        db = JobDB(self.path)
+        self._import(db, [('a', {'url': 'http://a/'})])
+        db.mark_finished([(job_id, None) for (job_id, job)
+                          in db.next_jobs(10)])
+        self._import(db, [('a', {'url': 'http://a/'}),
+                          ('b', {'url': 'http://b/'})])
+        self.assertEqual(db.counts(), {JobDB.FINISHED: 1, JobDB.PENDING: 1})
+        db.close()
+
+    def test_resume(self):
+        db = JobDB(self.path)
+        self._import(db, [(str(i), {'url': 'http://h%d/' % i})
+                          for i in range(5)])
+        handed_out = db.next_jobs(3)
+        result_list = [('%s.json' % handed_out[0][0],
+                        [{'url': 'http://h/'},
+                         {'url': 'http://h/final', 'status_code': 200,
+                          'dom': {'md5': 'abc'}}])]
+        db.mark_finished([(handed_out[0][0], result_list)])
+        db.close()
+        # The crawl died with two jobs in flight.
+        db = JobDB(self.path)
+        self.assertEqual(db.requeue_in_flight(), 2)
+        self.assertEqual(db.counts(), {JobDB.FINISHED: 1, JobDB.PENDING: 4})
+        remaining = sorted(job_id for (job_id, job) in db.next_jobs(10))
+        self.assertEqual(remaining, sorted(str(i) for i in range(5)
+                                           if str(i) != handed_out[0][0]))
+        rows = db._execute("SELECT fname, pages, final_url, status_code, " +
+                           "dom FROM results")
+        self.assertEqual(rows, [(result_list[0][0], 2, 'http://h/final',
+                                 '200', '{"md5": "abc"}')])
+        db.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
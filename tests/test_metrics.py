@@ -0,0 +1,109 @@
+"""Tests for metrics.py.
+"""
+
+import logging
+import unittest
+
+import metrics
+
+
+class RegistryTest(unittest.TestCase):
+    def test_counters_and_gauges(self):
+        registry = metrics.Registry(
+                        [('requests_total', 'counter', 'Requests.'),
+                         ('temperature', 'gauge', 'Degrees.')])
+        registry.inc('requests_total', status='ok')
+        registry.inc('requests_total', 2, status='ok')
+        registry.inc('requests_total', status='say "hi"\n\\')
+        registry.set('temperature', 21.5)
+        self.assertEqual(registry.render(),
+                         '# HELP requests_total Requests.\n'
+                         '# TYPE requests_total counter\n'
+                         'requests_total{status="ok"} 3\n'
+                         'requests_total{status="say \\"hi\\"\\n\\\\"} 1\n'
+                         '# HELP temperature Degrees.\n'
+                         '# TYPE temperature gauge\n'
+                         'temperature 21.5\n')
+
+    def test_histogram(self):
+        registry = metrics.Registry([('seconds', 'histogram', 'Time.')],
+                                    buckets=(1, 5))
+        for value in (0.5, 1, 3, 10):
+            registry.observe('seconds', value, phase='load')
+        lines = registry.render().splitlines()[2:]
+        self.assertEqual(lines,
+                         ['seconds_bucket{phase="load",le="1"} 2',
+                          'seconds_bucket{phase="load",le="5"} 3',
+                          'seconds_bucket{phase="load",le="+Inf"} 4',
+                          'seconds_sum{phase="load"} 14.5',
+                          'seconds_count{phase="load"} 4'])
+
+    def test_gauge_funcs(self):
+        registry = metrics.Registry([('depth', 'gauge', 'Depth.'),
+                                     ('broken', 'gauge', 'Broken.')])
+        registry.gauge_func('depth', lambda: 7)
+        def broken():
+            raise NotImplementedError()
+        registry.gauge_func('broken', broken)
+        lines = registry.render().splitlines()
+        self.assertTrue('depth 7' in lines)
+        self.assertFalse([line for line in lines
+                          if line.startswith('broken')])
+
+
+class MetricsCollectorTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+        logger = logging.getLogger('test_metrics')
+        logger.addHandler(logging.NullHandler())
+        self.collector = metrics.MetricsCollector(None, self.registry, logger)
+
+    def _lines(self, name):
+        return [line for line in self.registry.render().splitlines()
+                if line.startswith(name)]
+
+    def test_visits(self):
+        timings = {'queue_wait': 100.0, 'load': 1.5, 'dom': 0.5}
+        self.collector.add(('visit', 'ok', '10.0.0.1:8080', timings))
+        self.collector.add(('visit', 'tim', None, timings))
+        self.assertEqual(self._lines('stallone_visits_total'),
+                         ['stallone_visits_total{status="ok"} 1',
+                          'stallone_visits_total{status="tim"} 1'])
+        self.assertEqual(self._lines('stallone_proxy_visits_total'),
+                         ['stallone_proxy_visits_total' +
+                          '{proxy="10.0.0.1:8080",status="ok"} 1'])
+        # The time spent waiting for the job isn't part of the visit.
+        self.assertEqual(self._lines('stallone_visit_seconds_sum'),
+                         ['stallone_visit_seconds_sum 4.0'])
+        self.assertTrue('stallone_phase_seconds_count{phase="load"} 2'
+                        in self._lines('stallone_phase_seconds_count'))
+        self.assertTrue(self.collector.visit_rate() > 0)
+
+    def test_browsers(self):
+        self.collector.add(('browser_start', 1.25, 0.5))
+        self.collector.add(('browser_start', None, 0.0))
+        self.collector.add(('browser_restart',))
+        self.collector.add(('browser_sample', '4000', 2 ** 20, 12.5, 4))
+        self.collector.add(('browser_sample', '4000', 2 ** 21, 50.0, 5))
+        self.assertEqual(self._lines('stallone_browser_starts_total'),
+                         ['stallone_browser_starts_total{result="failed"} 1',
+                          'stallone_browser_starts_total{result="ok"} 1'])
+        self.assertEqual(self._lines('stallone_browser_restarts_total'),
+                         ['stallone_browser_restarts_total 1'])
+        self.assertEqual(
+                    self._lines('stallone_browser_slot_wait_seconds_count'),
+                    ['stallone_browser_slot_wait_seconds_count 2'])
+        self.assertEqual(self._lines('stallone_browser_rss_bytes'),
+                         ['stallone_browser_rss_bytes{port="4000"} 2097152'])
+        self.assertEqual(self._lines('stallone_browser_cpu_percent'),
+                         ['stallone_browser_cpu_percent{port="4000"} 50.0'])
+
+    def test_stored(self):
+        self.collector.add(('stored', 'dom', 100))
+        self.collector.add(('stored', 'dom', 50))
+        self.assertEqual(self._lines('stallone_bytes_written_total'),
+                         ['stallone_bytes_written_total{kind="dom"} 150'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+"""Tests for packfile.py.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from packfile import pack_prefix, PackReader, PackWriter, read_record
+
+
+class PackWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_records_read_back(self):
+        writer = PackWriter(self.directory, 'test')
+        first = writer.append('dom', 'a.html', '<html>a</html>')
+        second = writer.append('screenshot', 'b.png', '\x89PNG\n\x00')
+        writer.close()
+        self.assertEqual(first['pack'], 'test-00000.pack')
+        self.assertEqual(first['length'], len('<html>a</html>'))
+        path = os.path.join(self.directory, second['pack'])
+        self.assertEqual(read_record(path, second['offset'],
+                                     second['length']), '\x89PNG\n\x00')
+        reader = PackReader(self.directory)
+        self.assertEqual(reader.keys(), [('dom', 'a.html'),
+                                         ('screenshot', 'b.png')])
+        self.assertEqual(reader.keys('dom'), [('dom', 'a.html')])
+        self.assertEqual(reader.get('dom', 'a.html'), '<html>a</html>')
+        self.assertEqual(reader.get('dom', 'missing'), None)
+
+    def test_rolls_over_at_max_size(self):
+        writer = PackWriter(self.directory, 'test', max_size=10)
+        names = [writer.append('dom', str(i), 'x' * 20)['pack']
+                 for i in range(3)]
+        writer.close()
+        self.assertEqual(names, ['test-00000.pack', 'test-00001.pack',
+                                 'test-00002.pack'])
+        reader = PackReader(self.directory)
+        for i in range(3):
+            self.assertEqual(reader.get('dom', str(i)), 'x' * 20)
+
+    def test_never_appends_to_earlier_packs(self):
+        writer = PackWriter(self.directory, 'test')
+        writer.append('dom', 'a', 'first')
+        writer.close()
+        writer = PackWriter(self.directory, 'test')
+        record = writer.append('dom', 'a', 'second')
+        writer.close()
+        self.assertEqual(record['pack'], 'test-00001.pack')
+        self.assertEqual(record['offset'], len('dom a 6\n'))
+        # The later record wins.
+        self.assertEqual(PackReader(self.directory).get('dom', 'a'),
+                         'second')
+
+    def test_append_file(self):
+        path = os.path.join(self.directory, 'raw.png')
+        fh = open(path, 'wb')
+        fh.write('data' * 100)
+        fh.close()
+        writer = PackWriter(os.path.join(self.directory, 'packs'), 'test')
+        writer.append_file('screenshot', 'raw.png', path)
+        writer.close()
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(writer.has_key('screenshot', 'raw.png'))
+        reader = PackReader(os.path.join(self.directory, 'packs'))
+        self.assertEqual(reader.get('screenshot', 'raw.png'), 'data' * 100)
+
+    def test_invalid_keys(self):
+        writer = PackWriter(self.directory, 'test')
+        self.assertRaises(ValueError, writer.append, 'dom', 'a\tb', 'x')
+        self.assertRaises(ValueError, writer.append, 'dom', 'a\nb', 'x')
+        self.assertRaises(ValueError, writer.append, 'd m', 'a', 'x')
+        writer.close()
+
+    def test_reader_skips_partial_index_line(self):
+        writer = PackWriter(self.directory, 'test')
+        writer.append('dom', 'a', 'data')
+        writer.close()
+        fh = open(os.path.join(self.directory, 'test-00000.idx'), 'ab')
+        fh.write('dom\tb\t100')
+        fh.close()
+        self.assertEqual(PackReader(self.directory).keys(), [('dom', 'a')])
+
+    def test_pack_prefix(self):
+        self.assertNotEqual(pack_prefix('crawl'), pack_prefix('sink'))
+        self.assertTrue(str(os.getpid()) in pack_prefix('crawl'))
+
+
+if __name__ == '__main__':
+    unittest.main()
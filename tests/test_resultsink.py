@@ -0,0 +1,96 @@
+"""Tests for resultsink.py.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from resultsink import JsonlSink, read_index, read_visit
+
+
+def _results(start, count):
+    return [('vc%d.json' % i, [{'url': 'http://example.com/%d' % i,
+                                'status_code': 200}])
+            for i in range(start, start + count)]
+
+
+class JsonlSinkTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _shards(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if '.jsonl' in name)
+
+    def _check_visits(self, results):
+        index = read_index(self.directory)
+        self.assertEqual(sorted(index), sorted(fname for (fname, visit)
+                                               in results))
+        for (fname, visit) in results:
+            (shard, offset, length) = index[fname]
+            self.assertEqual(read_visit(self.directory, shard, offset,
+                                        length), visit)
+
+    def test_batches(self):
+        sink = JsonlSink(self.directory, batch_size=3, flush_interval=3600)
+        sink.write(_results(0, 2))
+        self.assertEqual(sink.pending(), 2)
+        self.assertEqual(read_index(self.directory), {})
+        sink.write(_results(2, 1))
+        self.assertEqual(sink.pending(), 0)
+        self.assertEqual(len(read_index(self.directory)), 3)
+        sink.write(_results(3, 1))
+        sink.flush()
+        self.assertEqual(sink.pending(), 1)
+        sink.flush(force=True)
+        self.assertEqual(sink.pending(), 0)
+        sink.close()
+        self._check_visits(_results(0, 4))
+
+    def test_rotates_by_size(self):
+        sink = JsonlSink(self.directory, max_size=50, batch_size=1)
+        results = _results(0, 5)
+        sink.write(results)
+        sink.close()
+        self.assertEqual(len(self._shards()), 5)
+        self._check_visits(results)
+
+    def test_rotates_by_age(self):
+        sink = JsonlSink(self.directory, max_age=0.1, batch_size=1)
+        results = _results(0, 3)
+        sink.write(results[:2])
+        time.sleep(0.15)
+        sink.write(results[2:])
+        sink.close()
+        self.assertEqual(len(self._shards()), 2)
+        self._check_visits(results)
+
+    def test_compressed(self):
+        sink = JsonlSink(self.directory, compress=True, max_size=150,
+                         batch_size=1)
+        results = _results(0, 4)
+        sink.write(results)
+        sink.close()
+        shards = self._shards()
+        self.assertTrue(len(shards) > 1)
+        self.assertTrue(all(name.endswith('.jsonl.gz') for name in shards))
+        self._check_visits(results)
+
+    def test_never_overwrites_earlier_shards(self):
+        sink = JsonlSink(self.directory, batch_size=1)
+        sink.write(_results(0, 1))
+        sink.close()
+        sink = JsonlSink(self.directory, batch_size=1)
+        sink.write(_results(1, 1))
+        sink.close()
+        self.assertEqual(len(self._shards()), 2)
+        self._check_visits(_results(0, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
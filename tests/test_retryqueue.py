@@ -0,0 +1,83 @@
+"""Tests for retryqueue.py.
+"""
+
+import threading
+import time
+import unittest
+
+import config
+from retryqueue import RetryQueue
+
+
+def _attempt(status, proxy=None):
+    return {'status': status, 'proxy': proxy, 'time': time.time()}
+
+
+class RetryQueueTest(unittest.TestCase):
+    def test_retries_failed_jobs(self):
+        queue = RetryQueue(3, backoff=0.1, max_backoff=0.15)
+        job = ('a', {'url': 'http://a/'})
+        queue.track(job)
+        queue.handed_out('a')
+        self.assertTrue(queue.finished('a',
+                                       _attempt(config.PAGE_TIMEOUT_ST)))
+        self.assertEqual(queue.pending(), 1)
+        self.assertEqual(queue.pop_due(), None)
+        time.sleep(0.15)
+        retry = queue.pop_due()
+        self.assertEqual(retry[0], 'a')
+        self.assertEqual([attempt['status'] for attempt
+                          in retry[1]['attempts']],
+                         [config.PAGE_TIMEOUT_ST])
+        # The original job is left alone.
+        self.assertFalse(job[1].has_key('attempts'))
+        queue.track(retry)
+        queue.handed_out('a')
+        self.assertTrue(queue.finished('a',
+                                       _attempt(config.FIREFOX_ERR_ST)))
+        retry = queue.wait_due()
+        self.assertEqual(len(retry[1]['attempts']), 2)
+        queue.track(retry)
+        queue.handed_out('a')
+        # The third attempt was the last.
+        self.assertFalse(queue.finished('a',
+                                        _attempt(config.FIREFOX_ERR_ST)))
+        self.assertEqual(queue.wait_due(), None)
+
+    def test_successful_and_unknown_jobs(self):
+        queue = RetryQueue(3)
+        queue.track(('a', {}))
+        self.assertFalse(queue.finished('a', _attempt(None)))
+        self.assertFalse(queue.finished('unknown',
+                                        _attempt(config.PAGE_TIMEOUT_ST)))
+        self.assertEqual(queue.pending(), 0)
+        self.assertEqual(queue.wait_due(), None)
+
+    def test_new_proxy(self):
+        queue = RetryQueue(2, backoff=0, new_proxy=True)
+        queue.track(('a', {}))
+        queue.finished('a', _attempt(config.PROXY_ERR_ST,
+                                     ['10.0.0.1', 8080, 'http']))
+        self.assertEqual(queue.pop_due()[1]['avoid_proxy'],
+                         ['10.0.0.1', 8080, 'http'])
+
+    def test_stale_after_handed_out(self):
+        queue = RetryQueue(3, backoff=0, stale=0.2)
+        queue.track(('a', {}))
+        done = []
+        thread = threading.Thread(target=lambda:
+                                  done.append(queue.wait_due()))
+        thread.start()
+        # A job that wasn't handed out yet never goes stale.
+        time.sleep(0.4)
+        self.assertEqual(done, [])
+        queue.handed_out('a')
+        thread.join(5)
+        self.assertEqual(done, [None])
+        # Forgotten, so a late result isn't retried.
+        self.assertFalse(queue.finished('a',
+                                        _attempt(config.PAGE_TIMEOUT_ST)))
+
+
+if __name__ == '__main__':
+    unittest.main()
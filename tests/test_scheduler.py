@@ -0,0 +1,117 @@
+"""Tests for scheduler.py.
+"""
+
+import threading
+import time
+import unittest
+
+from scheduler import HostScheduler, job_host
+
+
+def _job(job_id, host):
+    return (job_id, {'url': 'http://%s/%s' % (host, job_id)})
+
+
+def _drain(scheduler):
+    job_ids = []
+    while True:
+        job = scheduler.next()
+        if job is None:
+            return job_ids
+        job_ids.append(job[0])
+        scheduler.done(job[0])
+
+
+class HostSchedulerTest(unittest.TestCase):
+    def test_job_host(self):
+        self.assertEqual(job_host(_job('1', 'Example.com:8080')),
+                         'example.com')
+        self.assertEqual(job_host(('1', {})), '')
+
+    def test_interleaves_hosts(self):
+        scheduler = HostScheduler(max_per_host=1, min_delay=0, window=100)
+        for i in range(3):
+            scheduler.add(_job('a%d' % i, 'a'))
+        for i in range(2):
+            scheduler.add(_job('b%d' % i, 'b'))
+        scheduler.close()
+        self.assertEqual(_drain(scheduler), ['a0', 'b0', 'a1', 'b1', 'a2'])
+
+    def test_host_busy_until_done(self):
+        scheduler = HostScheduler(max_per_host=1, min_delay=0, window=100)
+        scheduler.add(_job('a0', 'a'))
+        scheduler.add(_job('a1', 'a'))
+        scheduler.close()
+        self.assertEqual(scheduler.next()[0], 'a0')
+        taken = []
+        thread = threading.Thread(target=lambda:
+                                  taken.append(scheduler.next()[0]))
+        thread.start()
+        time.sleep(0.2)
+        self.assertEqual(taken, [])
+        scheduler.done('a0')
+        thread.join(5)
+        self.assertEqual(taken, ['a1'])
+
+    def test_stale_jobs_free_their_host(self):
+        scheduler = HostScheduler(max_per_host=1, min_delay=0, window=100,
+                                  stale=0.2)
+        scheduler.add(_job('a0', 'a'))
+        scheduler.add(_job('a1', 'a'))
+        scheduler.close()
+        start = time.time()
+        self.assertEqual(scheduler.next()[0], 'a0')
+        self.assertEqual(scheduler.next()[0], 'a1')
+        self.assertTrue(time.time() - start >= 0.2)
+        # add() forgets stale jobs as well.
+        scheduler = HostScheduler(max_per_host=1, min_delay=0, window=100,
+                                  stale=0.2)
+        scheduler.add(_job('b0', 'b'))
+        scheduler.next()
+        time.sleep(0.3)
+        scheduler.add(_job('c0', 'c'))
+        self.assertEqual(scheduler.out, {})
+
+    def test_min_delay(self):
+        scheduler = HostScheduler(max_per_host=0, min_delay=0.2, window=100)
+        scheduler.add(_job('a0', 'a'))
+        scheduler.add(_job('a1', 'a'))
+        scheduler.add(_job('b0', 'b'))
+        scheduler.close()
+        start = time.time()
+        self.assertEqual(_drain(scheduler), ['a0', 'b0', 'a1'])
+        self.assertTrue(time.time() - start >= 0.2)
+
+    def test_big_host_leaves_room_for_others(self):
+        scheduler = HostScheduler(max_per_host=1, min_delay=0, window=4,
+                                  host_window=2)
+        # Blocks once the window and the overflow are full.
+        for i in range(6):
+            scheduler.add(_job('a%d' % i, 'a'))
+        scheduler.add(_job('b0', 'b'))
+        scheduler.add(_job('c0', 'c'))
+        self.assertEqual(scheduler.num_pending, 4)
+        self.assertEqual(scheduler.num_overflow, 4)
+        scheduler.close()
+        self.assertEqual(_drain(scheduler),
+                         ['a0', 'b0', 'c0', 'a1', 'a2', 'a3', 'a4', 'a5'])
+
+    def test_add_blocks_on_full_window(self):
+        scheduler = HostScheduler(max_per_host=1, min_delay=0, window=2,
+                                  host_window=0)
+        scheduler.add(_job('a0', 'a'))
+        scheduler.add(_job('b0', 'b'))
+        thread = threading.Thread(target=scheduler.add,
+                                  args=(_job('c0', 'c'),))
+        thread.start()
+        time.sleep(0.2)
+        self.assertTrue(thread.is_alive())
+        scheduler.next()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        scheduler.close()
+        self.assertEqual(_drain(scheduler), ['b0', 'c0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
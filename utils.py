@@ -1,6 +1,7 @@
 """Utilities for Stallone.
 """
 
+import hashlib
 import os
 import random
 import shutil
@@ -18,10 +19,32 @@ def cleanup(logger):
     if crawlglobs.display is not None:
         logger.info("Stopping XVFB")
         crawlglobs.display.stop()
-    profile_dir = os.path.join(crawlglobs.tmp_dir, config.PROFILE_DIR)
+    profile_dir = crawlglobs.profile_dir
+    if profile_dir is None:
+        profile_dir = os.path.join(crawlglobs.tmp_dir, config.PROFILE_DIR)
     if os.path.isdir(profile_dir):
         logger.debug("Deleting profiles in temp")
         shutil.rmtree(profile_dir)
+    root = os.path.dirname(profile_dir)
+    if root != crawlglobs.tmp_dir and os.path.isdir(root):
+        # The profiles were on tmpfs.
+        try:
+            os.rmdir(root)
+        except OSError:
+            pass
+
+def file_md5(file_path, chunk_size=65536):
+    """Returns md5 for file at file_path, reading it in chunks.
+    """
+    md5 = hashlib.md5()
+    fh = open(file_path, 'rb')
+    while True:
+        data = fh.read(chunk_size)
+        if not data:
+            break
+        md5.update(data)
+    fh.close()
+    return md5.hexdigest()
 
 def default_tmp_location(size=6, chars=string.ascii_letters + string.digits):
     """If a default tmp location for this execution doesn't exist, create and